@@ -7,6 +7,9 @@ config = {
     'SECURE_MODE' : False, # this mode is highly recommended if you use biomedisa for production with users you do not trust
     'DEBUG' : True, # activate the debug mode if you develop the app. This must be deactivated in production mode for security reasons!
     #'STORAGE_SIZE' : 1000, # storage size for new users
+    #'VOLUME_CACHE_SIZE' : 50, # disk budget in GB for decoded volumes shared across jobs (least recently used are evicted)
+    #'VOLUME_CACHE_DIR' : '/scratch/biomedisa_cache', # node-local cache location (default: biomedisa/tmp/volume_cache)
+    #'RW_CACHE_SIZE' : 10, # disk budget in GB for the hits of incremental random walks (least recently used crops are evicted)
 
     'EMAIL_CONFIRMATION' : False, # users must confirm their emails during the registration process (to handle biomedisa's notification service the following email support must be set up)
     'EMAIL' : 'philipp.loesel@anu.edu.au',
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biomedisa_app', '0104_alter_profile_storage_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='probe',
+            field=models.TextField(null=True),
+        ),
+    ]
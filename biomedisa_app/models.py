@@ -41,6 +41,7 @@ from django.core.files.storage import FileSystemStorage
 from django.utils.deconstruct import deconstructible
 from multiprocessing import Process
 import shutil
+import json
 import os
 
 class Profile(models.Model):
@@ -229,6 +230,29 @@ class Upload(models.Model):
     filters = models.CharField("Network architecture (AI)", default='32-64-128-256-512', max_length=30)
     resnet = models.BooleanField("ResNet convolutional blocks (AI)", default=False)
     validation_data = models.BooleanField('Validation data (AI)', default=False)
+    probe = models.TextField(null=True)
+
+    def get_probe(self):
+        # header information, cached until the file changes
+        from biomedisa_features.biomedisa_helper import probe_data
+        path_to_data = self.pic.path
+        if not os.path.exists(path_to_data):
+            return None
+        mtime = os.path.getmtime(path_to_data)
+        if self.probe:
+            info = json.loads(self.probe)
+            if info.get('mtime') == mtime:
+                # JSON returns lists, probe_data tuples
+                for key in ['shape', 'spacing']:
+                    if info.get(key) is not None:
+                        info[key] = tuple(info[key])
+                return info
+        info = probe_data(path_to_data)
+        if info:
+            info['mtime'] = mtime
+            self.probe = json.dumps(info)
+            self.save(update_fields=['probe'])
+        return info
 
 class UploadForm(forms.ModelForm):
     class Meta:
@@ -35,6 +35,7 @@ import biomedisa
 from biomedisa_features.curvop_numba import curvop, evolution
 from biomedisa_features.biomedisa_helper import (unique_file_path, load_data, save_data,
     pre_processing, img_to_uint8, silent_remove, send_data_to_host)
+from biomedisa_features.lazy_volume import LazyVolume, PaddedVolume
 import numpy as np
 import numba
 import argparse
@@ -160,14 +161,18 @@ def activeContour(data, labelData, alpha=1.0, smooth=1, steps=3,
 
     if bm.success:
 
-        # data type
-        bm.data = img_to_uint8(bm.data)
+        # memory-mapped volumes are converted and padded within the crop only
+        zsh, ysh, xsh = bm.labelData.shape
+        if isinstance(bm.data, LazyVolume):
+            bm.data = PaddedVolume(bm.data, np.uint8)
+        else:
+            # data type
+            bm.data = img_to_uint8(bm.data)
 
-        # append data
-        zsh, ysh, xsh = bm.data.shape
-        tmp = np.zeros((2+zsh, 2+ysh, 2+xsh), dtype=bm.data.dtype)
-        tmp[1:-1,1:-1,1:-1] = bm.data
-        bm.data = np.copy(tmp)
+            # append data
+            tmp = np.zeros((2+zsh, 2+ysh, 2+xsh), dtype=bm.data.dtype)
+            tmp[1:-1,1:-1,1:-1] = bm.data
+            bm.data = np.copy(tmp)
         tmp = np.zeros((2+zsh, 2+ysh, 2+xsh), dtype=bm.labelData.dtype)
         tmp[1:-1,1:-1,1:-1] = bm.labelData
         bm.labelData = np.copy(tmp)
@@ -3,12 +3,13 @@
 
 from collections import UserList
 import numpy
+import mmap
 import re
 import struct
 import time
 
 from skimage.measure._find_contours import find_contours
-from numba import jit
+from numba import jit, prange
 
 from .amira_header import AmiraHeader
 
@@ -139,246 +140,212 @@ def byterle_encoder(data):
     final_result = bytearray(output)
     return final_result
 
-@jit(nopython=True)
-def numba_array_create(dtype, base_size=1073741824):
-    assert(base_size > 0)
-    new_arr = numpy.zeros(base_size, dtype=dtype)
-    return new_arr
-
-@jit(nopython=True)
-def numba_array_copy(arr):
-    assert(arr.size > 0)
-    new_arr = numpy.zeros(arr.size, dtype=arr.dtype)
-    for i in range(arr.size):
-        new_arr[i] = arr[i]
-    return new_arr, new_arr.size
-
-@jit(nopython=True)
-def numba_array_resize(arr, base_size=1073741824):
-    assert(base_size > 0)
-    new_arr = numpy.zeros(arr.size+base_size, dtype=arr.dtype)
-    new_arr[:arr.size] = arr
-    return new_arr
-
-@jit(nopython=True)
-def numba_array_add(arr, idx, elem, base_size=1073741824):
-    assert(base_size > 0)
-    if idx >= arr.size:
-        arr = numba_array_resize(arr, base_size)
-    arr[idx] = elem
-    idx += 1
-    return arr, idx
+# size of independently coded segments (bytes of decoded data)
+SEGMENT_SIZE = 16777216
 
 @jit(nopython=True)
-def numba_array_extend(arr, idx, elems, elems_len, base_size=1073741824):
-    assert(base_size > 0)
-    assert(elems.size <= base_size)
-    if idx+elems.size >= arr.size:
-        arr = numba_array_resize(arr, base_size)
-    for i in range(elems_len):
-        arr[idx+i] = elems[i]
-    idx += elems_len
-    return arr, idx
+def byterle_encode_segment(data, start, stop, output, idx, write):
+    """HxByteRLE encode ``data[start:stop]``
 
-@jit(nopython=True)
-def numba_array_extend_mult(arr, idx, elem, no_elem, base_size=1073741824):
-    assert(base_size > 0)
-    assert(no_elem <= base_size)
-    if idx+no_elem >= arr.size:
-        arr = numba_array_resize(arr, base_size)
-    arr[idx:idx+no_elem] = elem
-    idx += no_elem
-    return arr, idx
+    Repeats of 2 to 127 bytes are written as ``count, value``, all other
+    bytes as ``128+count`` followed by up to 127 literals. Returns the new
+    output index. With ``write=False`` only the encoded size is counted.
+    """
+    MAX = 127
+    i = start
+    while i < stop:
+        # length of the repeat starting at i
+        run = 1
+        while i + run < stop and run < MAX and data[i + run] == data[i]:
+            run += 1
+        if run > 1:
+            if write:
+                output[idx] = run
+                output[idx + 1] = data[i]
+            idx += 2
+            i += run
+        else:
+            # literals until the next repeat
+            lit = 1
+            while i + lit < stop and lit < MAX:
+                if i + lit + 1 < stop and data[i + lit] == data[i + lit + 1]:
+                    break
+                lit += 1
+            if write:
+                output[idx] = 128 + lit
+                output[idx + 1:idx + 1 + lit] = data[i:i + lit]
+            idx += 1 + lit
+            i += lit
+    return idx
+
+@jit(nopython=True, parallel=True)
+def byterle_encode_parallel(data, segment_size):
+    nsegments = (data.size + segment_size - 1) // segment_size
+    sizes = numpy.zeros(nsegments + 1, dtype=numpy.int64)
+    dummy = numpy.zeros(0, dtype=numpy.uint8)
+    for k in prange(nsegments):
+        start = k * segment_size
+        stop = min(start + segment_size, data.size)
+        sizes[k + 1] = byterle_encode_segment(data, start, stop, dummy, 0, False)
+    offsets = numpy.cumsum(sizes)
+    output = numpy.empty(offsets[-1], dtype=numpy.uint8)
+    for k in prange(nsegments):
+        start = k * segment_size
+        stop = min(start + segment_size, data.size)
+        byterle_encode_segment(data, start, stop, output, offsets[k], True)
+    return output
 
 @jit(nopython=True)
-def byterle_decoder_njit(data, len_data, output_size):
-    """Python drop-in replacement for compiled equivalent
+def byterle_index(data, segment_size):
+    """Exact decoded size and entry points of HxByteRLE data
 
-    :param int output_size: the number of items when ``data`` is uncompressed
-    :param str data: a raw stream of data to be unpacked
-    :return numpy.array output: an array of ``numpy.uint8``
+    Only control bytes are visited. Every ``segment_size`` decoded bytes
+    the input and output positions are recorded so that the segments can
+    be decoded independently.
     """
-
-    output = numba_array_create(dtype=numpy.uint8)
-    output_idx = 0
-
-    count = True
-    no_repeat = False
-    no = None
-    i = 0
-    while i < len_data:
-        if count:
+    # decoded size
+    i, j = 0, 0
+    while i < data.size:
+        no = data[i]
+        if no > 127:
+            no &= 0x7f
+            i += 1 + no
+        else:
+            i += 2
+        j += no
+    size = j
+
+    # entry points
+    n = size // segment_size + 2
+    in_offsets = numpy.zeros(n, dtype=numpy.int64)
+    out_offsets = numpy.zeros(n, dtype=numpy.int64)
+    k, mark = 1, segment_size
+    i, j = 0, 0
+    while i < data.size:
+        if j >= mark:
+            in_offsets[k] = i
+            out_offsets[k] = j
+            k += 1
+            mark = j + segment_size
+        no = data[i]
+        if no > 127:
+            no &= 0x7f
+            i += 1 + no
+        else:
+            i += 2
+        j += no
+    in_offsets[k] = data.size
+    out_offsets[k] = size
+    return size, in_offsets[:k+1], out_offsets[:k+1]
+
+@jit(nopython=True, parallel=True)
+def byterle_decode_parallel(data, in_offsets, out_offsets, output):
+    for k in prange(in_offsets.size - 1):
+        i, j = in_offsets[k], out_offsets[k]
+        while i < in_offsets[k + 1]:
             no = data[i]
             if no > 127:
-                no &= 0x7f # 2's complement
-                no_repeat = True
+                no &= 0x7f
+                output[j:j + no] = data[i + 1:i + 1 + no]
+                i += 1 + no
             else:
-                no_repeat = False
-
-            i += 1
-            count = False
-            continue
-        elif not count:
-            if no_repeat:
-                no_rep, no_rep_idx = numba_array_copy(data[i:i + no])
-                output, output_idx = numba_array_extend(output, output_idx, no_rep, no_rep_idx)
-                i += no
-            elif not no_repeat:
-                elem = data[i]
-                output, output_idx = numba_array_extend_mult(output, output_idx, elem, no)
-                i += 1
-
-            count = True
-            no_repeat = False
-            continue
-
-    output = output[:output_idx]
-
-    assert output_idx == output_size
-    return output
-
-@jit(nopython=True)
-def byterle_encoder_njit(data, len_data):
-
-    BASE = 128
-    MAX = 127
-
-    output = numba_array_create(dtype=numpy.uint8)
-    no_rep = numba_array_create(dtype=numpy.uint8, base_size=MAX)
-    output_idx = 0
-    no_rep_idx = 0
-
-    prev = None
-    cur = None
-    cnt = 0
-    i = 0
-    while i < len_data:
-        cur = data[i]
-        if prev is not None and prev == cur: # repeat
-            if no_rep_idx > 0:
-                output, output_idx = numba_array_add(output, output_idx, BASE+no_rep_idx)
-                output, output_idx = numba_array_extend(output, output_idx, no_rep, no_rep_idx)
-                no_rep_idx = 0
-
-            # find all repeat
-            cnt = 1 # prev
-            while i < len_data:
-                cur = data[i]
-                if prev == cur:
-                    cnt += 1
-                    if cnt == MAX:
-                        output, output_idx = numba_array_add(output, output_idx, cnt)
-                        output, output_idx = numba_array_add(output, output_idx, cur)
-                        prev = None
-                        cur = None
-                        cnt = 0
-                        i += 1
-                        break
-
-                else:  # end of repeat
-                    output, output_idx = numba_array_add(output, output_idx, cnt)
-                    output, output_idx = numba_array_add(output, output_idx, prev)
-                    prev = None
-                    cnt = 0
-                    break
-
-                prev = cur
-                i += 1
-
-            if cnt > 0: # end of file
-                output, output_idx = numba_array_add(output, output_idx, cnt)
-                output, output_idx = numba_array_add(output, output_idx, cur)
-                prev = None
-                cur = None
-                cnt = 0
-
-        else: # no repeat
-            if prev is not None:
-                no_rep, no_rep_idx = numba_array_add(no_rep, no_rep_idx, prev)
-                if no_rep_idx == MAX:
-                    output, output_idx = numba_array_add(output, output_idx, BASE+no_rep_idx)
-                    output, output_idx = numba_array_extend(output, output_idx, no_rep, no_rep_idx)
-                    no_rep_idx = 0
-
-            prev = cur
-            i += 1
-
-    if cur is not None:
-        no_rep, no_rep_idx = numba_array_add(no_rep, no_rep_idx, cur)
-
-    if no_rep_idx > 0:
-        output, output_idx = numba_array_add(output, output_idx, BASE+no_rep_idx)
-        output, output_idx = numba_array_extend(output, output_idx, no_rep, no_rep_idx)
-        no_rep_idx = 0
-
-    output = output[:output_idx]
+                output[j:j + no] = data[i + 1]
+                i += 2
+            j += no
     return output
 
 def hxbyterle_decode(output_size, data):
     """Decode HxRLE data stream
 
-    If C-extension is not compiled it will use a (slower) Python equivalent
+    The exact output size is computed first, then independent segments
+    are decoded in parallel into a preallocated array.
 
     :param int output_size: the number of items when ``data`` is uncompressed
     :param str data: a raw stream of data to be unpacked
     :return numpy.array output: an array of ``numpy.uint8``
     """
 
-    # input_data = struct.unpack('<{}B'.format(len(data)), data)
     input_data = numpy.ndarray((len(data),), '<B', data)
 
-    output = byterle_decoder_njit(input_data, len(input_data), output_size)
-
-    assert len(output) == output_size
+    size, in_offsets, out_offsets = byterle_index(input_data, SEGMENT_SIZE)
+    assert size == output_size
+    output = numpy.empty(size, dtype=numpy.uint8)
+    byterle_decode_parallel(input_data, in_offsets, out_offsets, output)
     return output
 
 def hxbyterle_encode(data):
     """Encode HxRLE data
 
+    Segments are encoded independently in parallel, their concatenation
+    is a valid HxByteRLE stream.
+
     :param numpy.array data: an array of ``numpy.uint8``
-    :return str output: packed data stream
+    :return numpy.array output: packed data stream
     """
 
-    buf = data.tobytes()
-    # buf = data.astype('<B').tostring()
-
-    if len(buf) == 0:
-        return ""
+    buf = numpy.ascontiguousarray(data).reshape(-1).view(numpy.uint8)
 
-    # output = byterle_encoder(buf)
-    output = byterle_encoder_njit(buf, len(buf))
-    output = output.tolist()
+    if buf.size == 0:
+        return b""
 
-    final_output = bytearray(output)
-    return final_output
+    output = byterle_encode_parallel(buf, SEGMENT_SIZE)
+    return output
 
 
 def hxzip_decode(data_size, data):
     """Decode HxZip data stream
 
+    A single zlib stream cannot be split, it is inflated piecewise into a
+    preallocated array instead.
+
     :param int data_size: the number of items when ``data`` is uncompressed
     :param str data: a raw stream of data to be unpacked
     :return numpy.array output: an array of ``numpy.uint8``
     """
     import zlib
-    data_stream = zlib.decompress(data)
-    output = numpy.array(struct.unpack('<{}B'.format(len(data_stream)), data_stream), dtype=numpy.uint8)
-    # output = numpy.ndarray((data_size,), '<B', data)
-
-    assert len(output) == data_size
+    output = numpy.empty(data_size, dtype=numpy.uint8)
+    decompressor = zlib.decompressobj()
+    idx = 0
+    while data and idx < data_size:
+        chunk = decompressor.decompress(data, min(SEGMENT_SIZE, data_size - idx))
+        output[idx:idx+len(chunk)] = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        idx += len(chunk)
+        data = decompressor.unconsumed_tail
+    chunk = decompressor.flush()
+    assert idx + len(chunk) == data_size
+    output[idx:] = numpy.frombuffer(chunk, dtype=numpy.uint8)
     return output
 
 def hxzip_encode(data):
     """Encode HxZip data stream
 
+    Segments are deflated in parallel and joined at flush points into a
+    single zlib stream, so the result is readable by any zlib decoder.
+
     :param numpy.array data: an array of ``numpy.uint8``
     :return str output: packed data stream
     """
     import zlib
-
-    buf = data.tobytes()
-    # buf = data.astype('<B').tostring()
-    output = zlib.compress(buf)
+    from concurrent.futures import ThreadPoolExecutor
+
+    buf = numpy.ascontiguousarray(data).reshape(-1).view(numpy.uint8)
+    nsegments = max(1, (buf.size + SEGMENT_SIZE - 1) // SEGMENT_SIZE)
+
+    def deflate(k):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        segment = compressor.compress(buf[k*SEGMENT_SIZE:(k+1)*SEGMENT_SIZE])
+        if k == nsegments - 1:
+            return segment + compressor.flush(zlib.Z_FINISH)
+        return segment + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    with ThreadPoolExecutor() as pool:
+        segments = list(pool.map(deflate, range(nsegments)))
+
+    # zlib header and adler32 checksum of the whole stream
+    adler = 1
+    for k in range(nsegments):
+        adler = zlib.adler32(buf[k*SEGMENT_SIZE:(k+1)*SEGMENT_SIZE], adler)
+    output = b''.join([b'\x78\x9c'] + segments + [struct.pack('>I', adler & 0xffffffff)])
     return output
 
 def to_numpy_dtype(data_type):
@@ -645,6 +612,7 @@ class AmiraDataStream(object):
         self.__data_pointer = data_pointer
         self.__stream_data = stream_data
         self.__decoded_length = 0
+        self.offsets = None
     @property
     def header(self):
         """An :py:class:``ahds.header.AmiraHeader`` object"""
@@ -698,8 +666,24 @@ class AmiraMeshDataStream(AmiraDataStream):
             pass
         else:
             raise ValueError("Unable to determine data size")
+    def encoded_length(self):
+        """Number of bytes of this stream if known from the header"""
+        if self.data_pointer.data_length:
+            return self.data_pointer.data_length
+        if self.data_pointer.data_format is None and self.header.designation.format != "ASCII" \
+            and self.decoded_length and self.data_pointer.data_type:
+            dimension = self.data_pointer.data_dimension or 1
+            itemsize = numpy.dtype(to_numpy_dtype(self.data_pointer.data_type)).itemsize
+            return self.decoded_length * dimension * itemsize
+        return None
     @property
     def encoded_data(self):
+        if self.offsets is not None:
+            # view into the memory-mapped file without copying
+            start, end = self.offsets
+            if self.header.designation.format == "ASCII":
+                return self.stream_data[start:end]
+            return memoryview(self.stream_data)[start:end]
         i = self.data_pointer.data_index
         regex = self.regex.replace(b'{}', b'%d')
         cnt = regex.count(b"%d")
@@ -932,9 +916,32 @@ class DataStreams(object):
         self.__filetype = None
         self.__stream_data = None
         self.__data_streams = self.__configure()
+    def __locate(self):
+        """Find the offsets of all streams once, in order of the data pointers"""
+        stream_data = self.__stream_data
+        pos = len(self.__amira_header.raw_header)
+        streams = [self.__data_streams[k] for k in sorted(self.__data_streams)]
+        for k, stream in enumerate(streams):
+            marker = b'\n@%d\n' % stream.data_pointer.data_index
+            start = stream_data.find(marker, pos)
+            if start < 0:
+                return
+            start += len(marker)
+            length = stream.encoded_length()
+            if length is not None:
+                end = start + length
+            elif k < len(streams) - 1:
+                end = stream_data.find(b'\n@%d' % streams[k+1].data_pointer.data_index, start)
+                if end < 0:
+                    return
+            else:
+                end = len(stream_data)
+            stream.offsets = (start, end)
+            pos = end
     def __configure(self):
         with open(self.__fn, 'rb') as f:
-            self.__stream_data = f.read() #.strip(b'\n')
+            # copy-on-write mapping, pages are only read when accessed
+            self.__stream_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
             if self.__amira_header.designation.filetype == "AmiraMesh" or self.__amira_header.designation.filetype == "Avizo":
                 self.__filetype = self.__amira_header.designation.filetype
                 i = 0
@@ -947,6 +954,7 @@ class DataStreams(object):
                 self.__data_streams[i + 1] = AmiraMeshDataStream(self.__amira_header, data_pointer, self.__stream_data)
                 # reset AmiraMeshDataStream.last_stream
                 AmiraMeshDataStream.last_stream = False
+                self.__locate()
             elif self.__amira_header.designation.filetype == "HyperSurface":
                 self.__filetype = "HyperSurface"
                 if self.__amira_header.designation.format == "BINARY":
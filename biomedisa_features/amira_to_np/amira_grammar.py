@@ -6,6 +6,7 @@ Grammar to parse headers in Amira files
 import sys
 import re
 import time
+import mmap
 import collections
 
 from pprint import pprint
@@ -281,33 +282,27 @@ def detect_format(fn, format_bytes=50, *args, **kwargs):
 def get_header(fn, file_format, header_bytes=536870912, *args, **kwargs): #2097152
     """Apply rules for detecting the boundary of the header
 
+    The file is memory-mapped, so only the pages up to the end of the
+    header are read.
+
     :param str fn: file name
     :param str file_format: either ``AmiraMesh`` or ``Avizo``or ``HyperSurface``
-    :param int header_bytes: number of bytes in which to search for the header [default: 20000]
+    :param int header_bytes: unused, kept for compatibility
     :return str data: the header as per the ``file_format``
     """
-    assert header_bytes > 0
     assert file_format in ['AmiraMesh', 'Avizo', 'HyperSurface']
-    header_count = header_bytes
 
-    while (True):
-        m = None
-        with open(fn, 'rb') as f:
-            rough_header = f.read(header_count)
+    with open(fn, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
             if file_format == "AmiraMesh" or file_format == "Avizo":
-                m = re.search(b'(?P<data>)\n@1\n', rough_header, flags=re.S)
+                idx = mm.find(b'\n@1\n')
             elif file_format == "HyperSurface":
-                m = re.search(b'(?P<data>)\nVertices [0-9]*\n', rough_header, flags=re.S)
-            elif file_format == "Undefined":
-                raise ValueError("Unable to parse undefined file")
-        if m is None:
-            header_count += header_bytes
-        else:
-            # select the data
-            # data = m.group('data')
-            idx = m.start()
-            data = rough_header[:idx]
-            return data
+                m = re.search(b'\nVertices [0-9]*\n', mm)
+                idx = -1 if m is None else m.start()
+            if idx < 0:
+                raise ValueError("Unable to find the end of the header")
+            data = mm[:idx]
+    return data
 
 def parse_header(data, *args, **kwargs):
     """Parse the data using the grammar specified in this module
@@ -0,0 +1,96 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from biomedisa_features.biomedisa_helper import load_data
+from tifffile import imwrite
+import numpy as np
+import argparse
+import tempfile
+import time
+
+CODECS = [None, 'packbits', 'zlib', 'zstd', 'lzma']
+
+def _synthetic(size):
+    # label map of nested spheres and a matching uncertainty map
+    z, y, x = np.mgrid[:size, :size, :size] - size // 2
+    r = np.sqrt(x**2 + y**2 + z**2)
+    labels = np.zeros((size, size, size), dtype=np.uint8)
+    for k, radius in enumerate([0.45, 0.3, 0.15]):
+        labels[r < radius * size] = k + 1
+    distance = np.abs(r - np.round(r / (0.15 * size)) * 0.15 * size)
+    uncertainty = np.clip(255 * (1 - distance / 3), 0, 255).astype(np.uint8)
+    return labels, uncertainty
+
+if __name__ == '__main__':
+
+    # initialize arguments
+    parser = argparse.ArgumentParser(description='Write time and file size of TIFF codecs.',
+             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path_to_data', type=str, metavar='PATH_TO_DATA', nargs='?', default=None,
+                        help='volume to write, a synthetic label and uncertainty map is used if omitted')
+    parser.add_argument('-s', '--size', type=int, default=512,
+                        help='edge length of the synthetic volumes')
+    parser.add_argument('-t', '--tile', type=int, default=256,
+                        help='tile edge length (0 writes strips only)')
+    parser.add_argument('-w', '--maxworkers', type=int, default=os.cpu_count(),
+                        help='number of compression threads')
+    args = parser.parse_args()
+
+    if args.path_to_data:
+        data, _ = load_data(args.path_to_data)
+        volumes = [(os.path.basename(args.path_to_data), data)]
+    else:
+        labels, uncertainty = _synthetic(args.size)
+        volumes = [('labels', labels), ('uncertainty', uncertainty)]
+
+    tiles = [None, (args.tile, args.tile)] if args.tile else [None]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = tmp_dir + '/benchmark.tif'
+        print('%-14s %-9s %-8s %10s %12s %8s' %('volume', 'codec', 'tiled', 'time [s]', 'size [MB]', 'ratio'))
+        for name, data in volumes:
+            for codec in CODECS:
+                for tile in tiles:
+                    # write directly, save_data would silently fall back to zlib
+                    tic = time.time()
+                    try:
+                        imwrite(path, data, bigtiff=data.nbytes > 2e9, compression=codec,
+                            tile=tile, maxworkers=args.maxworkers)
+                    except Exception as e:
+                        print(f'{name} {codec}: not available ({e})')
+                        if os.path.exists(path):
+                            os.remove(path)
+                        continue
+                    t = time.time() - tic
+                    size = os.path.getsize(path)
+                    print('%-14s %-9s %-8s %10.2f %12.1f %8.1f' %(name, codec, tile is not None,
+                        t, size / 1e6, data.nbytes / size))
+                    os.remove(path)
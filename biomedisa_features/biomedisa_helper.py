@@ -32,7 +32,10 @@ except:
     from biomedisa_app.config_example import config
 from biomedisa.settings import BASE_DIR, PRIVATE_STORAGE_ROOT
 from biomedisa_features.amira_to_np.amira_helper import amira_to_np, np_to_amira
-from biomedisa_features.nc_reader import nc_to_np, np_to_nc
+from biomedisa_features.nc_reader import nc_to_np, np_to_nc, nc_probe, _tmpfs_dir
+from biomedisa_features.lazy_volume import lazy_load
+from biomedisa_features.hdf5_volume import h5_to_np, np_to_h5
+from biomedisa_features import volume_cache
 from tifffile import imread, imwrite
 from medpy.io import load, save
 import SimpleITK as sitk
@@ -46,7 +49,9 @@ import time
 import zipfile
 import numba
 from shutil import copytree
+import shutil
 import subprocess
+import json
 import re
 import math
 
@@ -224,7 +229,112 @@ def rgb2gray(img):
     """Convert a RGB image to gray scale."""
     return 0.2989*img[:,:,0] + 0.587*img[:,:,1] + 0.114*img[:,:,2]
 
-def load_data_(path_to_data, process):
+class SliceHeaders(object):
+    """Compact per-slice headers of an image series
+
+    Stores spacing, offset and direction of each slice in arrays and the
+    meta data (e.g. DICOM tags) as plain dictionaries instead of keeping a
+    medpy Header with its full SimpleITK image for every slice.
+    """
+    def __init__(self, n, ndim):
+        self.spacing = np.ones((n, ndim), dtype=np.float64)
+        self.offset = np.zeros((n, ndim), dtype=np.float64)
+        self.direction = np.tile(np.identity(ndim), (n, 1, 1))
+        self.meta_data = [None] * n
+
+    def set(self, k, header):
+        self.spacing[k] = header.spacing
+        self.offset[k] = header.offset
+        self.direction[k] = header.direction
+        if header.sitkimage is not None:
+            keys = header.sitkimage.GetMetaDataKeys()
+            if keys:
+                self.meta_data[k] = {key: header.sitkimage.GetMetaData(key) for key in keys}
+
+    def select(self, valid):
+        headers = SliceHeaders(0, self.spacing.shape[1])
+        headers.spacing = self.spacing[valid]
+        headers.offset = self.offset[valid]
+        headers.direction = self.direction[valid]
+        headers.meta_data = [m for m, v in zip(self.meta_data, valid) if v]
+        return headers
+
+    def __len__(self):
+        return len(self.meta_data)
+
+    def __getitem__(self, k):
+        from medpy.io import Header
+        header = Header(spacing=tuple(self.spacing[k]), offset=tuple(self.offset[k]))
+        header.direction = np.copy(self.direction[k])
+        if self.meta_data[k]:
+            # medpy copies meta data from a SimpleITK image when saving
+            ndim = self.spacing.shape[1]
+            header.sitkimage = sitk.Image([1] * ndim, sitk.sitkUInt8)
+            for key, value in self.meta_data[k].items():
+                header.sitkimage.SetMetaData(key, value)
+        return header
+
+def _to_slice(img):
+    rgb = False
+    if len(img.shape) == 3 and img.shape[2] == 3:
+        img = rgb2gray(img)
+        rgb = True
+    elif len(img.shape) == 3 and img.shape[2] == 1:
+        img = img[:,:,0]
+    return img, rgb
+
+def load_slices(files):
+    """Load an image series into a preallocated stack
+
+    Each file is read exactly once by a pool of threads. Shape and type
+    are taken from the first readable slice, unreadable files are skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # first readable slice
+    files = sorted([name for name in files if os.path.isfile(name)])
+    for first, file_name in enumerate(files):
+        try:
+            img, img_header = load(file_name)
+            break
+        except:
+            pass
+    else:
+        raise Exception('No readable slices found.')
+    files = files[first:]
+    data = np.zeros((len(files), img.shape[0], img.shape[1]), dtype=img.dtype)
+    headers = SliceHeaders(len(files), len(img_header.spacing))
+    valid = np.ones(len(files), dtype=bool)
+    rgb = np.zeros(len(files), dtype=bool)
+
+    def store(k, img, img_header):
+        img, rgb[k] = _to_slice(img)
+        if img.shape != data.shape[1:]:
+            raise Exception(f'Slice {os.path.basename(files[k])} has a different shape.')
+        data[k] = img
+        headers.set(k, img_header)
+
+    def read(k):
+        try:
+            img, img_header = load(files[k])
+        except:
+            valid[k] = False
+            return
+        store(k, img, img_header)
+
+    # decode the remaining slices in parallel
+    store(0, img, img_header)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        list(pool.map(read, range(1, len(files))))
+
+    # remove unreadable files
+    if not np.all(valid):
+        data = data[valid]
+        headers = headers.select(valid)
+        files = [name for name, v in zip(files, valid) if v]
+    return data, headers, files, np.any(rgb)
+
+def load_data_(path_to_data, process, lazy=False):
 
     if os.path.isdir(path_to_data):
         path_to_data = path_to_data + '.zip'
@@ -235,7 +345,27 @@ def load_data_(path_to_data, process):
     elif extension == '.bz2':
         extension = os.path.splitext(os.path.splitext(path_to_data)[0])[1]
 
-    if extension == '.am':
+    # memory-map uncompressed volumes instead of reading them
+    if lazy and not config['SECURE_MODE']:
+        volume = lazy_load(path_to_data, extension)
+        if volume is not None:
+            data, header = volume
+            return data, header, extension
+
+    # decoded volumes are shared across jobs
+    key, cached = None, None
+    if volume_cache.enabled() and extension not in volume_cache.UNCACHED:
+        try:
+            key = volume_cache.content_hash(path_to_data, extension)
+            cached = volume_cache.lookup(key) if key else None
+        except Exception as e:
+            print('Warning: volume cache unavailable.', e)
+            key = None
+
+    if cached is not None:
+        data, header, extension = cached
+
+    elif extension == '.am':
         try:
             data, header = amira_to_np(path_to_data)
             header = [header]
@@ -254,6 +384,13 @@ def load_data_(path_to_data, process):
             print(e)
             data, header = None, None
 
+    elif extension == '.hdf5':
+        try:
+            data, header = h5_to_np(path_to_data), None
+        except Exception as e:
+            print(e)
+            data, header = None, None
+
     elif extension in ['.hdr', '.mhd', '.mha', '.nrrd', '.nii', '.nii.gz']:
         try:
             data, header = load(path_to_data)
@@ -287,30 +424,10 @@ def load_data_(path_to_data, process):
                 data, header = None, None
         else:
             try:
-                # remove unreadable files or directories
-                for name in files:
-                    if os.path.isfile(name):
-                        try:
-                            img, _ = load(name)
-                        except:
-                            files.remove(name)
-                    else:
-                        files.remove(name)
-                files.sort()
-
                 # load data slice by slice
-                img, _ = load(files[0])
-                data = np.zeros((len(files), img.shape[0], img.shape[1]), dtype=img.dtype)
-                header, image_data_shape = [], []
-                for k, file_name in enumerate(files):
-                    img, img_header = load(file_name)
-                    if len(img.shape) == 3 and img.shape[2] == 3:
-                        img = rgb2gray(img)
-                        extension = '.tif'
-                    elif len(img.shape) == 3 and img.shape[2] == 1:
-                        img = img[:,:,0]
-                    data[k] = img
-                    header.append(img_header)
+                data, header, files, rgb = load_slices(files)
+                if rgb:
+                    extension = '.tif'
                 header = [header, files, data.dtype]
                 data = np.swapaxes(data, 1, 2)
                 data = np.copy(data, order='C')
@@ -340,53 +457,203 @@ def load_data_(path_to_data, process):
     else:
         data, header = None, None
 
+    # cache the decoded volume before it is handed to the caller
+    cache = key and cached is None and data is not None
+    if cache and not config['SECURE_MODE']:
+        volume_cache.store(key, data, header, extension)
+
     if config['SECURE_MODE']:
+        entry = (data, header, extension)
         if extension not in ['.am','.tif']:
             extension, header = '.tif', None
-        if data is None:
-            data = 'None'
-        if header is None:
-            header = 'None'
-        for file, data_type in [(data, 'data'), (header, 'header'), (extension, 'extension')]:
-            src = BASE_DIR + '/tmp/tmp.' + data_type + '_' + process + '.npy'
-            dest = BASE_DIR + '/tmp/' + data_type + '_' + process + '.npy'
-            np.save(src, file, allow_pickle=False)
-            os.rename(src, dest)
+        # hand the arrays back as memory-mapped files on tmpfs
+        message = {'extension': extension}
+        for file, data_type in [(data, 'data'), (header, 'header')]:
+            if file is not None:
+                src = _shared_dir() + '/tmp.' + data_type + '_' + process + '.npy'
+                dest = _shared_dir() + '/' + data_type + '_' + process + '.npy'
+                np.save(src, file, allow_pickle=False)
+                os.rename(src, dest)
+                message[data_type] = dest
+        # signal completion
+        from redis import Redis
+        Redis().publish('load_data_' + process, json.dumps(message))
+        # the caller already has the volume
+        if cache:
+            volume_cache.store(key, *entry)
     else:
         return data, header, extension
 
-def load_data(path_to_data, process='None', return_extension=False):
+def _shared_dir():
+    # memory-backed storage if available
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return BASE_DIR + '/tmp'
+
+def load_data(path_to_data, process='None', return_extension=False, lazy=False):
     if config['SECURE_MODE']:
         from redis import Redis
         from rq import Queue
-        q = Queue('load_data', connection=Redis())
+        import uuid
+        process = process + '_' + uuid.uuid4().hex
+        redis = Redis()
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('load_data_' + process)
+        q = Queue('load_data', connection=redis)
         job = q.enqueue_call(load_data_, args=(path_to_data, process), timeout=-1)
-        for k, data_type in enumerate(['data', 'header', 'extension']):
-            file_path = BASE_DIR + '/tmp/' + data_type + '_' + process + '.npy'
-            while not os.path.exists(file_path):
-                time.sleep(1)
-            if k == 0:
-                data = np.load(file_path)
-                if data.dtype == '<U4':
-                    if str(data) == 'None':
-                        data = None
-            elif k == 1:
-                header = np.load(file_path)
-                if header.dtype == '<U4':
-                    if str(header) == 'None':
-                        header = None
-            elif k == 2:
-                extension = str(np.load(file_path))
-                if extension == 'None':
-                    extension = None
-            os.remove(file_path)
+
+        # wait for the completion message
+        message = None
+        while message is None:
+            message = pubsub.get_message(timeout=10)
+            if message is None and job.get_status() in ['failed', 'stopped', 'canceled']:
+                break
+        pubsub.close()
+        message = json.loads(message['data']) if message else {}
+
+        # map the arrays without copying, the files are removed immediately
+        data, header = None, None
+        if 'data' in message:
+            data = np.load(message['data'], mmap_mode='c')
+            os.remove(message['data'])
+        if 'header' in message:
+            header = np.load(message['header'])
+            os.remove(message['header'])
+        extension = message.get('extension', None)
     else:
-        data, header, extension = load_data_(path_to_data, process)
+        data, header, extension = load_data_(path_to_data, process, lazy)
     if return_extension:
         return data, header, extension
     else:
         return data, header
 
+def _sitk_probe(path_to_data):
+    # image information without reading the voxels
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path_to_data)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    dtype = sitk.GetArrayFromImage(sitk.Image([1] * len(size), reader.GetPixelID())).dtype
+    return size, reader.GetSpacing(), dtype
+
+def probe_data(path_to_data):
+    """Header information of a volume without reading its data
+
+    Returns a dictionary with ``format``, ``shape`` (z,y,x), ``dtype``,
+    ``spacing`` (x,y,z) or None and the number of Amira ``streams``, or
+    None if the file cannot be probed.
+    """
+    if os.path.isdir(path_to_data):
+        path_to_data = path_to_data + '.zip'
+
+    extension = os.path.splitext(path_to_data)[1]
+    if extension == '.gz':
+        extension = '.nii.gz'
+    elif extension == '.bz2':
+        extension = os.path.splitext(os.path.splitext(path_to_data)[0])[1]
+
+    info = {'format': extension, 'shape': None, 'dtype': None, 'spacing': None, 'streams': 1}
+    try:
+        if extension == '.am':
+            from biomedisa_features.amira_to_np.amira_header import AmiraHeader
+            from biomedisa_features.amira_to_np.amira_data_stream import to_numpy_dtype
+            header = AmiraHeader.from_file(path_to_data)
+            xsh, ysh, zsh = header.definitions.Lattice
+            info['shape'] = (zsh, ysh, xsh)
+            info['streams'] = len(header.data_pointers.attrs)
+            info['dtype'] = np.dtype(to_numpy_dtype(header.data_pointers.data_pointer_1.data_type)).name
+            bounding_box = re.search(b'BoundingBox (.*),\n', header.raw_header)
+            if bounding_box:
+                i0, i1, i2, i3, i4, i5 = bounding_box.group(1).split(b' ')
+                info['spacing'] = ((float(i1)-float(i0)) / xsh,
+                    (float(i3)-float(i2)) / ysh, (float(i5)-float(i4)) / zsh)
+
+        elif extension == '.nc':
+            shape, dtype = nc_probe(path_to_data)
+            info['shape'], info['dtype'] = shape, dtype.name
+
+        elif extension == '.hdf5':
+            import h5py
+            with h5py.File(path_to_data, 'r') as hf:
+                info['shape'], info['dtype'] = hf['scale0'].shape, hf['scale0'].dtype.name
+
+        elif extension in ['.hdr', '.mhd', '.mha', '.nrrd', '.nii', '.nii.gz']:
+            size, spacing, dtype = _sitk_probe(path_to_data)
+            info['shape'], info['spacing'], info['dtype'] = tuple(size[::-1]), tuple(spacing), dtype.name
+
+        elif extension == '.zip':
+            # slices are counted like in load_slices, unreadable files are skipped
+            def _slice_probe(name):
+                try:
+                    return _sitk_probe(name)
+                except Exception:
+                    return None
+            if os.path.isdir(path_to_data[:-4]):
+                files = glob.glob(path_to_data[:-4]+'/**/*', recursive=True)
+                files = sorted([name for name in files if os.path.isfile(name)])
+                if any('.nc' in name for name in files):
+                    shape, dtype = nc_probe(path_to_data[:-4])
+                    info.update({'format': '.nc', 'shape': shape, 'dtype': dtype.name})
+                    return info
+                probes = [_slice_probe(name) for name in files]
+            else:
+                # extract one member of the archive at a time
+                import tempfile
+                with zipfile.ZipFile(path_to_data, 'r') as zip_ref:
+                    names = sorted([name for name in zip_ref.namelist() if not name.endswith('/')])
+                    if any('.nc' in name for name in names):
+                        # probe NetCDF blocks one at a time on tmpfs
+                        tmp_dir, zsh = _tmpfs_dir(), 0
+                        try:
+                            for name in names:
+                                if '.nc' in name:
+                                    block = zip_ref.extract(name, path=tmp_dir)
+                                    shape, dtype = nc_probe(block)
+                                    os.remove(block)
+                                    zsh += shape[0]
+                        finally:
+                            shutil.rmtree(tmp_dir, ignore_errors=True)
+                        info.update({'format': '.nc', 'shape': (zsh,) + shape[1:], 'dtype': dtype.name})
+                        return info
+                    tmp_dir, probes = tempfile.mkdtemp(), []
+                    try:
+                        for name in names:
+                            member = zip_ref.extract(name, path=tmp_dir)
+                            probes.append(_slice_probe(member))
+                            os.remove(member)
+                    finally:
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+            probes = [probe for probe in probes if probe is not None]
+            if not probes:
+                return None
+            size, spacing, dtype = probes[0]
+            info['shape'] = (len(probes), size[1], size[0])
+            info['spacing'] = tuple(spacing[:2]) + (spacing[2] if len(spacing) > 2 else 1.0,)
+            info['dtype'] = dtype.name
+
+        elif extension == '.mrc':
+            import mrcfile
+            with mrcfile.open(path_to_data, permissive=True, header_only=True) as mrc:
+                h = mrc.header
+                info['shape'] = (int(h.nz), int(h.ny), int(h.nx))
+                info['dtype'] = mrcfile.utils.data_dtype_from_header(h).name
+                info['spacing'] = tuple(float(v) for v in mrc.voxel_size.tolist())
+            info['format'] = '.tif'
+
+        elif extension in ['.tif', '.tiff']:
+            from tifffile import TiffFile
+            with TiffFile(path_to_data) as tif:
+                series = tif.series[0]
+                info['shape'], info['dtype'] = tuple(series.shape), series.dtype.name
+
+        else:
+            return None
+    except Exception as e:
+        print(e)
+        return None
+    info['shape'] = tuple(int(s) for s in info['shape'])
+    return info
+
 def _error_(bm, message):
     if bm.django_env:
         from biomedisa_features.django_env import create_error_object
@@ -401,7 +668,7 @@ def pre_processing(bm):
 
     # load data
     if bm.data is None:
-        bm.data, _ = load_data(bm.path_to_data, bm.process)
+        bm.data, _ = load_data(bm.path_to_data, bm.process, lazy=True)
 
     # error handling
     if bm.data is None:
@@ -469,7 +736,22 @@ def pre_processing(bm):
     bm.success = True
     return bm
 
-def save_data(path_to_final, final, header=None, final_image_type=None, compress=True):
+# default TIFF codec and level per output type, all readable by ImageJ
+# (packbits, zstd or lz4 are used only if passed as `compression`, packbits
+# runs end at every row and make label maps much larger than zlib)
+TIFF_CODECS = {
+    'labels': ('zlib', 6),
+    'uncertainty': ('zlib', 6),
+    'image': ('zlib', 6),
+    }
+
+def _tiff_codec(output_type, compression):
+    if compression is not None:
+        return compression, None
+    return TIFF_CODECS[output_type or 'image']
+
+def save_data(path_to_final, final, header=None, final_image_type=None, compress=True,
+              output_type=None, compression=None, tile=None, maxworkers=None, complevel=4, chunksizes=None):
     if final_image_type == None:
         final_image_type = os.path.splitext(path_to_final)[1]
         if final_image_type == '.gz':
@@ -482,7 +764,9 @@ def save_data(path_to_final, final, header=None, final_image_type=None, compress
         header = header[0]
         np_to_amira(path_to_final, final, header)
     elif final_image_type == '.nc':
-        np_to_nc(path_to_final, final, header)
+        np_to_nc(path_to_final, final, header, complevel=complevel if compress else 0, chunksizes=chunksizes)
+    elif final_image_type == '.hdf5':
+        np_to_h5(path_to_final, final, compress)
     elif final_image_type in ['.hdr', '.mhd', '.mha', '.nrrd', '.nii', '.nii.gz']:
         final = np.swapaxes(final, 0, 2)
         save(final, path_to_final, header)
@@ -497,7 +781,7 @@ def save_data(path_to_final, final, header=None, final_image_type=None, compress
             os.chmod(results_dir, 0o777)
         # save data as NC blocks
         if os.path.splitext(header[1][0])[1] == '.nc':
-            np_to_nc(results_dir, final, header)
+            np_to_nc(results_dir, final, header, complevel=complevel if compress else 0, chunksizes=chunksizes)
             file_names = header[1]
         # save data as PNG, TIF, DICOM slices
         else:
@@ -514,12 +798,29 @@ def save_data(path_to_final, final, header=None, final_image_type=None, compress
     else:
         imageSize = int(final.nbytes * 10e-7)
         bigtiff = True if imageSize > 2000 else False
+        codec, level = _tiff_codec(output_type, compression) if compress else (None, None)
+        maxworkers = maxworkers or os.cpu_count()
         try:
-            compress = 'zlib' if compress else None
-            imwrite(path_to_final, final, bigtiff=bigtiff, compression=compress)
-        except:
-            compress = 6 if compress else 0
-            imwrite(path_to_final, final, bigtiff=bigtiff, compress=compress)
+            kwargs = {'compressionargs':{'level':level}} if level is not None else {}
+            try:
+                imwrite(path_to_final, final, bigtiff=bigtiff, compression=codec,
+                    tile=tile, maxworkers=maxworkers, **kwargs)
+            except TypeError:
+                # tifffile < 2022.7 passes the level with the codec
+                codec = (codec, level) if level is not None else codec
+                imwrite(path_to_final, final, bigtiff=bigtiff, compression=codec,
+                    tile=tile, maxworkers=maxworkers)
+        except Exception as e:
+            if codec not in [None, 'zlib']:
+                print(f'Warning: {codec} compression not available ({e}). Falling back to zlib.')
+            try:
+                compress = 'zlib' if compress else None
+                imwrite(path_to_final, final, bigtiff=bigtiff, compression=compress,
+                    tile=tile, maxworkers=maxworkers)
+            except:
+                compress = 6 if compress else 0
+                imwrite(path_to_final, final, bigtiff=bigtiff, compress=compress,
+                    tile=tile, maxworkers=maxworkers)
 
 def color_to_gray(labelData):
     if len(labelData.shape) == 4 and labelData.shape[1] == 3:
@@ -571,6 +872,13 @@ def _get_platform(bm):
         except:
             pass
 
+    # parallel CPU random walks with Numba
+    if bm.platform == 'numba_CPU':
+        bm.available_devices = 1
+        print('Detected platform:', bm.platform)
+        print('Detected threads:', numba.get_num_threads())
+        return bm
+
     # import PyOpenCL
     try:
         import pyopencl as cl
@@ -618,9 +926,15 @@ def _get_platform(bm):
                 print('Detected devices:', my_devices)
                 return bm
 
-    # stop the process if no device is detected
+    # fall back to parallel CPU random walks
     if bm.platform is None:
-        bm.platform = 'OpenCL or CUDA'
+        bm.platform = 'numba_CPU'
+        bm.available_devices = 1
+        print('Detected platform:', bm.platform)
+        print('Detected threads:', numba.get_num_threads())
+        return bm
+
+    # stop the process if no device is detected
     print(f'Error: No {bm.platform} device found.')
     bm.success = False
     return bm
@@ -730,6 +1044,7 @@ def read_labeled_slices_allx_large(arr):
 def predict_blocksize(bm):
     zsh, ysh, xsh = bm.labelData.shape
     argmin_z, argmax_z, argmin_y, argmax_y, argmin_x, argmax_x = zsh, 0, ysh, 0, xsh, 0
+    # slice by slice, so lazy volumes are never read as a whole
     for k in range(zsh):
         y, x = np.nonzero(bm.labelData[k])
         if x.any():
@@ -817,18 +1132,19 @@ def sendToChild(comm, indices, indices_child, dest, data, Labels, nbrw, sorw, al
     comm.send(indices, dest=dest, tag=9)
     comm.send(indices_child, dest=dest, tag=10)
 
-def _split_indices(indices, ngpus):
-    ngpus = ngpus if ngpus < len(indices) else len(indices)
-    nindices = len(indices)
-    parts = []
-    for i in range(0, ngpus):
-        slice_idx = indices[i]
-        parts.append([slice_idx])
-    if ngpus < nindices:
-        for i in range(ngpus, nindices):
-            gid = i % ngpus
-            slice_idx = indices[i]
-            parts[gid].append(slice_idx)
+def _split_indices(indices, ngpus, weights=None):
+    # assign the heaviest slices first to the GPU with the least work (LPT),
+    # ties go to the GPU with the fewest slices so that no GPU is left empty
+    # as long as there are enough slices, remaining GPUs get empty parts
+    if weights is None:
+        weights = np.ones(len(indices))
+    parts = [[] for i in range(ngpus)]
+    loads = np.zeros(ngpus)
+    for i in sorted(range(len(indices)), key=lambda i: -weights[i]):
+        gid = min(range(ngpus), key=lambda g: (loads[g], len(parts[g])))
+        parts[gid].append(i)
+        loads[gid] += weights[i]
+    parts = [[indices[i] for i in sorted(part)] for part in parts]
     return parts
 
 def get_labels(pre_final, labels):
@@ -34,6 +34,7 @@ import biomedisa
 from biomedisa_features.biomedisa_helper import (_get_platform, smooth_img_3x3,
     pre_processing, _error_, read_labeled_slices, read_labeled_slices_allx,
     read_indices_allx, predict_blocksize)
+from biomedisa_features.lazy_volume import LazyVolume, PaddedVolume
 from multiprocessing import freeze_support
 import numpy as np
 import argparse
@@ -45,7 +46,7 @@ class Biomedisa(object):
 def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
     path_to_data=None, path_to_labels=None, denoise=False, uncertainty=False, platform=None,
     allaxis=False, ignore='none', only='all', smooth=0, no_compression=False, return_hits=False,
-    img_id=None, label_id=None, remote=False, queue=0):
+    adaptive=False, tolerance=0.001, pyramid=0, incremental=False, dry_run=False, img_id=None, label_id=None, remote=False, queue=0):
 
     freeze_support()
 
@@ -111,16 +112,20 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
                 if bm.success == False:
                     bm = _error_(bm, f'No {bm.platform} device found.')
 
-        # smooth, uncertainty and allx are not supported for opencl
-        if bm.success and bm.platform.split('_')[0] == 'opencl':
-            if bm.smooth:
-                bm.smooth = 0
-                print('Warning: Smoothing is not yet supported for opencl. Process starts without smoothing.')
-            if bm.uncertainty:
-                bm.uncertainty = False
-                print('Warning: Uncertainty is not yet supported for opencl. Process starts without uncertainty.')
-            if bm.allaxis:
-                bm = _error_(bm, 'Allx is not yet supported for opencl.')
+        # adaptive walks are not supported for allx
+        if bm.success and bm.allaxis and bm.adaptive:
+            bm.adaptive = False
+            print('Warning: Adaptive random walks are not yet supported for allx. Process starts with a fixed number of walks.')
+
+        # coarse-to-fine random walks are not supported for allx
+        if bm.success and bm.allaxis and bm.pyramid:
+            bm.pyramid = 0
+            print('Warning: Coarse-to-fine random walks are not yet supported for allx. Process starts at full resolution.')
+
+        # incremental interpolation requires the hits of each slice to be independent of the others
+        if bm.success and bm.incremental and (bm.allaxis or bm.adaptive or bm.pyramid):
+            bm.incremental = False
+            print('Warning: Incremental interpolation is not supported for allx, adaptive or coarse-to-fine random walks. Process starts without cache.')
 
         if not bm.success:
 
@@ -145,8 +150,14 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
                 bm.path_to_smooth = filename + '.smooth' + bm.final_image_type
                 bm.path_to_uq = filename + '.uncertainty.tif'
 
+            # memory-mapped volumes are converted and padded crop by crop when they are read
+            lazy = isinstance(bm.data, LazyVolume) and not bm.denoise
+            if lazy:
+                dtype = np.uint8 if bm.data.dtype in [np.uint8, np.int8] else np.float32
+                bm.data = PaddedVolume(bm.data, dtype, shift_int8=True)
+
             # data type
-            if bm.data.dtype == 'uint8':
+            if lazy or bm.data.dtype == 'uint8':
                 pass
             elif bm.data.dtype == 'int8':
                 bm.data = bm.data.astype(np.int16)
@@ -161,19 +172,20 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
 
             # denoise image data
             if bm.denoise:
-                bm.data = smooth_img_3x3(bm.data)
+                bm.data = smooth_img_3x3(np.asarray(bm.data))
 
             # image size
             bm.imageSize = int(bm.data.nbytes * 10e-7)
 
             # add boundaries
-            zsh, ysh, xsh = bm.data.shape
+            zsh, ysh, xsh = bm.labelData.shape
             tmp = np.zeros((1+zsh+1, 1+ysh+1, 1+xsh+1), dtype=bm.labelData.dtype)
             tmp[1:-1, 1:-1, 1:-1] = bm.labelData
             bm.labelData = tmp.copy(order='C')
-            tmp = np.zeros((1+zsh+1, 1+ysh+1, 1+xsh+1), dtype=bm.data.dtype)
-            tmp[1:-1, 1:-1, 1:-1] = bm.data
-            bm.data = tmp.copy(order='C')
+            if not lazy:
+                tmp = np.zeros((1+zsh+1, 1+ysh+1, 1+xsh+1), dtype=bm.data.dtype)
+                tmp[1:-1, 1:-1, 1:-1] = bm.data
+                bm.data = tmp.copy(order='C')
             bm.zsh, bm.ysh, bm.xsh = bm.data.shape
 
             # check if labeled slices are adjacent
@@ -208,15 +220,36 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
 
                 # When is domain decomposition faster?
                 bm = predict_blocksize(bm)
-                nbytes = (bm.argmax_z - bm.argmin_z) * (bm.argmax_y - bm.argmin_y) * (bm.argmax_x - bm.argmin_x) * 4
+
+                # query the available memory of all ranks and plan the interpolation
+                from biomedisa_features.random_walk.planner import available_memory, plan_interpolation, print_plan
+                comm.bcast(bm.platform, root=0)
+                memory = comm.gather(available_memory(bm.platform, rank), root=0)
+                bm.plan = plan_interpolation(bm, memory)
+                print_plan(bm.plan, memory)
+
+                # stop after planning
+                comm.bcast(bm.dry_run, root=0)
+                if bm.dry_run:
+                    return {'plan': bm.plan}
+
+                # walk at coarse scale and keep only seeds near the coarse label boundaries
+                if bm.pyramid > 1:
+                    from biomedisa_features.random_walk.pyramid import coarse_to_fine
+                    bm = coarse_to_fine(bm)
 
                 # small or large
-                if nbytes * bm.nol < 1e10 and nbytes < 2e9:
+                if bm.plan['small']:
 
                     # send "small" to childs
                     for dest in range(1, size):
                         comm.send(1, dest=dest, tag=1)
 
+                    # cached hits are kept per image, independent of the crop
+                    if bm.incremental:
+                        from biomedisa_features.random_walk.incremental import cache_path
+                        bm.path_to_cache = cache_path(bm.data, bm.nbrw, bm.sorw)
+
                     # reduce blocksize
                     bm.data = np.copy(bm.data[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x], order='C')
                     bm.labelData = np.copy(bm.labelData[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x], order='C')
@@ -259,9 +292,19 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
                     for dest in range(1, size):
                         comm.send(0, dest=dest, tag=1)
 
-                    # number of ngpus
-                    ngpus = min((bm.argmax_z - bm.argmin_z) // 100, size)
-                    ngpus = max(ngpus, 1)
+                    # adaptive walks are only supported for small volumes
+                    if bm.adaptive:
+                        bm.adaptive = False
+                        print('Warning: Adaptive random walks are not yet supported for large volumes. Process starts with a fixed number of walks.')
+
+                    # incremental interpolation is only supported for small volumes
+                    if bm.incremental:
+                        bm.incremental = False
+                        print('Warning: Incremental interpolation is not yet supported for large volumes. Process starts without cache.')
+
+                    # number of ngpus and subdomains
+                    ngpus = bm.plan['ngpus']
+                    bm.subdomains = bm.plan['subdomains']
 
                     # send number of GPUs to childs
                     for dest in range(1, size):
@@ -282,6 +325,15 @@ def smart_interpolation(data, labelData, nbrw=10, sorw=4000,
 
         if executable:
 
+            # report the available memory
+            from biomedisa_features.random_walk.planner import available_memory
+            platform = comm.bcast(None, root=0)
+            comm.gather(available_memory(platform, rank), root=0)
+
+            # stop after planning
+            if comm.bcast(None, root=0):
+                return
+
             # get small or large
             small = comm.recv(source=0, tag=1)
 
@@ -335,9 +387,19 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--smooth', nargs='?', type=int, const=100, default=0,
                         help='Number of smoothing iterations for segmentation result')
     parser.add_argument('-p', '--platform', default=None,
-                        help='One of "cuda", "opencl_NVIDIA_GPU", "opencl_Intel_CPU"')
+                        help='One of "cuda", "opencl_NVIDIA_GPU", "opencl_Intel_CPU", "numba_CPU"')
     parser.add_argument('-rh','--return_hits', action='store_true', default=False,
                         help='Return hits from each label')
+    parser.add_argument('-ad','--adaptive', action='store_true', default=False,
+                        help='Run random walks in rounds and stop once the segmentation converges')
+    parser.add_argument('-tol','--tolerance', type=float, default=0.001,
+                        help='Fraction of changed voxels between two rounds below which adaptive random walks stop')
+    parser.add_argument('-py','--pyramid', nargs='?', type=int, const=2, default=0,
+                        help='Downsampling factor of a coarse random walk. Full resolution walks only start near coarse label boundaries')
+    parser.add_argument('-inc','--incremental', action='store_true', default=False,
+                        help='Cache the hits of each labeled slice and only walk from new or changed slices when rerunning')
+    parser.add_argument('-dr','--dry_run', action='store_true', default=False,
+                        help='Print the estimated memory usage and the chosen interpolation path without running it')
     parser.add_argument('-iid','--img_id', type=str, default=None,
                         help='Image ID within django environment/browser version')
     parser.add_argument('-lid','--label_id', type=str, default=None,
@@ -113,7 +113,7 @@ def create_slices(path_to_data, path_to_label, on_site=False):
                 path_to_dir, extension = os.path.splitext(path_to_dir)
             if extension == '.tar':
                 img_names = []
-                for data_type in ['.tif','.tiff','.am','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz']:
+                for data_type in ['.tif','.tiff','.am','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz','.hdf5']:
                     tmp_img_names = glob(path_to_dir+'/**/*'+data_type, recursive=True)
                     tmp_img_names = sorted(tmp_img_names)
                     img_names.extend(tmp_img_names)
@@ -164,7 +164,7 @@ def create_slices(path_to_data, path_to_label, on_site=False):
                     path_to_dir, extension = os.path.splitext(path_to_dir)
                 if extension == '.tar':
                     img_names = []
-                    for data_type in ['.tif','.tiff','.am','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz']:
+                    for data_type in ['.tif','.tiff','.am','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz','.hdf5']:
                         tmp_img_names = glob(path_to_dir+'/**/*'+data_type, recursive=True)
                         tmp_img_names = sorted(tmp_img_names)
                         img_names.extend(tmp_img_names)
@@ -0,0 +1,176 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import zlib
+import os
+
+# chunk edge length and maximum number of pyramid levels
+CHUNK = 64
+LEVELS = 4
+
+def _pad(block, chunks):
+    # direct chunk writes require full chunks
+    if block.shape == tuple(chunks):
+        return block
+    tmp = np.zeros(chunks, dtype=block.dtype)
+    tmp[:block.shape[0], :block.shape[1], :block.shape[2]] = block
+    return tmp
+
+def _chunk_offsets(shape, chunks):
+    for z in range(0, shape[0], chunks[0]):
+        for y in range(0, shape[1], chunks[1]):
+            for x in range(0, shape[2], chunks[2]):
+                yield (z, y, x)
+
+def _write_level(hf, name, arr, compress):
+    chunks = tuple(min(CHUNK, s) for s in arr.shape)
+    if not compress:
+        dset = hf.create_dataset(name, data=arr, chunks=chunks)
+        return
+    dset = hf.create_dataset(name, shape=arr.shape, dtype=arr.dtype,
+        chunks=chunks, compression='gzip', compression_opts=4)
+
+    # zlib releases the GIL, so chunks are compressed in parallel
+    def compress_chunk(offset):
+        z, y, x = offset
+        block = arr[z:z+chunks[0], y:y+chunks[1], x:x+chunks[2]]
+        block = np.ascontiguousarray(_pad(block, chunks))
+        return offset, zlib.compress(block.tobytes(), 4)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for offset, raw in pool.map(compress_chunk, _chunk_offsets(arr.shape, chunks)):
+            dset.id.write_direct_chunk(offset, raw)
+
+def np_to_h5(path_to_data, arr, compress=True):
+    """Save a volume as chunked HDF5 with a multiscale pyramid
+
+    Level k is stored as dataset ``scale<k>`` and subsampled by 2**k.
+    """
+    import h5py
+    with h5py.File(path_to_data, 'w') as hf:
+        hf.attrs['biomedisa_volume'] = True
+        for k in range(LEVELS):
+            level = arr[::2**k, ::2**k, ::2**k]
+            if k > 0 and min(level.shape) < CHUNK:
+                break
+            _write_level(hf, f'scale{k}', np.ascontiguousarray(level), compress)
+            hf.attrs['levels'] = k + 1
+
+class ChunkedArray(object):
+    """Read-only view of an HDF5 volume
+
+    Cropping reads and decompresses only the chunks it touches, using a
+    pool of threads.
+    """
+    def __init__(self, path_to_data, level=0):
+        import h5py
+        self.path = path_to_data
+        self._file = h5py.File(path_to_data, 'r')
+        self._dset = self._file[f'scale{level}']
+        self.shape = self._dset.shape
+        self.dtype = self._dset.dtype
+        self.ndim = self._dset.ndim
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._chunks = self._dset.chunks
+        # chunks compressed with plain deflate can be decoded without h5py
+        self._direct = self._dset.compression == 'gzip' and not self._dset.shuffle \
+            and not self._dset.fletcher32 and self._dset.scaleoffset is None
+
+    def close(self):
+        self._file.close()
+
+    def __del__(self):
+        try:
+            self._file.close()
+        except Exception:
+            pass
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def _read_chunk(self, offset):
+        z, y, x = offset
+        chunks = self._chunks
+        if self._direct:
+            try:
+                filter_mask, raw = self._dset.id.read_direct_chunk(offset)
+                if filter_mask == 0:
+                    block = np.frombuffer(zlib.decompress(raw), dtype=self.dtype).reshape(chunks)
+                    return offset, block
+            except Exception:
+                # chunk was never written
+                pass
+        block = self._dset[z:z+chunks[0], y:y+chunks[1], x:x+chunks[2]]
+        return offset, block
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3 or not all(isinstance(k, (slice, int, np.integer)) for k in key):
+            return self._dset[key]
+        key = key + (slice(None),) * (3 - len(key))
+
+        # region of interest
+        bounds, squeeze = [], []
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[axis])
+                if step != 1:
+                    return self._dset[key]
+                bounds.append((start, max(start, stop)))
+            else:
+                k = int(k) + self.shape[axis] if k < 0 else int(k)
+                bounds.append((k, k+1))
+                squeeze.append(axis)
+        out = np.empty([b[1]-b[0] for b in bounds], dtype=self.dtype)
+        if out.size == 0:
+            return np.squeeze(out, axis=tuple(squeeze))
+
+        # chunks overlapping the region
+        chunks = self._chunks
+        ranges = [range(b[0] - b[0] % c, b[1], c) for b, c in zip(bounds, chunks)]
+        offsets = [(z, y, x) for z in ranges[0] for y in ranges[1] for x in ranges[2]]
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for offset, block in pool.map(self._read_chunk, offsets):
+                src, dst = [], []
+                for axis in range(3):
+                    lo = max(bounds[axis][0], offset[axis])
+                    hi = min(bounds[axis][1], offset[axis] + chunks[axis])
+                    src.append(slice(lo - offset[axis], hi - offset[axis]))
+                    dst.append(slice(lo - bounds[axis][0], hi - bounds[axis][0]))
+                out[tuple(dst)] = block[tuple(src)]
+        return np.squeeze(out, axis=tuple(squeeze))
+
+def h5_to_np(path_to_data, level=0):
+    volume = ChunkedArray(path_to_data, level)
+    data = volume[:]
+    volume.close()
+    return data
@@ -372,7 +372,7 @@ def load_training_data(normalize, img_list, label_list, channels, x_scale, y_sca
                         tar.close()
                     label_name = label_dir
 
-                for data_type in ['.am','.tif','.tiff','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz']:
+                for data_type in ['.am','.tif','.tiff','.hdr','.mhd','.mha','.nrrd','.nii','.nii.gz','.hdf5']:
                     tmp_img_names = glob(img_name+'/**/*'+data_type, recursive=True)
                     tmp_label_names = glob(label_name+'/**/*'+data_type, recursive=True)
                     tmp_img_names = sorted(tmp_img_names)
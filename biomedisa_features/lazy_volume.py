@@ -0,0 +1,264 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+import os
+import numpy as np
+
+# element types of MetaImage (.mhd) headers
+MET_TYPES = {'MET_CHAR':np.int8, 'MET_UCHAR':np.uint8, 'MET_SHORT':np.int16,
+    'MET_USHORT':np.uint16, 'MET_INT':np.int32, 'MET_UINT':np.uint32,
+    'MET_LONG':np.int64, 'MET_ULONG':np.uint64, 'MET_FLOAT':np.float32,
+    'MET_DOUBLE':np.float64}
+
+class LazyVolume(object):
+    """Read-only volume backed by a memory map
+
+    Exposes ``shape``, ``dtype`` and cropping via ``__getitem__`` without
+    reading the whole file. Crops are returned as regular C-ordered arrays.
+    """
+    def __init__(self, path, array):
+        self.path = path
+        self._array = array
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def nbytes(self):
+        return self._array.nbytes
+
+    def __len__(self):
+        return self._array.shape[0]
+
+    def __getitem__(self, key):
+        return np.array(self._array[key], order='C')
+
+    def __array__(self, dtype=None):
+        return np.array(self._array, dtype=dtype, order='C')
+
+    def astype(self, dtype):
+        return np.array(self._array, dtype=dtype, order='C')
+
+    def __repr__(self):
+        return 'LazyVolume(%s, shape=%s, dtype=%s)' %(self.path, self.shape, self.dtype)
+
+class PaddedVolume(object):
+    """Lazy volume with a border of zeros whose crops are converted on access
+
+    Integer and float volumes are scaled to [0, 255] by their global range,
+    which is computed slice by slice. With ``shift_int8`` signed bytes are
+    shifted by 128 instead. Only crops are ever read from the file.
+    """
+    def __init__(self, volume, dtype, pad=1, shift_int8=False):
+        self.volume = volume
+        self.pad = pad
+        self._dtype = np.dtype(dtype)
+        self._shift = shift_int8 and volume.dtype == np.int8 and self._dtype == np.uint8
+        self._range = None
+        if volume.dtype != self._dtype and not self._shift:
+            lo, hi = np.inf, -np.inf
+            for k in range(volume.shape[0]):
+                slc = volume[k]
+                lo = min(lo, float(np.amin(slc)))
+                hi = max(hi, float(np.amax(slc)))
+            self._range = (lo, hi)
+
+    @property
+    def shape(self):
+        return tuple(n + 2 * self.pad for n in self.volume.shape)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self._dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _convert(self, block):
+        if self._range is None and not self._shift:
+            return block
+        if self._shift:
+            return (block.astype(np.int16) + 128).astype(np.uint8)
+        # same arithmetic as for volumes in memory
+        block = block.astype(np.float64 if self._dtype == np.float32 else np.float32)
+        block -= self._range[0]
+        block /= self._range[1] - self._range[0]
+        block *= 255.0
+        return block.astype(self._dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        bounds, squeeze = [], []
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[axis])
+                if step != 1:
+                    raise IndexError('crops of lazy volumes must be contiguous')
+            else:
+                start = int(k) + self.shape[axis] if int(k) < 0 else int(k)
+                stop = start + 1
+                squeeze.append(axis)
+            bounds.append((start, max(start, stop)))
+        crop = np.zeros(tuple(b - a for a, b in bounds), dtype=self._dtype)
+        src, dst = [], []
+        for (a, b), n in zip(bounds, self.volume.shape):
+            lo, hi = max(a - self.pad, 0), min(b - self.pad, n)
+            if hi <= lo:
+                return np.squeeze(crop, axis=tuple(squeeze))
+            src.append(slice(lo, hi))
+            dst.append(slice(lo + self.pad - a, hi + self.pad - a))
+        crop[tuple(dst)] = self._convert(np.asarray(self.volume[tuple(src)]))
+        return np.squeeze(crop, axis=tuple(squeeze))
+
+    def __array__(self, dtype=None):
+        crop = self[:, :, :]
+        return crop if dtype is None else crop.astype(dtype)
+
+    def astype(self, dtype):
+        return self[:, :, :].astype(dtype)
+
+    def __repr__(self):
+        return 'PaddedVolume(%s, shape=%s, dtype=%s)' %(self.volume, self.shape, self.dtype)
+
+def _memmap_tif(path):
+    from tifffile import memmap
+    # raises for compressed or non-contiguous files
+    array = memmap(path, mode='r')
+    return array, None
+
+def _parse_mhd(path):
+    fields = {}
+    with open(path, 'r', errors='ignore') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                fields[key.strip()] = value.strip()
+            if line.startswith('ElementDataFile'):
+                break
+    return fields
+
+def _memmap_mhd(path):
+    fields = _parse_mhd(path)
+    if fields.get('CompressedData', 'False').lower() == 'true':
+        raise ValueError('compressed MetaImage')
+    shape = tuple(int(x) for x in fields['DimSize'].split())[::-1]
+    if len(shape) != 3 or int(fields.get('ElementNumberOfChannels', 1)) != 1:
+        raise ValueError('MetaImage is not a scalar volume')
+    dtype = np.dtype(MET_TYPES[fields['ElementType']])
+    msb = fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False'))
+    dtype = dtype.newbyteorder('>' if msb.lower() == 'true' else '<')
+    data_file = fields['ElementDataFile']
+    if data_file == 'LOCAL':
+        data_file = path
+        size = int(np.prod(shape)) * dtype.itemsize
+        offset = os.path.getsize(path) - size
+    else:
+        if len(data_file.split()) > 1 or '%' in data_file:
+            raise ValueError('MetaImage data is split into several files')
+        data_file = os.path.join(os.path.dirname(path), data_file)
+        offset = int(fields.get('HeaderSize', 0))
+        if offset == -1:
+            offset = os.path.getsize(data_file) - int(np.prod(shape)) * dtype.itemsize
+    array = np.memmap(data_file, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return array, _medpy_header(path)
+
+def _memmap_nii(path):
+    import nibabel as nib
+    hdr = nib.load(path).header
+    slope, inter = hdr.get_slope_inter()
+    if slope not in [None, 1] or inter not in [None, 0]:
+        raise ValueError('NIfTI intensities are scaled')
+    shape = hdr.get_data_shape()
+    if len(shape) != 3:
+        raise ValueError('NIfTI is not a scalar volume')
+    # voxels are stored x fastest, i.e. z,y,x in C order
+    array = np.memmap(path, dtype=hdr.get_data_dtype(), mode='r',
+        offset=int(hdr['vox_offset']), shape=shape[::-1])
+    return array, _medpy_header(path)
+
+def _medpy_header(path):
+    # header as returned by medpy.io.load without reading the voxels
+    import SimpleITK as sitk
+    from medpy.io import Header
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    ndim = reader.GetDimension()
+    # medpy cannot infer ndim from the direction argument
+    header = Header(spacing=reader.GetSpacing(), offset=reader.GetOrigin())
+    header.direction = np.asarray(reader.GetDirection()).reshape(ndim, ndim)
+    # medpy copies the meta data from a SimpleITK image when saving
+    keys = reader.GetMetaDataKeys()
+    if keys:
+        header.sitkimage = sitk.Image([1] * ndim, sitk.sitkUInt8)
+        for key in keys:
+            header.sitkimage.SetMetaData(key, reader.GetMetaData(key))
+    return header
+
+def lazy_load(path, extension):
+    """Memory-map uncompressed TIFF, MetaImage and NIfTI volumes or open
+    chunked HDF5 volumes for chunk-level access
+
+    Returns (LazyVolume, header) or None if the file cannot be mapped.
+    """
+    try:
+        if extension in ['.tif', '.tiff']:
+            array, header = _memmap_tif(path)
+        elif extension == '.mhd':
+            array, header = _memmap_mhd(path)
+        elif extension == '.nii':
+            array, header = _memmap_nii(path)
+        elif extension == '.hdf5':
+            from biomedisa_features.hdf5_volume import ChunkedArray
+            array, header = ChunkedArray(path), None
+        else:
+            return None
+    except Exception:
+        return None
+    if array.ndim != 3:
+        return None
+    return LazyVolume(path, array), header
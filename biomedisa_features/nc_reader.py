@@ -26,11 +26,28 @@
 ##                                                                      ##
 ##########################################################################
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import collections
+import itertools
+import errno
 import os
 import glob
+import shutil
+import tempfile
 import numpy as np
 
-def save_nc_block(path_to_dst, arr, path_to_src, offset):
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _variable_shape(path_to_src):
+    # shape of the volume from the header only
+    import netCDF4
+    with netCDF4.Dataset(path_to_src, 'r') as src:
+        for name in ['labels', 'segmented', 'tomo']:
+            if name in src.variables.keys():
+                return src.variables[name].shape
+
+def save_nc_block(path_to_dst, arr, path_to_src, offset, complevel=4, chunksizes=None):
     try:
         import netCDF4
     except:
@@ -45,16 +62,23 @@ def save_nc_block(path_to_dst, arr, path_to_src, offset):
                     name, (len(dimension) if not dimension.isunlimited() else None))
             # copy all file data
             for name, variable in src.variables.items():
-                if name in ['labels','segmented']:
-                    srcarr = src[name][:]
-                    zsh, ysh, xsh = srcarr.shape
-                    x = dst.createVariable(name, variable.datatype, variable.dimensions, compression='zlib')
-                    dst[name][:] = arr[offset:offset+zsh]
-                elif name == 'tomo':
-                    srcarr = src[name][:]
-                    zsh, ysh, xsh = srcarr.shape
-                    x = dst.createVariable(name, variable.datatype, variable.dimensions)
-                    dst[name][:] = arr[offset:offset+zsh]
+                if name in ['labels','segmented','tomo']:
+                    zsh, ysh, xsh = variable.shape
+                    chunks = None
+                    if chunksizes:
+                        chunks = [min(c, s) for c, s in zip(chunksizes, variable.shape)]
+                    if name == 'tomo' or not complevel:
+                        x = dst.createVariable(name, variable.datatype, variable.dimensions, chunksizes=chunks)
+                    else:
+                        x = dst.createVariable(name, variable.datatype, variable.dimensions,
+                            compression='zlib', complevel=complevel, chunksizes=chunks)
+                    block = arr[max(0, offset):max(0, offset+zsh)]
+                    if block.shape[0] != zsh:
+                        # slices of partially read blocks beyond the volume stay zero
+                        tmp = np.zeros((zsh, ysh, xsh), dtype=block.dtype)
+                        tmp[max(0, -offset):max(0, -offset)+block.shape[0]] = block
+                        block = tmp
+                    dst[name][:] = block
                 else:
                     x = dst.createVariable(name, variable.datatype, variable.dimensions)
                     dst[name][:] = src[name][:]
@@ -62,7 +86,17 @@ def save_nc_block(path_to_dst, arr, path_to_src, offset):
                 dst[name].setncatts(src[name].__dict__)
     return offset+zsh
 
-def np_to_nc(results_dir, labeled_array, header=None, reference_dir=None, reference_file=None, start=0, stop=None):
+def np_to_nc(results_dir, labeled_array, header=None, reference_dir=None, reference_file=None, start=0, stop=None,
+             complevel=4, chunksizes=None, processes=None):
+    """Save a volume as NetCDF file or blocks following the reference blocks
+
+    Blocks are written concurrently by a pool of ``processes``. They are
+    spawned rather than forked, which is safe within MPI and CUDA
+    processes, and share the volume through a memory-mapped file on
+    tmpfs. ``complevel`` is the zlib level of labels (0 disables
+    compression) and ``chunksizes`` the (z,y,x) chunk shape of the
+    volume variable.
+    """
     try:
         import netCDF4
     except:
@@ -91,89 +125,220 @@ def np_to_nc(results_dir, labeled_array, header=None, reference_dir=None, refere
     if not stop:
         stop = len(ref_files)-1
 
-    # save volume by volume
-    offset = 0
-    for path_to_src in ref_files[start:stop+1]:
-        if is_file:
-            path_to_dst = results_dir
-        else:
-            path_to_dst = results_dir + '/' + os.path.basename(path_to_src)
-        offset = save_nc_block(path_to_dst, labeled_array, path_to_src, offset)
+    # offsets of the blocks from their headers, a volume read by slices
+    # may start within its first block
+    ref_files = ref_files[start:stop+1]
+    first = header[3] if header and len(header) > 3 else 0
+    offsets = np.cumsum([0] + [_variable_shape(path)[0] for path in ref_files]) - first
+
+    if is_file or processes == 1:
+        for i, path_to_src in enumerate(ref_files):
+            path_to_dst = results_dir if is_file else results_dir + '/' + os.path.basename(path_to_src)
+            save_nc_block(path_to_dst, labeled_array, path_to_src, offsets[i], complevel, chunksizes)
+        return
 
-def nc_to_np(base_dir, start=0, stop=None, show_keys=False):
+    # share the volume through a memory-mapped file instead of pickling blocks
+    tmp_dir = _tmpfs_dir()
+    try:
+        path_to_npy = tmp_dir + '/volume.npy'
+        shared = np.lib.format.open_memmap(path_to_npy, mode='w+',
+            dtype=labeled_array.dtype, shape=labeled_array.shape)
+        shared[:] = labeled_array
+        shared.flush()
+        del shared
+
+        # save blocks concurrently in fresh processes, every process gets its own block
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = []
+            for i, path_to_src in enumerate(ref_files):
+                path_to_dst = results_dir + '/' + os.path.basename(path_to_src)
+                futures.append(pool.submit(_save_nc_block_mapped, path_to_dst, path_to_npy, path_to_src, offsets[i], complevel, chunksizes))
+            for future in futures:
+                future.result()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _save_nc_block_mapped(path_to_dst, path_to_npy, path_to_src, offset, complevel, chunksizes):
+    arr = np.load(path_to_npy, mmap_mode='r')
+    return save_nc_block(path_to_dst, arr, path_to_src, offset, complevel, chunksizes)
+
+def _tmpfs_dir():
+    # decompress into memory-backed storage if available
+    base = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+    return tempfile.mkdtemp(prefix='nc_', dir=base)
+
+def _disk_dir():
+    # fallback for blocks that do not fit into tmpfs
+    os.makedirs(BASE_DIR + '/tmp', exist_ok=True)
+    return tempfile.mkdtemp(prefix='nc_', dir=BASE_DIR + '/tmp')
+
+def _decompress(filepath, tmp_dirs):
+    import bz2
+    for i, tmp_dir in enumerate(tmp_dirs):
+        newfilepath = os.path.join(tmp_dir, os.path.basename(filepath)[:-4])
+        try:
+            with bz2.open(filepath, 'rb') as src, open(newfilepath, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 16777216)
+            return newfilepath
+        except OSError as e:
+            if os.path.exists(newfilepath):
+                os.remove(newfilepath)
+            # retry on disk if tmpfs is full
+            if e.errno != errno.ENOSPC or i == len(tmp_dirs)-1:
+                raise
+
+def _window(path, most):
+    # decompressed blocks wait on tmpfs, which shares the free memory with the output
+    size = max(1, os.path.getsize(path))
+    free = shutil.disk_usage(os.path.dirname(path)).free
+    try:
+        free = min(free, os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (ValueError, AttributeError, OSError):
+        pass
+    return max(1, min(most, int(free // (2 * size))))
+
+def _blocks(files, tmp_dirs, window=None):
+    # yield the readable path of every block in order, compressed blocks are
+    # decompressed ahead of the reader as far as the CPUs and the free memory allow
+    window = window or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=window) as pool:
+        submit = lambda filepath: pool.submit(_decompress, filepath, tmp_dirs) if '.bz2' in filepath else None
+        files = iter(files)
+        pending = collections.deque()
+        # one block at a time until the size of a decompressed block is known
+        limit = [1]
+        def refill():
+            for filepath in itertools.islice(files, max(0, limit[0] - len(pending))):
+                pending.append((filepath, submit(filepath)))
+        try:
+            refill()
+            while pending:
+                filepath, future = pending.popleft()
+                path = future.result() if future else filepath
+                if path != filepath:
+                    limit[0] = _window(path, window)
+                refill()
+                yield filepath, path
+        finally:
+            # the reader stopped early
+            for filepath, future in pending:
+                if future:
+                    future.cancel()
+
+def _variable_name(f):
+    name = None
+    for n in ['labels', 'segmented', 'tomo']:
+        if n in f.variables.keys():
+            name = n
+    return name
+
+def nc_to_np(base_dir, start=0, stop=None, show_keys=False, unit='block'):
+    """Read a NetCDF file or a directory of NetCDF blocks
+
+    ``start``/``stop`` select blocks (``stop`` inclusive) or, with
+    ``unit='slice'``, the z-range ``[start, stop)`` across blocks.
+    Compressed blocks are decompressed in parallel into a temporary
+    directory on tmpfs (on disk if tmpfs is full), at most one per CPU
+    ahead of the reader and only as many as fit twice into the free
+    memory. Every block is read into its offset of the output as soon
+    as it is available and removed right after. The header records the
+    slices of the first block before the output for ``np_to_nc``.
+    """
     try:
         import netCDF4
     except:
         raise Exception("netCDF4 not found. please use `pip install netCDF4`")
 
     if os.path.isfile(base_dir):
-        # decompress bz2 files
-        if '.bz2' in base_dir:
-            import bz2
-            zipfile = bz2.BZ2File(base_dir) # open the file
-            data = zipfile.read() # get the decompressed data
-            newfilepath = base_dir[:-4] # assuming the filepath ends with .bz2
-            open(newfilepath, 'wb').write(data)
-            f = netCDF4.Dataset(newfilepath,'r')
-        else:
-            f = netCDF4.Dataset(base_dir,'r')
-        if show_keys:
-            print(f.variables.keys())
-        for n in ['labels', 'segmented', 'tomo']:
-            if n in f.variables.keys():
-                name = n
-        output = f.variables[name]
-        output = np.copy(output)
-        # remove tmp file
-        if '.bz2' in base_dir:
-            os.remove(newfilepath)
-        header = [name, [base_dir], output.dtype]
-
+        files = [base_dir]
     elif os.path.isdir(base_dir):
-        # read volume by volume
         files = glob.glob(base_dir+'/**/*.nc', recursive=True)
         files += glob.glob(base_dir+'/**/*.bz2', recursive=True)
         files.sort()
 
-        # check for compression
-        if os.path.splitext(files[0])[1]=='.bz2':
-            import bz2
-
+    if unit == 'block' and os.path.isdir(base_dir):
         if not stop:
             stop = len(files)-1
+        files = files[start:stop+1]
 
-        for i,filepath in enumerate(files[start:stop+1]):
+    # requested range of slices
+    zmin, zmax = 0, None
+    if unit == 'slice':
+        zmin, zmax = max(0, start), stop
 
-            # decompress bz2 files
-            if '.bz2' in filepath:
-                zipfile = bz2.BZ2File(filepath) # open the file
-                data = zipfile.read() # get the decompressed data
-                newfilepath = filepath[:-4] # assuming the filepath ends with .bz2
-                open(newfilepath, 'wb').write(data)
-                f = netCDF4.Dataset(newfilepath,'r')
-            else:
-                f = netCDF4.Dataset(filepath,'r')
+    tmp_dirs = [_tmpfs_dir(), _disk_dir()]
+    try:
+        output, selected, offset, first = None, [], 0, 0
+        for filepath, path in _blocks(files, tmp_dirs):
+            with netCDF4.Dataset(path, 'r') as f:
+                if show_keys:
+                    print(f.variables.keys())
+                name = _variable_name(f)
+                variable = f.variables[name]
+                variable.set_auto_mask(False)
+                zsh, ysh, xsh = variable.shape
 
-            if show_keys:
-                print(f.variables.keys())
-            for n in ['labels', 'segmented', 'tomo']:
-                if n in f.variables.keys():
-                    name = n
+                # blocks usually share their size, the estimate is corrected when they do not
+                if output is None:
+                    size = zsh * len(files) if zmax is None else min(zsh * len(files), zmax)
+                    output = np.empty((max(0, size-zmin), ysh, xsh), dtype=variable[:0].dtype)
 
-            a = f.variables[name]
-            a = np.copy(a)
+                # read block into its offset
+                lo, hi = max(zmin, offset), offset+zsh
+                if zmax is not None:
+                    hi = min(zmax, hi)
+                if lo < hi:
+                    if not selected:
+                        first = lo - offset
+                    if hi-zmin > output.shape[0]:
+                        output.resize((hi-zmin, ysh, xsh), refcheck=False)
+                    output[lo-zmin:hi-zmin] = variable[lo-offset:hi-offset]
+                    selected.append(filepath)
+                offset += zsh
 
             # remove tmp file
-            if '.bz2' in filepath:
-                os.remove(newfilepath)
+            if path != filepath:
+                os.remove(path)
 
-            # append output array
-            if i==0:
-                output = a
-            else:
-                output = np.append(output, a, axis=0)
+            # stop decompressing blocks beyond the requested slices
+            if zmax is not None and offset >= zmax:
+                break
+    finally:
+        for tmp_dir in tmp_dirs:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        header = [name, files[start:stop+1], a.dtype]
+    # release the unused part of the estimate
+    size = max(0, min(offset, zmax if zmax is not None else offset) - zmin)
+    if size != output.shape[0]:
+        output.resize((size, ysh, xsh), refcheck=False)
 
+    # slices of the first block before the output, required to write the blocks back
+    header = [name, selected, output.dtype, first]
     return output, header
 
+def nc_probe(base_dir):
+    """Shape and data type of a NetCDF file or directory from the headers"""
+    import netCDF4
+    if os.path.isfile(base_dir):
+        files = [base_dir]
+    else:
+        files = glob.glob(base_dir+'/**/*.nc', recursive=True)
+        files += glob.glob(base_dir+'/**/*.bz2', recursive=True)
+        files.sort()
+    tmp_dirs = [_tmpfs_dir(), _disk_dir()]
+    try:
+        zsh = 0
+        # headers of compressed blocks are only available after decompression
+        for filepath, path in _blocks(files, tmp_dirs):
+            with netCDF4.Dataset(path, 'r') as f:
+                variable = f.variables[_variable_name(f)]
+                variable.set_auto_mask(False)
+                shape = variable.shape
+                dtype = variable[:0].dtype
+            if path != filepath:
+                os.remove(path)
+            zsh += shape[0]
+    finally:
+        for tmp_dir in tmp_dirs:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return (zsh,) + tuple(shape[1:]), dtype
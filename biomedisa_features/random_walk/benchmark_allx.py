@@ -0,0 +1,110 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+from biomedisa_features.biomedisa_helper import read_labeled_slices_allx
+import numpy as np
+import argparse
+import time
+
+def _synthetic(size, spacing):
+    # noisy sphere labeled on every n-th slice of each axis
+    z, y, x = np.mgrid[:size, :size, :size] - size // 2
+    sphere = (x**2 + y**2 + z**2 < (size // 3)**2).astype(np.uint8)
+    data = 100 * sphere + np.random.normal(0, 20, sphere.shape)
+    data = np.clip(data, 0, 255).astype(np.uint8)
+    labelData = np.zeros_like(sphere)
+    labelData[::spacing] = sphere[::spacing]
+    labelData[:, ::spacing] = sphere[:, ::spacing]
+    labelData[:, :, ::spacing] = sphere[:, :, ::spacing]
+    return data, labelData
+
+def _labeled_slices(labelData):
+    indices, labels = [], []
+    tmp = labelData
+    for ax in range(3):
+        indices_tmp, labels_tmp = read_labeled_slices_allx(tmp, ax)
+        indices.extend(indices_tmp)
+        labels.append(labels_tmp)
+        tmp = np.ascontiguousarray(np.swapaxes(tmp, 0, 1) if ax == 0 else np.swapaxes(tmp, 0, 2))
+    return indices, labels
+
+def _run(walk, data, labels, indices, nbrw, sorw, name, ctx=None, queue=None):
+    slices = [np.copy(l) for l in labels]
+    tic = time.time()
+    walkmap = walk(data, slices, indices, indices, nbrw, sorw, name, ctx, queue)
+    return walkmap, time.time() - tic
+
+if __name__ == '__main__':
+
+    # initialize arguments
+    parser = argparse.ArgumentParser(description='Throughput of all-axes random walks on the host and on CUDA.',
+             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help='edge length of the synthetic volume')
+    parser.add_argument('-sp', '--spacing', type=int, default=16,
+                        help='distance between labeled slices')
+    parser.add_argument('-nbrw', '--nbrw', type=int, default=10,
+                        help='number of random walks starting at each pre-segmented pixel')
+    parser.add_argument('-sorw', '--sorw', type=int, default=4000,
+                        help='steps of a random walk')
+    args = parser.parse_args()
+
+    data, labelData = _synthetic(args.size, args.spacing)
+    indices, labels = _labeled_slices(labelData)
+    seeds = sum(l.size for l in labels)
+    steps = float(seeds) * args.nbrw * args.sorw
+
+    # host engine (numba_CPU and OpenCL nodes), warm up the jit first
+    from biomedisa_features.random_walk.numba_small_allx import walk
+    warmup_data, warmup_labelData = _synthetic(16, 4)
+    warmup_indices, warmup_labels = _labeled_slices(warmup_labelData)
+    _run(walk, warmup_data, warmup_labels, warmup_indices, 1, 1, 'warmup')
+    walkmap_cpu, t_cpu = _run(walk, data, labels, indices, args.nbrw, args.sorw, 'numba')
+    print('Host: %.2f s, %.3e steps/s' %(t_cpu, steps / t_cpu))
+
+    # cuda engine on the same data
+    try:
+        import pycuda.driver as cuda
+        from biomedisa_features.random_walk.pycuda_small_allx import walk
+    except ImportError:
+        print('Warning: PyCUDA not found. CUDA benchmark skipped.')
+    else:
+        cuda.init()
+        ctx = cuda.Device(0).make_context()
+        try:
+            walkmap_gpu, t_gpu = _run(walk, data, labels, indices, args.nbrw, args.sorw, 'cuda')
+        finally:
+            ctx.pop()
+        print('CUDA: %.2f s, %.3e steps/s' %(t_gpu, steps / t_gpu))
+        print('Speedup CUDA/host: %.2f' %(t_cpu / t_gpu))
+        agreement = np.mean(np.argmax(walkmap_cpu, axis=0) == np.argmax(walkmap_gpu, axis=0))
+        print('Label agreement: %.4f' %(agreement))
@@ -0,0 +1,108 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+import numba
+import numpy as np
+
+@numba.jit(nopython=True, parallel=True)
+def curvature_cpu(phi, curvature):
+    zsh, ysh, xsh = phi.shape
+    eps = 0.0000000001
+    for k in numba.prange(1, zsh-1):
+        for l in range(1, ysh-1):
+            for m in range(1, xsh-1):
+                dx  = (phi[k,l,m-1] - phi[k,l,m+1]) / 2.0
+                dxx = (phi[k,l,m-1] - 2*phi[k,l,m] + phi[k,l,m+1])
+                dx2 = dx * dx
+
+                dy  = (phi[k,l-1,m] - phi[k,l+1,m]) / 2.0
+                dyy = (phi[k,l-1,m] - 2*phi[k,l,m] + phi[k,l+1,m])
+                dy2 = dy * dy
+
+                dz  = (phi[k-1,l,m] - phi[k+1,l,m]) / 2.0
+                dzz = (phi[k-1,l,m] - 2*phi[k,l,m] + phi[k+1,l,m])
+                dz2 = dz * dz
+
+                dxy = (phi[k,l-1,m-1] + phi[k,l+1,m+1] - phi[k,l-1,m+1] - phi[k,l+1,m-1]) / 4.0
+                dxz = (phi[k+1,l,m-1] + phi[k-1,l,m+1] - phi[k+1,l,m+1] - phi[k-1,l,m-1]) / 4.0
+                dyz = (phi[k+1,l-1,m] + phi[k-1,l+1,m] - phi[k+1,l+1,m] - phi[k-1,l-1,m]) / 4.0
+
+                curvature[k,l,m] = (dxx*(dy2+dz2)+dyy*(dx2+dz2)+dzz*(dx2+dy2)-2*dx*dy*dxy-2*dx*dz*dxz-2*dy*dz*dyz) / (dx2+dy2+dz2+eps)
+    return curvature
+
+@numba.jit(nopython=True, parallel=True)
+def update_cpu(phi, curvature):
+    zsh, ysh, xsh = phi.shape
+    for k in numba.prange(1, zsh-1):
+        for l in range(1, ysh-1):
+            for m in range(1, xsh-1):
+                phi[k,l,m] += 0.01 * curvature[k,l,m]
+    return phi
+
+def smooth_cpu(phi, iterations):
+    # smooth the hits of one label by mean curvature flow
+    phi = np.array(phi, dtype=np.float32)
+    curvature = np.zeros_like(phi)
+    for k in range(iterations):
+        curvature_cpu(phi, curvature)
+        update_cpu(phi, curvature)
+    return phi
+
+@numba.jit(nopython=True, parallel=True)
+def max_to_uncertainty(max_hits, a):
+    # keep the three largest numbers of hits of each voxel
+    zsh, ysh, xsh = a.shape
+    for k in numba.prange(zsh):
+        for l in range(ysh):
+            for m in range(xsh):
+                tmp = a[k,l,m]
+                if tmp > max_hits[2,k,l,m]:
+                    max_hits[0,k,l,m] = max_hits[1,k,l,m]
+                    max_hits[1,k,l,m] = max_hits[2,k,l,m]
+                    max_hits[2,k,l,m] = tmp
+                elif tmp > max_hits[1,k,l,m]:
+                    max_hits[0,k,l,m] = max_hits[1,k,l,m]
+                    max_hits[1,k,l,m] = tmp
+                elif tmp > max_hits[0,k,l,m]:
+                    max_hits[0,k,l,m] = tmp
+    return max_hits
+
+@numba.jit(nopython=True, parallel=True)
+def compute_uncertainty(max_hits):
+    _, zsh, ysh, xsh = max_hits.shape
+    uq = np.zeros((zsh, ysh, xsh), dtype=np.float32)
+    for k in numba.prange(zsh):
+        for l in range(ysh):
+            for m in range(xsh):
+                max2 = max_hits[2,k,l,m]
+                if max2 == 0:
+                    max2 = 1
+                tmp = max_hits[0,k,l,m] / max2
+                tmp1 = max_hits[1,k,l,m] / max2
+                uq[k,l,m] = 1 - (1 - tmp) * (1 - tmp1)
+    return uq
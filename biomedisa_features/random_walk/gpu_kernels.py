@@ -26,7 +26,7 @@
 ##                                                                      ##
 ##########################################################################
 
-from pycuda.compiler import SourceModule
+from biomedisa_features.random_walk.kernel_cache import cuda_module
 
 def _build_kernel_fill():
     code = """
@@ -47,7 +47,7 @@ def _build_kernel_fill():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -74,7 +74,7 @@ def _build_kernel_uncertainty():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -111,7 +111,7 @@ def _build_kernel_max():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -134,7 +134,7 @@ def _build_update_gpu():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -178,6 +178,6 @@ def _build_curvature_gpu():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
@@ -0,0 +1,143 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from mpi4py import MPI
+import numpy as np
+
+def _default_codec():
+    # optional compression of ghost regions: 0 none, 1 lz4, 2 zstd
+    try:
+        import lz4.frame
+        return 1
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return 2
+    except ImportError:
+        return 0
+
+def _compress(codec, buf):
+    if codec == 1:
+        import lz4.frame
+        return np.frombuffer(lz4.frame.compress(buf), dtype=np.uint8)
+    elif codec == 2:
+        import zstandard
+        return np.frombuffer(zstandard.ZstdCompressor(level=1).compress(buf), dtype=np.uint8)
+    return np.frombuffer(buf, dtype=np.uint8)
+
+def _decompress(codec, buf):
+    if codec == 1:
+        import lz4.frame
+        return lz4.frame.decompress(buf)
+    elif codec == 2:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(buf)
+    return buf
+
+def _bounding_box(a):
+    # bounding box of the nonzero entries
+    box = []
+    for axis in range(3):
+        nonzero = np.flatnonzero(np.any(a, axis=tuple(k for k in range(3) if k != axis)))
+        if nonzero.size == 0:
+            return [0, 0, 0, 0, 0, 0]
+        box.extend([nonzero[0], nonzero[-1] + 1])
+    return box
+
+def _isend(comm, ghost, dest, tag, codec, requests, buffers):
+    # header: codec, number of bytes, bounding box, thickness of the ghost region
+    z0, z1, y0, y1, x0, x1 = _bounding_box(ghost)
+    payload = np.empty(0, dtype=np.uint8)
+    if z1 > z0:
+        payload = _compress(codec, np.ascontiguousarray(ghost[z0:z1, y0:y1, x0:x1]).tobytes())
+    header = np.array([codec, payload.size, z0, z1, y0, y1, x0, x1, ghost.shape[0]], dtype=np.int64)
+    requests.append(comm.Isend([header, MPI.INT64_T], dest=dest, tag=tag))
+    if payload.size:
+        requests.append(comm.Isend([payload, MPI.BYTE], dest=dest, tag=tag+1))
+    buffers.extend([header, payload])
+
+def sendrecv(a, blockmin, blockmax, comm, rank, size, update=None, codec=None):
+    # ghost regions are exchanged with both neighbours at the same time. Only their
+    # nonzero bounding box is sent. If given, update(lo, hi) is called for the slices
+    # not touched by the exchange while the payload is in flight and afterwards for the rest
+    codec = _default_codec() if codec is None else codec
+    neighbours = [source for source in (rank-1, rank+1) if 0 <= source < size]
+
+    # receive headers, tag 30 comes from below and tag 32 from above
+    headers, requests = {}, []
+    for source in neighbours:
+        headers[source] = np.empty(9, dtype=np.int64)
+        tag = 30 if source < rank else 32
+        requests.append(comm.Irecv([headers[source], MPI.INT64_T], source=source, tag=tag))
+
+    # send ghost regions
+    send_requests, buffers = [], []
+    if rank+1 < size:
+        _isend(comm, a[blockmax:], rank+1, 30, codec, send_requests, buffers)
+    if rank > 0:
+        _isend(comm, a[:blockmin], rank-1, 32, codec, send_requests, buffers)
+    MPI.Request.Waitall(requests)
+
+    # receive payloads
+    payloads, requests = {}, []
+    lo, hi = blockmin, blockmax
+    for source in neighbours:
+        _, nbytes, z0, z1, _, _, _, _, thickness = headers[source]
+        if nbytes:
+            payloads[source] = np.empty(nbytes, dtype=np.uint8)
+            tag = 31 if source < rank else 33
+            requests.append(comm.Irecv([payloads[source], MPI.BYTE], source=source, tag=tag))
+            if source < rank:
+                lo = max(lo, blockmin + z1)
+            else:
+                hi = min(hi, blockmax - thickness + z0)
+    if lo >= hi:
+        lo, hi = blockmin, blockmin
+
+    # process the interior while waiting
+    if update is not None and hi > lo:
+        update(lo, hi)
+    MPI.Request.Waitall(requests)
+
+    # add ghost regions of neighbours
+    for source, payload in payloads.items():
+        source_codec, _, z0, z1, y0, y1, x0, x1, thickness = headers[source]
+        recv = np.frombuffer(_decompress(source_codec, payload.tobytes()), dtype=a.dtype)
+        recv = recv.reshape(z1-z0, y1-y0, x1-x0)
+        offset = blockmin if source < rank else blockmax - thickness
+        a[offset+z0:offset+z1, y0:y1, x0:x1] += recv
+    MPI.Request.Waitall(send_requests)
+
+    # process the remaining slices
+    if update is not None:
+        if lo > blockmin:
+            update(blockmin, lo)
+        if blockmax > hi:
+            update(hi, blockmax)
+    return a
@@ -0,0 +1,107 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+try:
+    from biomedisa_app.config import config
+except:
+    from biomedisa_app.config_example import config
+from biomedisa.settings import BASE_DIR
+from biomedisa_features.volume_cache import evict
+import numpy as np
+import hashlib
+import os
+
+def cache_path(data, nbrw, sorw):
+    # the hits depend on the whole image and the walk parameters, not on the crop
+    digest = hashlib.sha256()
+    for k in range(data.shape[0]):
+        digest.update(np.ascontiguousarray(data[k]))
+    name = '%s_%s_%s_%s' %(digest.hexdigest()[:32], '_'.join(map(str, data.shape)), nbrw, sorw)
+    path = BASE_DIR + '/tmp/rw_cache/' + name
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    # most recently used, remove the least recently used images beyond the disk budget (GB)
+    os.utime(path)
+    budget = int(float(config.get('RW_CACHE_SIZE', 10)) * 1024**3)
+    evict(budget, keep=name, cache_dir=BASE_DIR + '/tmp/rw_cache')
+    return path
+
+def slice_files(path, indices, labels, box):
+    # each labeled slice is identified by its absolute position and the absolute
+    # coordinates of its labels, so slices stay valid when the crop changes
+    files = []
+    for k, slc in zip(indices, labels):
+        y, x = np.nonzero(slc)
+        digest = hashlib.sha256()
+        digest.update((y + box[2]).astype(np.int64))
+        digest.update((x + box[4]).astype(np.int64))
+        digest.update(np.ascontiguousarray(slc[y, x], dtype=np.int32))
+        files.append(path + '/slice_%s_%s.npz' %(k + box[0], digest.hexdigest()[:32]))
+    return files
+
+def walk_slices(walk, data, labels, indices, todo, nbrw, sorw, name, ctx, queue, files, box):
+    # walk from each slice separately and save its touched voxels within the crop
+    allLabels = np.unique(labels)
+    allLabels = allLabels[allLabels >= 0]
+    for k in todo:
+        contributions = {'box': np.array(box, dtype=np.int64)}
+        def accumulate(l, hits):
+            index = np.flatnonzero(hits)
+            if index.size:
+                contributions['index_%s' %(allLabels[l])] = index
+                contributions['values_%s' %(allLabels[l])] = hits.reshape(-1)[index].astype(np.float32)
+        # the absolute slice position selects the random number streams,
+        # adding or removing other slices does not change them
+        walk(data, labels, indices, [k], nbrw, sorw, name, ctx, queue, accumulate, seed=k + box[0])
+        path_to_slice = files[indices.index(k)]
+        np.savez(path_to_slice + '.tmp.npz', **contributions)
+        os.replace(path_to_slice + '.tmp.npz', path_to_slice)
+
+def _recrop(index, values, src, dst):
+    # move hits cached within another crop into the current crop
+    src_shape = (src[1]-src[0], src[3]-src[2], src[5]-src[4])
+    dst_shape = (dst[1]-dst[0], dst[3]-dst[2], dst[5]-dst[4])
+    z, y, x = np.unravel_index(index, src_shape)
+    z, y, x = z + (src[0]-dst[0]), y + (src[2]-dst[2]), x + (src[4]-dst[4])
+    inside = (z >= 0) & (z < dst_shape[0]) & (y >= 0) & (y < dst_shape[1]) & (x >= 0) & (x < dst_shape[2])
+    return np.ravel_multi_index((z[inside], y[inside], x[inside]), dst_shape), values[inside]
+
+def load_hits(files, label, box):
+    # sum the hits of one label over all labeled slices
+    shape = (box[1]-box[0], box[3]-box[2], box[5]-box[4])
+    hits = np.zeros(np.prod(shape), dtype=np.float32)
+    for path_to_slice in files:
+        with np.load(path_to_slice) as contributions:
+            if 'index_%s' %(label) in contributions:
+                index = contributions['index_%s' %(label)]
+                values = contributions['values_%s' %(label)]
+                src = tuple(int(b) for b in contributions['box'])
+                if src != tuple(box):
+                    index, values = _recrop(index, values, src, box)
+                hits[index] += values
+    return hits.reshape(shape)
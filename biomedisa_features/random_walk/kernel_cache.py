@@ -0,0 +1,76 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from biomedisa.settings import BASE_DIR
+import hashlib
+import os
+
+def _cache_file(key, ending):
+    path = BASE_DIR + '/tmp/kernel_cache'
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    return path + '/' + hashlib.sha256(key.encode()).hexdigest()[:32] + ending
+
+def _write_cache(path_to_cache, data):
+    # write to a temporary file first as other ranks may read at the same time
+    tmp = '%s.%s.tmp' %(path_to_cache, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path_to_cache)
+
+def cuda_module(code):
+    # pycuda caches compiled cubins by source, architecture and nvcc version and options,
+    # only the directory is moved next to the other kernel caches
+    from pycuda.compiler import SourceModule
+    path = BASE_DIR + '/tmp/kernel_cache/cuda'
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    return SourceModule(code, cache_dir=path)
+
+def opencl_program(ctx, src):
+    # compiled binaries are cached as raw bytes, one file per device, by source,
+    # device and driver version (never unpickled as the cache directory is shared)
+    import pyopencl as cl
+    devices = ctx.devices
+    paths = [_cache_file('%s %s %s %s' %(src, dev.platform.version, dev.name, dev.driver_version), '.clbin')
+             for dev in devices]
+    if all(os.path.exists(path_to_cache) for path_to_cache in paths):
+        binaries = []
+        for path_to_cache in paths:
+            with open(path_to_cache, 'rb') as f:
+                binaries.append(f.read())
+        try:
+            return cl.Program(ctx, devices, binaries).build()
+        except cl.Error:
+            print('Warning: Cached OpenCL kernel could not be loaded. Kernel is compiled again.')
+    prg = cl.Program(ctx, src).build()
+    # binaries are listed in the order of the program's devices
+    binaries = dict(zip(prg.get_info(cl.program_info.DEVICES), prg.get_info(cl.program_info.BINARIES)))
+    for dev, path_to_cache in zip(devices, paths):
+        _write_cache(path_to_cache, bytes(binaries[dev]))
+    return prg
@@ -0,0 +1,116 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+
+from mpi4py import MPI
+from biomedisa_features.random_walk.numba_small import _trace_buffers, _get_seeds, _random_walk
+from biomedisa_features.random_walk.walk_helper import reduceBlocksize, max_to_label
+from biomedisa_features.random_walk.halo import sendrecv
+from biomedisa_features.random_walk.cpu_kernels import max_to_uncertainty, compute_uncertainty, smooth_cpu
+import numpy as np
+
+def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax,
+         name, allLabels, smooth, uncertainty, ctx, queue, platform, subdomains=False):
+
+    # subdomains are not required on the host
+    subdomains = False
+
+    # get rank and size of mpi process
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # image size
+    raw = raw.astype(np.float32)
+    zsh, ysh, xsh = raw.shape
+
+    # crop to region of interest
+    slices = slices.astype(np.int32)
+    slices = reduceBlocksize(slices)
+    indices = np.array(indices, dtype=np.int32)
+
+    # allocate host memory
+    hits = np.empty(raw.shape, dtype=np.int32)
+    trace, count = _trace_buffers(raw.shape, sorw)
+    final = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
+
+    # smoothing and uncertainty are computed on the host
+    if smooth:
+        final_smooth = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
+    if uncertainty:
+        max_hits = np.zeros((3,)+raw.shape, dtype=np.float32)
+
+    # no device memory is involved
+    memory_error = False
+
+    for label_counter, segment in enumerate(allLabels):
+        print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
+
+        # compute random walks
+        hits.fill(0)
+        if np.any(indices):
+            seeds = _get_seeds(slices, indices, np.int32(segment), zsh)
+            _random_walk(raw, slices, indices, seeds, hits, trace, count, np.int32(segment), np.int32(sorw), np.int32(nbrw))
+        hits_sum = np.copy(hits)
+
+        # communicate hits and get the label with the most hits,
+        # the interior of the block is processed during communication
+        if label_counter == 0:
+            if size > 1:
+                hits_sum = sendrecv(hits_sum, blockmin, blockmax, comm, rank, size)
+            walkmap = np.copy(hits_sum)
+        else:
+            def update(lo, hi):
+                max_to_label(hits_sum, walkmap, final[lo-blockmin:], lo, hi, segment)
+            if size > 1:
+                sendrecv(hits_sum, blockmin, blockmax, comm, rank, size, update)
+            else:
+                update(blockmin, blockmax)
+
+        # save the three most occuring hits
+        if uncertainty:
+            max_to_uncertainty(max_hits, hits_sum)
+
+        # smooth manifold
+        if smooth:
+            hits_smooth = smooth_cpu(hits_sum, smooth)
+            if label_counter == 0:
+                hits_smooth[hits_smooth<0] = 0
+                walkmap_smooth = np.copy(hits_smooth)
+            else:
+                walkmap_smooth, final_smooth = max_to_label(hits_smooth, walkmap_smooth, final_smooth, blockmin, blockmax, segment)
+
+    # compute uncertainty
+    if uncertainty:
+        final_uncertainty = compute_uncertainty(max_hits)[blockmin:blockmax]
+    else:
+        final_uncertainty = None
+
+    if not smooth:
+        final_smooth = None
+
+    return memory_error, final, final_uncertainty, final_smooth
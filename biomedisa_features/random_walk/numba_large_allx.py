@@ -0,0 +1,102 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from biomedisa_features.random_walk.numba_small_allx import calc_beta, walk_allx
+from biomedisa_features.random_walk.walk_helper import reduceBlocksize_allx as reduceBlocksize, max_to_label
+from biomedisa_features.random_walk.halo import sendrecv
+from biomedisa_features.random_walk.cpu_kernels import max_to_uncertainty, compute_uncertainty, smooth_cpu
+import numpy as np
+
+def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
+         allLabels, smooth, uncertainty, ctx, queue, platform, subdomains=False):
+
+    # subdomains are not required on the host
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    raw = raw.astype(np.float32)
+    zsh, ysh, xsh = raw.shape
+
+    foundAxis = [0] * 3
+    beta = [None] * 3
+    for k in range(3):
+        if indices[k]:
+            foundAxis[k] = 1
+            indices[k] = np.array(indices[k], dtype=np.int32)
+            slices[k] = reduceBlocksize(slices[k].astype(np.int32))
+            beta[k] = calc_beta(raw, slices[k], indices[k], allLabels, k)
+
+    # allocate host memory
+    hits = np.zeros(raw.shape, dtype=np.int32)
+    final = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
+    if smooth:
+        final_smooth = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
+    if uncertainty:
+        max_hits = np.zeros((3,)+raw.shape, dtype=np.float32)
+    memory_error = False
+
+    for label_counter, segment in enumerate(allLabels):
+        print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
+
+        # compute random walks
+        a = walk_allx(raw, slices, indices, beta, foundAxis, segment, sorw, nbrw, hits, adaptive=True)
+
+        # communicate hits
+        if size > 1:
+            a = sendrecv(a, blockmin, blockmax, comm, rank, size)
+
+        # save the three most occuring hits
+        if uncertainty:
+            max_to_uncertainty(max_hits, a)
+
+        # smooth manifold
+        if smooth:
+            a_smooth = smooth_cpu(a, smooth)
+            if label_counter == 0:
+                a_smooth[a_smooth<0] = 0
+                walkmap_smooth = np.copy(a_smooth)
+            else:
+                walkmap_smooth, final_smooth = max_to_label(a_smooth, walkmap_smooth, final_smooth, blockmin, blockmax, segment)
+
+        # get the label with the most hits
+        if label_counter == 0:
+            a[a<0] = 0
+            walkmap = np.copy(a)
+        else:
+            walkmap, final = max_to_label(a, walkmap, final, blockmin, blockmax, segment)
+
+    # compute uncertainty
+    if uncertainty:
+        final_uncertainty = compute_uncertainty(max_hits)[blockmin:blockmax]
+    else:
+        final_uncertainty = None
+
+    if not smooth:
+        final_smooth = None
+
+    return memory_error, final, final_uncertainty, final_smooth
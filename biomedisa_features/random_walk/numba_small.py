@@ -0,0 +1,251 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+
+from biomedisa_features.random_walk.walk_helper import walk_labels, _seed_offset
+import numpy as np
+import numba
+
+def walk(data, slices, indices, indices_child, nbrw, sorw, name, ctx, queue, accumulate=None, seed=0):
+    return walk_labels(_walk_on_current_cpu, data, slices, indices, indices_child, nbrw, sorw, name,
+                       accumulate=accumulate, seed=seed)
+
+def _trace_buffers(shape, sorw, limit=5e8):
+    # every thread records the voxels it visits in one bucket per z-slab as there
+    # are no atomics on the CPU, the buckets are reduced slab by slab into one hit buffer
+    nthreads = numba.get_num_threads()
+    nslabs = max(min(nthreads, shape[0]), 1)
+    length = max(2 * int(sorw), int(limit // (8 * nthreads * nslabs)))
+    trace = np.empty((nthreads, nslabs, length), dtype=np.int64)
+    count = np.zeros((nthreads, nslabs), dtype=np.int64)
+    return trace, count
+
+@numba.jit(nopython=True, parallel=True)
+def _flush(hits, trace, count):
+    # each slab is updated by exactly one thread
+    zsh, ysh, xsh = hits.shape
+    hits_flat = hits.reshape(-1)
+    nthreads, nslabs, _ = trace.shape
+    for slab in numba.prange(nslabs):
+        for t in range(nthreads):
+            for i in range(count[t, slab]):
+                hits_flat[trace[t, slab, i]] += 1
+            count[t, slab] = 0
+
+@numba.jit(nopython=True)
+def _has_room(count, t, sorw, length):
+    # a walk of sorw steps fits into any bucket of the thread
+    for slab in range(count.shape[1]):
+        if count[t, slab] + sorw > length:
+            return False
+    return True
+
+def _walk_on_current_cpu(raw, slices, allLabels, indices, nbrw, sorw, name, accumulate=None, seed=0):
+
+    raw = raw.astype(np.float32)
+    indices = np.array(indices, dtype=np.int32)
+    slices = np.array(slices, dtype=np.int32)
+    if accumulate is None:
+        walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
+    hits = np.zeros(raw.shape, dtype=np.int32)
+    trace, count = _trace_buffers(raw.shape, sorw)
+    seed = _seed_offset(seed, slices.shape[0] * raw.shape[1] * raw.shape[2])
+
+    for label_counter, segment in enumerate(allLabels):
+        print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
+        hits.fill(0)
+        seeds = _get_seeds(slices, indices, np.int32(segment), raw.shape[0])
+        _random_walk(raw, slices, indices, seeds, hits, trace, count, np.int32(segment), np.int32(sorw), np.int32(nbrw), seed)
+        if accumulate is None:
+            walkmap[label_counter] += hits
+        else:
+            accumulate(label_counter, hits.astype(np.float32))
+
+    if accumulate is None:
+        return walkmap
+
+@numba.jit(nopython=True)
+def _get_seeds(slices, indices, segment, zsh):
+    slshape, ysh, xsh = slices.shape
+    n = 0
+    for slc in range(slshape):
+        plane = indices[slc]
+        if 0 < plane < zsh-1:
+            for row in range(1, ysh-1):
+                for column in range(1, xsh-1):
+                    if slices[slc, row, column] == segment:
+                        n += 1
+    seeds = np.empty((n, 2), dtype=np.int64)
+    n = 0
+    for slc in range(slshape):
+        plane = indices[slc]
+        if 0 < plane < zsh-1:
+            for row in range(1, ysh-1):
+                for column in range(1, xsh-1):
+                    if slices[slc, row, column] == segment:
+                        seeds[n, 0] = slc
+                        seeds[n, 1] = row * xsh + column
+                        n += 1
+    return seeds
+
+@numba.jit(nopython=True)
+def _calc_var(raw, slices, slc, plane, row, column, B, segment):
+    dev = 0.0
+    summe = 0.0
+    for n in range(-1, 2):
+        for o in range(-1, 2):
+            if slices[slc, row+n, column+o] == segment:
+                tmp = B - raw[plane, row+n, column+o]
+                dev += tmp * tmp
+                summe += 1
+    var = dev / summe
+    if var < 1.0:
+        var = 1.0
+    return var
+
+@numba.jit(nopython=True)
+def _weight(B, A, div1):
+    tmp = B - A
+    return np.exp(- tmp * tmp * div1)
+
+@numba.jit(nopython=True, parallel=True)
+def _random_walk(raw, slices, indices, seeds, hits, trace, count, segment, sorw, nbrw, seed=0):
+
+    zsh, ysh, xsh = raw.shape
+    flat = ysh * xsh
+    nthreads, nslabs, length = trace.shape
+    nseeds = seeds.shape[0]
+
+    # MRG32k3a
+    norm = 2.328306549295728e-10
+    m1 = 4294967087.0
+    m2 = 4294944443.0
+    a12 = 1403580.0
+    a13n = 810728.0
+    a21 = 527612.0
+    a23n = 1370589.0
+
+    # every thread walks every nthreads-th seed and pauses when its buckets are full
+    cursor = np.arange(nthreads)
+    walks = np.zeros(nthreads, dtype=np.int64)
+    state = np.zeros((nthreads, 6))
+
+    done = nseeds == 0
+    while not done:
+        for t in numba.prange(nthreads):
+            while cursor[t] < nseeds and _has_room(count, t, sorw, length):
+
+                s = cursor[t]
+                slc = seeds[s, 0]
+                plane = indices[slc]
+                row = seeds[s, 1] // xsh
+                column = seeds[s, 1] % xsh
+
+                # initialize MRG32k3a with the same seed as the GPU kernels
+                if walks[t] == 0:
+                    index = float(slc * flat + row * xsh + column + seed)
+                    for i in range(6):
+                        state[t, i] = index
+                s10, s11, s12 = state[t, 0], state[t, 1], state[t, 2]
+                s20, s21, s22 = state[t, 3], state[t, 4], state[t, 5]
+
+                # compute standard deviation
+                B = raw[plane, row, column]
+                var = _calc_var(raw, slices, slc, plane, row, column, B, segment)
+                div1 = 1 / (2 * var)
+
+                # compute one random walk
+                k, l, m = plane, row, column
+                for step in range(sorw):
+
+                    # compute weights
+                    W0 = _weight(B, raw[k+1, l, m], div1)
+                    W1 = W0 + _weight(B, raw[k-1, l, m], div1)
+                    W2 = W1 + _weight(B, raw[k, l+1, m], div1)
+                    W3 = W2 + _weight(B, raw[k, l-1, m], div1)
+                    W4 = W3 + _weight(B, raw[k, l, m+1], div1)
+                    W5 = W4 + _weight(B, raw[k, l, m-1], div1)
+
+                    # component 1
+                    p1 = a12 * s11 - a13n * s10
+                    p1 -= int(p1 / m1) * m1
+                    if p1 < 0.0:
+                        p1 += m1
+                    s10, s11, s12 = s11, s12, p1
+
+                    # component 2
+                    p2 = a21 * s22 - a23n * s20
+                    p2 -= int(p2 / m2) * m2
+                    if p2 < 0.0:
+                        p2 += m2
+                    s20, s21, s22 = s21, s22, p2
+
+                    # combination
+                    if p1 <= p2:
+                        rand = W5 * ((p1 - p2 + m1) * norm)
+                    else:
+                        rand = W5 * ((p1 - p2) * norm)
+
+                    # determine new direction of random walk
+                    n, o, p = 0, 0, 0
+                    if rand < W0 or rand == 0:
+                        n = 1
+                    elif rand < W1:
+                        n = -1
+                    elif rand < W2:
+                        o = 1
+                    elif rand < W3:
+                        o = -1
+                    elif rand < W4:
+                        p = 1
+                    else:
+                        p = -1
+
+                    # move in new direction and record the hit in the bucket of its slab
+                    if 0 < k+n < zsh-1 and 0 < l+o < ysh-1 and 0 < m+p < xsh-1:
+                        k += n
+                        l += o
+                        m += p
+                        slab = k * nslabs // zsh
+                        trace[t, slab, count[t, slab]] = k * flat + l * xsh + m
+                        count[t, slab] += 1
+
+                # continue the random number stream with the next walk
+                state[t, 0], state[t, 1], state[t, 2] = s10, s11, s12
+                state[t, 3], state[t, 4], state[t, 5] = s20, s21, s22
+                walks[t] += 1
+                if walks[t] == nbrw:
+                    walks[t] = 0
+                    cursor[t] += nthreads
+
+        # reduce the buckets of all threads
+        _flush(hits, trace, count)
+        done = True
+        for t in range(nthreads):
+            if cursor[t] < nseeds:
+                done = False
@@ -0,0 +1,312 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from biomedisa_features.random_walk.numba_small import _trace_buffers, _flush, _has_room, _weight
+import numpy as np
+import numba
+
+def walk(data, slices, indices_all, indices_child, nbrw, sorw, name, ctx, queue):
+
+    labels = np.zeros(0)
+    for k in range(3):
+        labels = np.append(labels, np.unique(slices[k]))
+    labels = np.unique(labels)
+
+    slicesChunk, indicesChunk = [], []
+    labelsChunk = np.zeros(0)
+    foundAxis = [0] * 3
+    for k in range(3):
+        slices_tmp, indices_tmp = _extract_slices(slices[k], indices_all, indices_child, k)
+        if indices_tmp: foundAxis[k] = 1
+        slicesChunk.append(slices_tmp)
+        indicesChunk.append(indices_tmp)
+        labelsChunk = np.append(labelsChunk, np.unique(slices_tmp))
+    labelsChunk = np.unique(labelsChunk)
+
+    # remove negative labels from list
+    index = np.argwhere(labels<0)
+    labels = np.delete(labels, index)
+    index = np.argwhere(labelsChunk<0)
+    labelsChunk = np.delete(labelsChunk, index)
+
+    walkmapChunk = _walk_on_current_cpu(data, slicesChunk, labelsChunk, indicesChunk, nbrw, sorw, name, foundAxis)
+
+    if walkmapChunk.shape[0] != len(labels):
+        walkmap = np.zeros((len(labels),)+data.shape, dtype=np.float32)
+        chunk2Walkmap = np.nonzero(np.in1d(labels, labelsChunk))[0]
+        for chunkIndex, walkmapIndex in enumerate(chunk2Walkmap):
+            walkmap[walkmapIndex] += walkmapChunk[chunkIndex]
+    else:
+        walkmap = walkmapChunk
+
+    return walkmap
+
+def _extract_slices(slices, indices_all, indicesChunk, k):
+    indices = [x for (x, y) in indices_all if y == k]
+    indicesChunk = [x for (x, y) in indicesChunk if y == k]
+    extracted = np.zeros((0, slices.shape[1], slices.shape[2]), dtype=np.int32)
+    slicesIndicesToExtract = np.nonzero(np.in1d(indices, indicesChunk))[0]
+    for arraySliceIndex in slicesIndicesToExtract:
+        extracted = np.append(extracted, [slices[arraySliceIndex]], axis=0)
+    return extracted, indicesChunk
+
+def _calc_label_walking_area(sliceData, labelValue):
+    walkingArea = np.zeros_like(sliceData)
+    walkingArea[sliceData == labelValue] = 1
+    return walkingArea
+
+@numba.jit(nopython=True)
+def _calc_var(raw, A):
+    ysh, xsh = raw.shape
+    beta = np.zeros((ysh, xsh))
+    for l in range(1, ysh-1):
+        for m in range(1, xsh-1):
+            if A[l, m] == 1:
+                dev, summe = 0, 0
+                B = raw[l, m]
+                for n in range(-1, 2):
+                    for o in range(-1, 2):
+                        if A[l+n, m+o] == 1:
+                            dev += (B - raw[l+n, m+o])**2
+                            summe += 1
+                var = dev / summe
+                if var < 1.0:
+                    beta[l, m] = 1.0
+                else:
+                    beta[l, m] = var
+    return beta
+
+def calc_beta(raw, slices, indices, allLabels, axis):
+    # variance of the image data around each pre-segmented pixel
+    Beta = np.zeros(slices.shape, dtype=np.float32)
+    for m in range(slices.shape[0]):
+        for n in allLabels:
+            A = _calc_label_walking_area(slices[m], n)
+            plane = indices[m]
+            if axis==0: raw_tmp = raw[plane]
+            if axis==1: raw_tmp = raw[:,plane]
+            if axis==2: raw_tmp = raw[:,:,plane]
+            Beta[m] += _calc_var(raw_tmp.astype(float), A)
+    return Beta
+
+def _walk_on_current_cpu(raw, slices, allLabels, indices, nbrw, sorw, name, foundAxis):
+
+    walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
+    raw = raw.astype(np.float32)
+    hits = np.zeros(raw.shape, dtype=np.int32)
+
+    beta = [None] * 3
+    for k, found in enumerate(foundAxis):
+        if found:
+            indices[k] = np.array(indices[k], dtype=np.int32)
+            slices[k] = slices[k].astype(np.int32)
+            beta[k] = calc_beta(raw, slices[k], indices[k], allLabels, k)
+
+    for label_counter, segment in enumerate(allLabels):
+        print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
+        walkmap[label_counter] = walk_allx(raw, slices, indices, beta, foundAxis, segment, sorw, nbrw, hits)
+    return walkmap
+
+def walk_allx(raw, slices, indices, beta, foundAxis, segment, sorw, nbrw, hits, adaptive=False):
+    # hits of random walks starting from the labeled slices of all axes
+    hits.fill(0)
+    trace, count = _trace_buffers(raw.shape, sorw)
+    for k, found in enumerate(foundAxis):
+        if found:
+            seeds = _get_seeds(slices[k], indices[k], np.int32(segment), k, raw.shape, adaptive)
+            _random_walk(raw, seeds, beta[k].reshape(-1), hits, trace, count, np.int32(sorw), np.int32(nbrw))
+    return hits.astype(np.float32)
+
+@numba.jit(nopython=True)
+def _coordinates(axis, index, row_g, col_g):
+    # position in the volume of a pixel within a slice of the given axis
+    if axis == 0:
+        return index, row_g, col_g
+    elif axis == 1:
+        return row_g, index, col_g
+    else:
+        return row_g, col_g, index
+
+@numba.jit(nopython=True)
+def _is_seed(slices, slc, row_g, col_g, segment, adaptive):
+    if slices[slc, row_g, col_g] != segment:
+        return False
+    if not adaptive or (col_g + row_g) % 4 == 0:
+        return True
+    # only walk from pixels near another label
+    _, ysh_g, xsh_g = slices.shape
+    for y in range(max(1, row_g-100) - row_g, min(ysh_g-1, row_g+101) - row_g):
+        for x in range(max(1, col_g-100) - col_g, min(xsh_g-1, col_g+101) - col_g):
+            tmp = slices[slc, row_g+y, col_g+x]
+            if tmp != segment and tmp != -1:
+                return True
+    return False
+
+@numba.jit(nopython=True)
+def _get_seeds(slices, indices, segment, axis, shape, adaptive):
+    zsh, ysh, xsh = shape
+    slshape, ysh_g, xsh_g = slices.shape
+    flat_g = ysh_g * xsh_g
+    is_seed = np.zeros(slices.shape, dtype=np.uint8)
+    n = 0
+    for slc in range(slshape):
+        index = np.int64(indices[slc])
+        for row_g in range(ysh_g):
+            for col_g in range(xsh_g):
+                plane, row, column = _coordinates(axis, index, row_g, col_g)
+                if 0 < plane < zsh-1 and 0 < row < ysh-1 and 0 < column < xsh-1:
+                    if _is_seed(slices, slc, row_g, col_g, segment, adaptive):
+                        is_seed[slc, row_g, col_g] = 1
+                        n += 1
+    seeds = np.empty((n, 4), dtype=np.int64)
+    n = 0
+    for slc in range(slshape):
+        index = np.int64(indices[slc])
+        for row_g in range(ysh_g):
+            for col_g in range(xsh_g):
+                if is_seed[slc, row_g, col_g]:
+                    plane, row, column = _coordinates(axis, index, row_g, col_g)
+                    seeds[n, 0] = slc * flat_g + row_g * xsh_g + col_g
+                    seeds[n, 1] = plane
+                    seeds[n, 2] = row
+                    seeds[n, 3] = column
+                    n += 1
+    return seeds
+
+@numba.jit(nopython=True, parallel=True)
+def _random_walk(raw, seeds, beta, hits, trace, count, sorw, nbrw):
+
+    zsh, ysh, xsh = raw.shape
+    flat = ysh * xsh
+    nthreads, nslabs, length = trace.shape
+    nseeds = seeds.shape[0]
+
+    # MRG32k3a
+    norm = 2.328306549295728e-10
+    m1 = 4294967087.0
+    m2 = 4294944443.0
+    a12 = 1403580.0
+    a13n = 810728.0
+    a21 = 527612.0
+    a23n = 1370589.0
+
+    # every thread walks every nthreads-th seed and pauses when its buckets are full
+    cursor = np.arange(nthreads)
+    walks = np.zeros(nthreads, dtype=np.int64)
+    state = np.zeros((nthreads, 6))
+
+    done = nseeds == 0
+    while not done:
+        for t in numba.prange(nthreads):
+            while cursor[t] < nseeds and _has_room(count, t, sorw, length):
+
+                s = cursor[t]
+                index = seeds[s, 0]
+                plane, row, column = seeds[s, 1], seeds[s, 2], seeds[s, 3]
+
+                # initialize MRG32k3a with the same seed as the GPU kernels
+                if walks[t] == 0:
+                    for i in range(6):
+                        state[t, i] = float(index)
+                s10, s11, s12 = state[t, 0], state[t, 1], state[t, 2]
+                s20, s21, s22 = state[t, 3], state[t, 4], state[t, 5]
+
+                # standard deviation
+                B = raw[plane, row, column]
+                div1 = 1 / (2 * beta[index])
+
+                # compute one random walk
+                k, l, m = plane, row, column
+                for step in range(sorw):
+
+                    # compute weights
+                    W0 = _weight(B, raw[k+1, l, m], div1)
+                    W1 = W0 + _weight(B, raw[k-1, l, m], div1)
+                    W2 = W1 + _weight(B, raw[k, l+1, m], div1)
+                    W3 = W2 + _weight(B, raw[k, l-1, m], div1)
+                    W4 = W3 + _weight(B, raw[k, l, m+1], div1)
+                    W5 = W4 + _weight(B, raw[k, l, m-1], div1)
+
+                    # component 1
+                    p1 = a12 * s11 - a13n * s10
+                    p1 -= int(p1 / m1) * m1
+                    if p1 < 0.0:
+                        p1 += m1
+                    s10, s11, s12 = s11, s12, p1
+
+                    # component 2
+                    p2 = a21 * s22 - a23n * s20
+                    p2 -= int(p2 / m2) * m2
+                    if p2 < 0.0:
+                        p2 += m2
+                    s20, s21, s22 = s21, s22, p2
+
+                    # combination
+                    if p1 <= p2:
+                        rand = W5 * ((p1 - p2 + m1) * norm)
+                    else:
+                        rand = W5 * ((p1 - p2) * norm)
+
+                    # determine new direction of random walk
+                    n, o, p = 0, 0, 0
+                    if rand < W0 or rand == 0:
+                        n = 1
+                    elif rand < W1:
+                        n = -1
+                    elif rand < W2:
+                        o = 1
+                    elif rand < W3:
+                        o = -1
+                    elif rand < W4:
+                        p = 1
+                    else:
+                        p = -1
+
+                    # move in new direction and record the hit in the bucket of its slab
+                    if 0 < k+n < zsh-1 and 0 < l+o < ysh-1 and 0 < m+p < xsh-1:
+                        k += n
+                        l += o
+                        m += p
+                        slab = k * nslabs // zsh
+                        trace[t, slab, count[t, slab]] = k * flat + l * xsh + m
+                        count[t, slab] += 1
+
+                # continue the random number stream with the next walk
+                state[t, 0], state[t, 1], state[t, 2] = s10, s11, s12
+                state[t, 3], state[t, 4], state[t, 5] = s20, s21, s22
+                walks[t] += 1
+                if walks[t] == nbrw:
+                    walks[t] = 0
+                    cursor[t] += nthreads
+
+        # reduce the buckets of all threads
+        _flush(hits, trace, count)
+        done = True
+        for t in range(nthreads):
+            if cursor[t] < nseeds:
+                done = False
@@ -0,0 +1,195 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+from biomedisa_features.biomedisa_helper import _get_device
+from biomedisa_features.random_walk.rw_large import _ghost_width
+from biomedisa_features.random_walk.rw_small import _batch_size
+import numpy as np
+import socket
+import os
+
+def _host_memory():
+    # available host memory in bytes or None if unknown
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+def available_memory(platform, rank):
+    # free host memory and free memory of the device used by this rank
+    host = _host_memory()
+    device = None
+    try:
+        if platform == 'cuda':
+            import pycuda.driver as cuda
+            cuda.init()
+            ctx = cuda.Device(rank % cuda.Device.count()).make_context()
+            device, _ = cuda.mem_get_info()
+            ctx.pop()
+            del ctx
+        elif platform == 'numba_CPU':
+            device = host
+        else:
+            # OpenCL does not report free memory
+            ctx, queue = _get_device(platform, rank)
+            device = queue.device.global_mem_size
+    except Exception as e:
+        print('Warning: Device memory of rank %s could not be queried.' %(rank))
+    return socket.gethostname(), host, device
+
+# upper bound of the trace buckets of the host walks (see numba_small._trace_buffers)
+TRACE_BYTES = 5e8
+
+def _streaming(bm):
+    # dense hits of all labels are only required for smoothing and returning hits
+    return not (bm.return_hits or bm.smooth or bm.allaxis or bm.adaptive)
+
+def _small_memory(bm, voxels, nslices, ngpus):
+    # peak memory of rw_small on the root and on a child
+    itemsize = 1 if bm.data.dtype == 'uint8' else 4
+    streaming = _streaming(bm)
+    labels = nslices * bm.labelData.shape[1] * bm.labelData.shape[2] * 4
+    device = voxels * (itemsize + 4) + labels
+    if bm.platform == 'numba_CPU' or (bm.allaxis and bm.platform != 'cuda'):
+        device += TRACE_BYTES
+    root_device = device
+    if bm.smooth:
+        root_device += 2 * voxels * 4
+    if bm.uncertainty and not streaming:
+        root_device += 4 * voxels * 4
+    if streaming:
+        child_host = voxels * 4
+        root_host = voxels * (1 + 4 + 4)
+        if bm.uncertainty:
+            root_host += 3 * voxels * 4
+        # labels reduced across ranks at once, root sums into a copy
+        if ngpus > 1:
+            batch = _batch_size(bm.nol, voxels) * voxels * 4
+            child_host += batch
+            root_host += 2 * batch
+    else:
+        child_host = bm.nol * voxels * 4
+        root_host = 2 * bm.nol * voxels * 4
+        if bm.smooth:
+            root_host += bm.nol * voxels * 4
+    root_host += bm.data.nbytes + bm.labelData.nbytes
+    child_host += voxels * itemsize + labels
+    return root_host, child_host, root_device, device
+
+def _large_memory(bm, ngpus):
+    # peak memory of rw_large on the root and on a child per block
+    itemsize = 1 if bm.data.dtype == 'uint8' else 4
+    zsh = bm.argmax_z - bm.argmin_z
+    flat = (bm.argmax_y - bm.argmin_y) * (bm.argmax_x - bm.argmin_x)
+    ghost = _ghost_width(bm.sorw, zsh, ngpus)
+    voxels = (zsh // ngpus + zsh % ngpus + 2 * ghost) * flat
+    device = voxels * (itemsize + 4)
+    if bm.smooth:
+        device += voxels * 4
+    if bm.uncertainty:
+        device += 3 * voxels * 4
+    if bm.platform == 'numba_CPU' or (bm.allaxis and bm.platform != 'cuda'):
+        device += TRACE_BYTES
+    # subdomains of 100 slices with ghost regions of 100 slices
+    subdomain = min(300 * flat, voxels) * (itemsize + 4) + voxels * 4
+    child_host = voxels * (itemsize + 4 + 4 + 1 + 4)
+    if bm.smooth:
+        child_host += voxels * (4 + 1)
+    root_host = child_host + bm.data.nbytes + bm.labelData.nbytes + zsh * flat * 3
+    return root_host, child_host, device, subdomain
+
+def _fits(memory, ngpus, root_host, child_host, root_device, device):
+    # sum the host memory of all ranks on the same node
+    hosts = {}
+    for rank in range(ngpus):
+        hostname, host, free = memory[rank]
+        if free is not None and (root_device if rank == 0 else device) > free:
+            return False
+        hosts.setdefault(hostname, [host, 0])
+        hosts[hostname][1] += root_host if rank == 0 else child_host
+    return all(host is None or need <= host for host, need in hosts.values())
+
+def plan_interpolation(bm, memory):
+    # choose between rw_small and rw_large, the number of GPUs and subdomains
+    size = len(memory)
+    plan = {}
+    zsh = bm.argmax_z - bm.argmin_z
+    voxels = zsh * (bm.argmax_y - bm.argmin_y) * (bm.argmax_x - bm.argmin_x)
+    nslices = np.count_nonzero(np.any(bm.labelData[bm.argmin_z:bm.argmax_z], axis=(1,2)))
+
+    # small volumes are limited by the index range of the kernels
+    ngpus = max(1, min(nslices, size))
+    root_host, child_host, root_device, device = _small_memory(bm, voxels, nslices, ngpus)
+    if any(host is not None or free is not None for _, host, free in memory):
+        plan['small'] = voxels * 4 < 2e9 and _fits(memory, ngpus, root_host, child_host, root_device, device)
+    else:
+        # without memory information fall back to fixed thresholds
+        plan['small'] = (_streaming(bm) or voxels * 4 * bm.nol < 1e10) and voxels * 4 < 2e9
+    plan['small_memory'] = (root_host, child_host, root_device, device)
+
+    if plan['small']:
+        plan['ngpus'] = ngpus
+        plan['subdomains'] = False
+    else:
+        plan.update(_large_plan(bm, memory, size, zsh))
+    return plan
+
+def _large_plan(bm, memory, size, zsh):
+    # each rank walks a block of at least 100 slices, fewer ranks only if memory requires it
+    most = max(1, min(size, zsh // 100))
+
+    # prefer the largest number of blocks that fits without subdomains, then with subdomains,
+    # more ranks shrink the blocks but add up in the host memory of a node
+    candidates = []
+    for ngpus in range(most, 0, -1):
+        root_host, child_host, device, subdomain = _large_memory(bm, ngpus)
+        if _fits(memory, ngpus, root_host, child_host, device, device):
+            return {'ngpus': ngpus, 'subdomains': False, 'large_memory': (root_host, child_host, device, subdomain)}
+        candidates.append((ngpus, root_host, child_host, device, subdomain))
+    for ngpus, root_host, child_host, device, subdomain in candidates:
+        if _fits(memory, ngpus, root_host, child_host, subdomain, subdomain):
+            return {'ngpus': ngpus, 'subdomains': True, 'large_memory': (root_host, child_host, device, subdomain)}
+    print('Warning: Estimated memory exceeds the available memory even with subdomains.')
+    ngpus, root_host, child_host, device, subdomain = candidates[0]
+    return {'ngpus': ngpus, 'subdomains': True, 'large_memory': (root_host, child_host, device, subdomain)}
+
+def print_plan(plan, memory):
+    gb = lambda x: 'unknown' if x is None else '%.2f GB' %(x / 1e9)
+    for rank, (hostname, host, device) in enumerate(memory):
+        print('Rank %s on %s: host %s, device %s available' %(rank, hostname, gb(host), gb(device)))
+    root_host, child_host, root_device, device = plan['small_memory']
+    print('Small: host %s (root) %s (child), device %s (root) %s (child)' %(gb(root_host), gb(child_host), gb(root_device), gb(device)))
+    if 'large_memory' in plan:
+        root_host, child_host, device, subdomain = plan['large_memory']
+        print('Large: host %s (root) %s (child), device %s, device with subdomains %s' %(gb(root_host), gb(child_host), gb(device), gb(subdomain)))
+    print('Plan: %s with %s GPUs%s' %('small' if plan['small'] else 'large', plan['ngpus'], ' and subdomains' if plan['subdomains'] else ''))
@@ -27,197 +27,17 @@
 ##########################################################################
 
 from mpi4py import MPI
-import numba
 import numpy as np
 import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
-from pycuda.compiler import SourceModule
+from biomedisa_features.random_walk.kernel_cache import cuda_module
+from biomedisa_features.random_walk.walk_helper import reduceBlocksize, max_to_label
+from biomedisa_features.random_walk.halo import sendrecv
 from biomedisa_features.random_walk.gpu_kernels import (_build_kernel_uncertainty,
         _build_kernel_max, _build_kernel_fill, _build_update_gpu, _build_curvature_gpu)
 
-def reduceBlocksize(slices):
-    zsh, ysh, xsh = slices.shape
-    argmin_x, argmax_x, argmin_y, argmax_y = xsh, 0, ysh, 0
-    for k in range(zsh):
-        y, x = np.nonzero(slices[k])
-        if x.any():
-            argmin_x = min(argmin_x, np.amin(x))
-            argmax_x = max(argmax_x, np.amax(x))
-            argmin_y = min(argmin_y, np.amin(y))
-            argmax_y = max(argmax_y, np.amax(y))
-    argmin_x = argmin_x - 100 if argmin_x - 100 > 0 else 0
-    argmax_x = argmax_x + 100 if argmax_x + 100 < xsh else xsh
-    argmin_y = argmin_y - 100 if argmin_y - 100 > 0 else 0
-    argmax_y = argmax_y + 100 if argmax_y + 100 < ysh else ysh
-    slices[:, :argmin_y] = -1
-    slices[:, argmax_y:] = -1
-    slices[:, :, :argmin_x] = -1
-    slices[:, :, argmax_x:] = -1
-    return slices
-
-def sendrecv(a, blockmin, blockmax, comm, rank, size):
-
-    sendbuf = np.empty(1, dtype=np.int32)
-    recvbuf = np.empty_like(sendbuf)
-
-    if rank == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank == size-1:
-
-        if rank % 2 == 1: add = 0
-        if rank % 2 == 0: add = 6
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0+add)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1+add)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=2+add)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4+add)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=5+add)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-
-    elif rank % 2 == 1:
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=2)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=5)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=7)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=8)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=9)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=10)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=11)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank % 2 == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=6)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=7)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=8)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=10)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=11)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-
-    return a
-
-@numba.jit(nopython=True)
-def max_to_label(a, walkmap, final, blockmin, blockmax, segment):
-    zsh, ysh, xsh = a.shape
-    for k in range(blockmin, blockmax):
-        for l in range(ysh):
-            for m in range(xsh):
-                if a[k,l,m] > walkmap[k,l,m]:
-                    walkmap[k,l,m] = a[k,l,m]
-                    final[k-blockmin,l,m] = segment
-    return walkmap, final
-
 def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
-         allLabels, smooth, uncertainty, ctx, queue, platform):
+         allLabels, smooth, uncertainty, ctx, queue, platform, subdomains=False):
 
     # get rank and size of mpi process
     rank = comm.Get_rank()
@@ -258,9 +78,11 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
 
     # allocate GPU memory or use subdomains
     memory_error = False
-    subdomains = False
-    if zsh * ysh * xsh > 42e8:
-        print('Warning: Volume indexes exceed unsigned long int range. The volume is splitted into subdomains.')
+    if zsh * ysh * xsh > 42e8 or subdomains:
+        if zsh * ysh * xsh > 42e8:
+            print('Warning: Volume indexes exceed unsigned long int range. The volume is splitted into subdomains.')
+        else:
+            print('The volume is splitted into subdomains to fit into GPU memory.')
         subdomains = True
         sendbuf = np.zeros(1, dtype=np.int32) + 1
         recvbuf = np.zeros(1, dtype=np.int32)
@@ -427,8 +249,14 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
                 pass
             return memory_error, None, None, None
 
-        # communicate hits
-        if size > 1:
+        # communicate hits, without smoothing and uncertainty the label with the most
+        # hits is computed on the interior of the block during communication
+        overlap = size > 1 and label_counter > 0 and not (uncertainty or smooth)
+        if overlap:
+            def update(lo, hi):
+                max_to_label(hits, walkmap, final[lo-blockmin:], lo, hi, segment)
+            sendrecv(hits, blockmin, blockmax, comm, rank, size, update)
+        elif size > 1:
             hits = sendrecv(hits, blockmin, blockmax, comm, rank, size)
             if uncertainty or smooth:
                 cuda.memcpy_htod(hits_gpu, hits)
@@ -453,7 +281,7 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
         # get the label with the most hits
         if label_counter == 0:
             walkmap = np.copy(hits)
-        else:
+        elif not overlap:
             walkmap, final = max_to_label(hits, walkmap, final, blockmin, blockmax, segment)
             #update = hits[blockmin:blockmax] > walkmap[blockmin:blockmax]
             #walkmap[blockmin:blockmax][update] = hits[blockmin:blockmax][update]
@@ -647,7 +475,7 @@ def _build_kernel_int8():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -820,7 +648,7 @@ def _build_kernel_float32():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
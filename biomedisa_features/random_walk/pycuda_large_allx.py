@@ -31,183 +31,12 @@ import numba
 import numpy as np
 import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
-from pycuda.compiler import SourceModule
+from biomedisa_features.random_walk.kernel_cache import cuda_module
+from biomedisa_features.random_walk.walk_helper import reduceBlocksize_allx as reduceBlocksize, max_to_label
+from biomedisa_features.random_walk.halo import sendrecv
 from biomedisa_features.random_walk.gpu_kernels import (_build_kernel_uncertainty,
         _build_kernel_max, _build_kernel_fill, _build_update_gpu, _build_curvature_gpu)
 
-def reduceBlocksize(slices):
-    testSlices = np.copy(slices)
-    testSlices[testSlices==-1] = 0
-    zsh, ysh, xsh = slices.shape
-    argmin_x, argmax_x, argmin_y, argmax_y = xsh, 0, ysh, 0
-    for k in range(zsh):
-        y, x = np.nonzero(testSlices[k])
-        if x.any():
-            argmin_x = min(argmin_x, np.amin(x))
-            argmax_x = max(argmax_x, np.amax(x))
-            argmin_y = min(argmin_y, np.amin(y))
-            argmax_y = max(argmax_y, np.amax(y))
-    argmin_x = argmin_x - 100 if argmin_x - 100 > 0 else 0
-    argmax_x = argmax_x + 100 if argmax_x + 100 < xsh else xsh
-    argmin_y = argmin_y - 100 if argmin_y - 100 > 0 else 0
-    argmax_y = argmax_y + 100 if argmax_y + 100 < ysh else ysh
-    slices[:, :argmin_y] = -1
-    slices[:, argmax_y:] = -1
-    slices[:, :, :argmin_x] = -1
-    slices[:, :, argmax_x:] = -1
-    return slices
-
-def sendrecv(a, blockmin, blockmax, comm, rank, size):
-
-    sendbuf = np.empty(1, dtype=np.int32)
-    recvbuf = np.empty_like(sendbuf)
-
-    if rank == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank == size-1:
-
-        if rank % 2 == 1: add = 0
-        if rank % 2 == 0: add = 6
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0+add)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1+add)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=2+add)
-            limit = min(a.shape[0], blockmin+data_z) - blockmin
-            a[blockmin:blockmin+data_z] += recv[:limit]
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4+add)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=5+add)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-
-    elif rank % 2 == 1:
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=2)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=5)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=7)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=8)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=9)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=10)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=11)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank % 2 == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=6)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=7)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.float32)
-            comm.Recv([recv, MPI.FLOAT], source=source, tag=8)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=10)
-            comm.Send([send, MPI.FLOAT], dest=dest, tag=11)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-
-    return a
-
 @numba.jit(nopython=True)
 def _calc_var(raw, A):
     ysh, xsh = raw.shape
@@ -229,25 +58,15 @@ def _calc_var(raw, A):
                     beta[l, m] = var
     return beta
 
-@numba.jit(nopython=True)
-def max_to_label(a, walkmap, final, blockmin, blockmax, segment):
-    zsh, ysh, xsh = a.shape
-    for k in range(blockmin, blockmax):
-        for l in range(ysh):
-            for m in range(xsh):
-                if a[k,l,m] > walkmap[k,l,m]:
-                    walkmap[k,l,m] = a[k,l,m]
-                    final[k-blockmin,l,m] = segment
-    return walkmap, final
-
 def _calc_label_walking_area(sliceData, labelValue):
     walkingArea = np.zeros_like(sliceData)
     walkingArea[sliceData == labelValue] = 1
     return walkingArea
 
 def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax, name,
-         allLabels, smooth, uncertainty, ctx, queue, platform):
+         allLabels, smooth, uncertainty, ctx, queue, platform, subdomains=False):
 
+    # subdomains are not supported for allx
     rank = comm.Get_rank()
     size = comm.Get_size()
 
@@ -621,7 +440,7 @@ def _build_kernel_int8():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -800,7 +619,7 @@ def _build_kernel_float32():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
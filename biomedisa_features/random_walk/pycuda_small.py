@@ -29,41 +29,15 @@
 import numpy as np
 import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
-from pycuda.compiler import SourceModule
+from biomedisa_features.random_walk.walk_helper import walk_labels, _seed_offset
+from biomedisa_features.random_walk.kernel_cache import cuda_module
 from biomedisa_features.random_walk.gpu_kernels import _build_kernel_fill
 
-def walk(data, slices, indices, indices_child, nbrw, sorw, name, ctx, queue):
+def walk(data, slices, indices, indices_child, nbrw, sorw, name, ctx, queue, accumulate=None, seed=0):
+    return walk_labels(_walk_on_current_gpu, data, slices, indices, indices_child, nbrw, sorw, name,
+                       accumulate=accumulate, seed=seed)
 
-    labels = np.unique(slices)
-    slicesChunk = _extract_slices(slices, indices, indices_child)
-    labelsChunk = np.unique(slicesChunk)
-
-    # remove negative labels from list
-    index = np.argwhere(labels<0)
-    labels = np.delete(labels, index)
-    index = np.argwhere(labelsChunk<0)
-    labelsChunk = np.delete(labelsChunk, index)
-
-    walkmapChunk = _walk_on_current_gpu(data, slicesChunk, labelsChunk, indices_child, nbrw, sorw, name)
-
-    if walkmapChunk.shape[0] != len(labels):
-        walkmap = np.zeros((len(labels),)+data.shape, dtype=np.float32)
-        chunk2Walkmap = np.nonzero(np.in1d(labels, labelsChunk))[0]
-        for chunkIndex, walkmapIndex in enumerate(chunk2Walkmap):
-            walkmap[walkmapIndex] += walkmapChunk[chunkIndex]
-    else:
-        walkmap = walkmapChunk
-
-    return walkmap
-
-def _extract_slices(slices, indices, indicesChunk):
-    extracted = np.zeros((0, slices.shape[1], slices.shape[2]), dtype=np.int32)
-    slicesIndicesToExtract = np.nonzero(np.in1d(indices, indicesChunk))[0]
-    for arraySliceIndex in slicesIndicesToExtract:
-        extracted = np.append(extracted, [slices[arraySliceIndex]], axis=0)
-    return extracted
-
-def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name):
+def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, accumulate=None, seed=0):
 
     if raw.dtype == 'uint8':
         kernel = _build_kernel_int8()
@@ -74,7 +48,6 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name):
 
     fill_gpu = _build_kernel_fill()
 
-    walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
     zsh, ysh, xsh = raw.shape
     slshape = slices.shape[0]
 
@@ -83,6 +56,7 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name):
     zsh_gpu = np.int32(zsh)
     sorw = np.int32(sorw)
     nbrw = np.int32(nbrw)
+    seed = _seed_offset(seed, slshape * ysh * xsh)
     indices = np.array(indices, dtype=np.int32)
     slices = np.array(slices, dtype=np.int32)
 
@@ -90,23 +64,46 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name):
     indices_gpu = gpuarray.to_gpu(indices)
     slices_gpu = gpuarray.to_gpu(slices)
 
-    a = np.empty(raw.shape, dtype=np.float32)
-    a_gpu = cuda.mem_alloc(a.nbytes)
-
     block = (32, 32, 1)
     x_grid = (xsh // 32) + 1
     y_grid = (ysh // 32) + 1
     grid = (int(x_grid), int(y_grid), int(slshape))
     grid2 = (int(x_grid), int(y_grid), int(zsh))
 
+    a = np.empty(raw.shape, dtype=np.float32)
+    if accumulate is None:
+        walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
+
+    # walk all labels in a single launch if the accumulators fit on the device
+    free, total = cuda.mem_get_info()
+    if len(allLabels) * a.nbytes < 0.9 * free:
+        print('%s:' %(name) + ' ' + str(len(allLabels)) + ' labels in a single launch')
+        segments_gpu = gpuarray.to_gpu(np.array(allLabels, dtype=np.int32))
+        walkmap_gpu = gpuarray.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
+        kernel(segments_gpu, np.int32(len(allLabels)), raw_gpu, slices_gpu, walkmap_gpu, xsh_gpu, ysh_gpu, zsh_gpu, indices_gpu, sorw, nbrw, seed, block=block, grid=grid)
+        if accumulate is None:
+            walkmap_gpu.get(walkmap)
+            return walkmap
+        for label_counter in range(len(allLabels)):
+            walkmap_gpu[label_counter].get(a)
+            accumulate(label_counter, a)
+        return None
+
+    a_gpu = cuda.mem_alloc(a.nbytes)
+
     for label_counter, segment in enumerate(allLabels):
         print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
-        segment_gpu = np.int32(segment)
+        segments_gpu = gpuarray.to_gpu(np.array([segment], dtype=np.int32))
         fill_gpu(a_gpu, xsh_gpu, ysh_gpu, block=block, grid=grid2)
-        kernel(segment_gpu, raw_gpu, slices_gpu, a_gpu, xsh_gpu, ysh_gpu, zsh_gpu, indices_gpu, sorw, nbrw, block=block, grid=grid)
+        kernel(segments_gpu, np.int32(1), raw_gpu, slices_gpu, a_gpu, xsh_gpu, ysh_gpu, zsh_gpu, indices_gpu, sorw, nbrw, seed, block=block, grid=grid)
         cuda.memcpy_dtoh(a, a_gpu)
-        walkmap[label_counter] += a
-    return walkmap
+        if accumulate is None:
+            walkmap[label_counter] += a
+        else:
+            accumulate(label_counter, a)
+
+    if accumulate is None:
+        return walkmap
 
 def _build_kernel_int8():
     code = """
@@ -135,7 +132,7 @@ def _build_kernel_int8():
         return exp( - tmp * tmp * div1 );
         }
 
-    __global__ void Funktion(int segment, float *raw, int *slices, float *a, int xsh, int ysh, int zsh, int *indices, int sorw, int nbrw) {
+    __global__ void Funktion(int *segments, int nsegments, float *raw, int *slices, float *a, int xsh, int ysh, int zsh, int *indices, int sorw, int nbrw, int seed) {
 
         int flat   = xsh * ysh;
         int column = blockIdx.x * blockDim.x + threadIdx.x;
@@ -146,7 +143,18 @@ def _build_kernel_int8():
 
         if (index < gridDim.z*flat && plane>0 && row>0 && column>0 && plane<zsh-1 && row<ysh-1 && column<xsh-1) {
 
-            if (slices[index]==segment) {
+            /* Get the accumulator of the label */
+            int segment = slices[index];
+            int label_idx = -1;
+            for (int s = 0; s < nsegments; s++) {
+                if (segments[s] == segment) {
+                    label_idx = s;
+                    }
+                }
+
+            if (label_idx >= 0) {
+
+                unsigned long long offset = (unsigned long long)label_idx * zsh * flat;
 
                 float rand;
                 float W0,W1,W2,W3,W4,W5;
@@ -162,7 +170,8 @@ def _build_kernel_int8():
                 float a23n = 1370589.0;
                 long k1;
                 float p1, p2;
-                float s10 = index, s11 = index, s12 = index, s20 = index, s21 = index, s22 = index;
+                int rng_seed = index + seed;
+                float s10 = rng_seed, s11 = rng_seed, s12 = rng_seed, s20 = rng_seed, s21 = rng_seed, s22 = rng_seed;
 
                 /* Compute standard deviation */
                 int position = plane*flat + row*xsh + column;
@@ -238,7 +247,7 @@ def _build_kernel_int8():
                         l += o;
                         m += p;
                         position = k*flat + l*xsh + m;
-                        atomicAdd(&a[position], 1);
+                        atomicAdd(&a[offset + position], 1);
                         }
 
                     step += 1;
@@ -256,7 +265,7 @@ def _build_kernel_int8():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -287,7 +296,7 @@ def _build_kernel_float32():
         return exp( - tmp * tmp * div1 );
         }
 
-    __global__ void Funktion(int segment, float *raw, int *slices, float *a, int xsh, int ysh, int zsh, int *indices, int sorw, int nbrw) {
+    __global__ void Funktion(int *segments, int nsegments, float *raw, int *slices, float *a, int xsh, int ysh, int zsh, int *indices, int sorw, int nbrw, int seed) {
 
         int flat   = xsh * ysh;
         int column = blockIdx.x * blockDim.x + threadIdx.x;
@@ -298,7 +307,18 @@ def _build_kernel_float32():
 
         if (index < gridDim.z*flat && plane>0 && row>0 && column>0 && plane<zsh-1 && row<ysh-1 && column<xsh-1) {
 
-            if (slices[index]==segment) {
+            /* Get the accumulator of the label */
+            int segment = slices[index];
+            int label_idx = -1;
+            for (int s = 0; s < nsegments; s++) {
+                if (segments[s] == segment) {
+                    label_idx = s;
+                    }
+                }
+
+            if (label_idx >= 0) {
+
+                unsigned long long offset = (unsigned long long)label_idx * zsh * flat;
 
                 float rand;
                 float W0,W1,W2,W3,W4,W5;
@@ -314,7 +334,8 @@ def _build_kernel_float32():
                 float a23n = 1370589.0;
                 long k1;
                 float p1, p2;
-                float s10 = index, s11 = index, s12 = index, s20 = index, s21 = index, s22 = index;
+                int rng_seed = index + seed;
+                float s10 = rng_seed, s11 = rng_seed, s12 = rng_seed, s20 = rng_seed, s21 = rng_seed, s22 = rng_seed;
 
                 /* Compute standard deviation */
                 int position = plane*flat + row*xsh + column;
@@ -390,7 +411,7 @@ def _build_kernel_float32():
                         l += o;
                         m += p;
                         position = k*flat + l*xsh + m;
-                        atomicAdd(&a[position], 1);
+                        atomicAdd(&a[offset + position], 1);
                         }
 
                     step += 1;
@@ -408,7 +429,7 @@ def _build_kernel_float32():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -29,7 +29,7 @@
 import numpy as np
 import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
-from pycuda.compiler import SourceModule
+from biomedisa_features.random_walk.kernel_cache import cuda_module
 from biomedisa_features.random_walk.gpu_kernels import _build_kernel_fill
 import numba
 
@@ -329,7 +329,7 @@ def _build_kernel_int8():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -487,7 +487,7 @@ def _build_kernel_float32():
             }
         }
     """
-    mod = SourceModule(code)
+    mod = cuda_module(code)
     kernel = mod.get_function("Funktion")
     return kernel
 
@@ -27,197 +27,16 @@
 ##########################################################################
 
 from mpi4py import MPI
-import numba
 import numpy as np
 import pyopencl as cl
 import pyopencl.array
-
-def reduceBlocksize(slices):
-    zsh, ysh, xsh = slices.shape
-    argmin_x, argmax_x, argmin_y, argmax_y = xsh, 0, ysh, 0
-    for k in range(zsh):
-        y, x = np.nonzero(slices[k])
-        if x.any():
-            argmin_x = min(argmin_x, np.amin(x))
-            argmax_x = max(argmax_x, np.amax(x))
-            argmin_y = min(argmin_y, np.amin(y))
-            argmax_y = max(argmax_y, np.amax(y))
-    argmin_x = argmin_x - 100 if argmin_x - 100 > 0 else 0
-    argmax_x = argmax_x + 100 if argmax_x + 100 < xsh else xsh
-    argmin_y = argmin_y - 100 if argmin_y - 100 > 0 else 0
-    argmax_y = argmax_y + 100 if argmax_y + 100 < ysh else ysh
-    slices[:, :argmin_y] = -1
-    slices[:, argmax_y:] = -1
-    slices[:, :, :argmin_x] = -1
-    slices[:, :, argmax_x:] = -1
-    return slices
-
-def sendrecv(a, blockmin, blockmax, comm, rank, size):
-
-    sendbuf = np.empty(1, dtype=np.int32)
-    recvbuf = np.empty_like(sendbuf)
-
-    if rank == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.INT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank == size-1:
-
-        if rank % 2 == 1: add = 0
-        if rank % 2 == 0: add = 6
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0+add)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1+add)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=2+add)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4+add)
-            comm.Send([send, MPI.INT], dest=dest, tag=5+add)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3+add)
-
-    elif rank % 2 == 1:
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=0)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=1)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=2)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=4)
-            comm.Send([send, MPI.INT], dest=dest, tag=5)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=3)
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=7)
-            comm.Send([send, MPI.INT], dest=dest, tag=8)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=6)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=9)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=10)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=11)
-            a[blockmax-data_z:blockmax] += recv
-
-    elif rank % 2 == 0:
-
-        # send block
-        dest = rank+1
-        tmp = a[blockmax:]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=1)
-            comm.Send([send, MPI.INT], dest=dest, tag=2)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=0)
-
-        # recv block
-        source = rank+1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=3)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=4)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=5)
-            a[blockmax-data_z:blockmax] += recv
-
-        # recv block
-        source = rank-1
-        comm.Recv([recvbuf, MPI.INT], source=source, tag=6)
-        if recvbuf:
-            data_z, data_y, data_x = comm.recv(source=source, tag=7)
-            recv = np.empty((data_z, data_y, data_x), dtype=np.int32)
-            comm.Recv([recv, MPI.INT], source=source, tag=8)
-            a[blockmin:blockmin+data_z] += recv
-
-        # send block
-        dest = rank-1
-        tmp = a[:blockmin]
-        if np.any(tmp):
-            sendbuf.fill(1)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-            send = tmp.copy(order='C')
-            comm.send([send.shape[0], send.shape[1], send.shape[2]], dest=dest, tag=10)
-            comm.Send([send, MPI.INT], dest=dest, tag=11)
-        else:
-            sendbuf.fill(0)
-            comm.Send([sendbuf, MPI.INT], dest=dest, tag=9)
-
-    return a
-
-@numba.jit(nopython=True)
-def max_to_label(a, walkmap, final, blockmin, blockmax, segment):
-    zsh, ysh, xsh = a.shape
-    for k in range(blockmin, blockmax):
-        for l in range(ysh):
-            for m in range(xsh):
-                if a[k,l,m] > walkmap[k,l,m]:
-                    walkmap[k,l,m] = a[k,l,m]
-                    final[k-blockmin,l,m] = segment
-    return walkmap, final
+from biomedisa_features.random_walk.kernel_cache import opencl_program
+from biomedisa_features.random_walk.walk_helper import reduceBlocksize, max_to_label
+from biomedisa_features.random_walk.halo import sendrecv
+from biomedisa_features.random_walk.cpu_kernels import max_to_uncertainty, compute_uncertainty, smooth_cpu
 
 def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax,
-         name, allLabels, smooth, uncertainty, ctx, queue, platform):
-
-    # disable smoothing and uncertainty
-    smooth, uncertainty = 0, 0
+         name, allLabels, smooth, uncertainty, ctx, queue, platform, subdomains=False):
 
     # get rank and size of mpi process
     rank = comm.Get_rank()
@@ -242,9 +61,15 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax,
     hits = np.empty(raw.shape, dtype=np.int32)
     final = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
 
+    # smoothing and uncertainty are computed on the host
+    if smooth:
+        final_smooth = np.zeros((blockmax-blockmin, ysh, xsh), dtype=np.uint8)
+    if uncertainty:
+        max_hits = np.zeros((3,)+raw.shape, dtype=np.float32)
+
     # kernel function instantiation
     mf = cl.mem_flags
-    prg = cl.Program(ctx, src).build()
+    prg = opencl_program(ctx, src)
 
     # allocate memory for variables on the device
     xsh_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(xsh))
@@ -258,10 +83,11 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax,
 
     # allocate device memory or use subdomains
     memory_error = False
-    subdomains = False
-    if zsh * ysh * xsh > 42e8 or platform.split('_')[-1] == 'GPU':
+    if zsh * ysh * xsh > 42e8 or platform.split('_')[-1] == 'GPU' or subdomains:
         if zsh * ysh * xsh > 42e8:
             print('Warning: Volume indexes exceed unsigned long int range. The volume is splitted into subdomains.')
+        elif subdomains:
+            print('The volume is splitted into subdomains to fit into device memory.')
         else:
             print('The volume is splitted into subdomains for better performance.')
         subdomains = True
@@ -373,22 +199,44 @@ def walk(comm, raw, slices, indices, nbrw, sorw, blockmin, blockmax,
             memory_error = True
             return memory_error, None, None, None
 
-        # communicate hits
-        if size > 1:
-            hits = sendrecv(hits, blockmin, blockmax, comm, rank, size)
-
-        # get the label with the most hits
+        # communicate hits and get the label with the most hits,
+        # the interior of the block is processed during communication
         if label_counter == 0:
+            if size > 1:
+                hits = sendrecv(hits, blockmin, blockmax, comm, rank, size)
             walkmap = np.copy(hits)
         else:
-            walkmap, final = max_to_label(hits, walkmap, final, blockmin, blockmax, segment)
+            def update(lo, hi):
+                max_to_label(hits, walkmap, final[lo-blockmin:], lo, hi, segment)
+            if size > 1:
+                sendrecv(hits, blockmin, blockmax, comm, rank, size, update)
+            else:
+                update(blockmin, blockmax)
             #update = hits[blockmin:blockmax] > walkmap[blockmin:blockmax]
             #walkmap[blockmin:blockmax][update] = hits[blockmin:blockmax][update]
             #final[update] = segment
 
-    # uncertainty and smooth are disabled
-    final_uncertainty = None
-    final_smooth = None
+        # save the three most occuring hits
+        if uncertainty:
+            max_to_uncertainty(max_hits, hits)
+
+        # smooth manifold
+        if smooth:
+            hits_smooth = smooth_cpu(hits, smooth)
+            if label_counter == 0:
+                hits_smooth[hits_smooth<0] = 0
+                walkmap_smooth = np.copy(hits_smooth)
+            else:
+                walkmap_smooth, final_smooth = max_to_label(hits_smooth, walkmap_smooth, final_smooth, blockmin, blockmax, segment)
+
+    # compute uncertainty
+    if uncertainty:
+        final_uncertainty = compute_uncertainty(max_hits)[blockmin:blockmax]
+    else:
+        final_uncertainty = None
+
+    if not smooth:
+        final_smooth = None
 
     return memory_error, final, final_uncertainty, final_smooth
 
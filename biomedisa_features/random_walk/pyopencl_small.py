@@ -29,39 +29,14 @@
 import numpy as np
 import pyopencl as cl
 import os
+from biomedisa_features.random_walk.walk_helper import walk_labels, _seed_offset
+from biomedisa_features.random_walk.kernel_cache import opencl_program
 
-def walk(data, slices, indices, indices_child, nbrw, sorw, name, ctx, queue):
-
-    labels = np.unique(slices)
-    slicesChunk = _extract_slices(slices, indices, indices_child)
-    labelsChunk = np.unique(slicesChunk)
-
-    # remove negative labels from list
-    index = np.argwhere(labels<0)
-    labels = np.delete(labels, index)
-    index = np.argwhere(labelsChunk<0)
-    labelsChunk = np.delete(labelsChunk, index)
-
-    walkmapChunk = _walk_on_current_gpu(data, slicesChunk, labelsChunk, indices_child, nbrw, sorw, name, ctx, queue)
-
-    if walkmapChunk.shape[0] != len(labels):
-        walkmap = np.zeros((len(labels),)+data.shape, dtype=np.float32)
-        chunk2Walkmap = np.nonzero(np.in1d(labels, labelsChunk))[0]
-        for chunkIndex, walkmapIndex in enumerate(chunk2Walkmap):
-            walkmap[walkmapIndex] += walkmapChunk[chunkIndex]
-    else:
-        walkmap = walkmapChunk
-
-    return walkmap
+def walk(data, slices, indices, indices_child, nbrw, sorw, name, ctx, queue, accumulate=None, seed=0):
+    return walk_labels(_walk_on_current_gpu, data, slices, indices, indices_child, nbrw, sorw, name,
+                       (ctx, queue), accumulate=accumulate, seed=seed)
  
-def _extract_slices(slices, indices, indicesChunk):
-    extracted = np.zeros((0, slices.shape[1], slices.shape[2]), dtype=np.int32)
-    slicesIndicesToExtract = np.nonzero(np.in1d(indices, indicesChunk))[0]
-    for arraySliceIndex in slicesIndicesToExtract:
-        extracted = np.append(extracted, [slices[arraySliceIndex]], axis=0)
-    return extracted
-
-def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, ctx, queue):
+def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, ctx, queue, accumulate=None, seed=0):
 
     # build kernels
     if raw.dtype == 'uint8':
@@ -73,8 +48,9 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, ctx,
 
     indices = np.array(indices, dtype=np.int32)
     slices = np.array(slices, dtype=np.int32)
-    walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
     a = np.empty(raw.shape, dtype=np.int32)
+    if accumulate is None:
+        walkmap = np.zeros((len(allLabels),)+raw.shape, dtype=np.float32)
 
     # image size
     zsh, ysh, xsh = raw.shape
@@ -82,20 +58,22 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, ctx,
 
     # kernel function instantiation
     mf = cl.mem_flags
-    prg = cl.Program(ctx, src).build()
+    prg = opencl_program(ctx, src)
 
     # allocate memory for variables on the device
     indices_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=indices)
     slices_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=slices)
     raw_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=raw)
-    a_cl = cl.Buffer(ctx, mf.WRITE_ONLY | mf.COPY_HOST_PTR, hostbuf=a)
 
     xsh_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(xsh))
     ysh_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(ysh))
     zsh_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(zsh))
     sorw_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(sorw))
     nbrw_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(nbrw))
-    segment_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(0))
+    seed_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=_seed_offset(seed, slshape * ysh * xsh))
+    segments = np.array(allLabels, dtype=np.int32)
+    segments_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=segments)
+    nsegments_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(0))
 
     # block and grid size
     #block = (1, 32, 32)
@@ -106,15 +84,43 @@ def _walk_on_current_gpu(raw, slices, allLabels, indices, nbrw, sorw, name, ctx,
     block = None
     grid = (slshape, ysh, xsh)
 
+    # walk all labels in a single launch if the accumulators fit on the device
+    device = queue.device
+    hits_nbytes = len(allLabels) * a.nbytes
+    if hits_nbytes < device.max_mem_alloc_size and hits_nbytes < 0.8 * device.global_mem_size:
+        print('%s:' %(name) + ' ' + str(len(allLabels)) + ' labels in a single launch')
+        hits_cl = cl.Buffer(ctx, mf.WRITE_ONLY, size=hits_nbytes)
+        cl.enqueue_fill_buffer(queue, hits_cl, np.int32(0), offset=0, size=hits_nbytes)
+        cl.enqueue_fill_buffer(queue, nsegments_cl, np.int32(len(allLabels)), offset=0, size=4, wait_for=None)
+        prg.randomWalk(queue, grid, block, segments_cl, nsegments_cl, raw_cl, slices_cl, hits_cl, xsh_cl, ysh_cl, zsh_cl, indices_cl, sorw_cl, nbrw_cl, seed_cl)
+        if accumulate is None:
+            hits = np.empty((len(allLabels),)+raw.shape, dtype=np.int32)
+            cl.enqueue_copy(queue, hits, hits_cl)
+            hits_cl.release()
+            walkmap += hits
+            return walkmap
+        for label_counter in range(len(allLabels)):
+            cl.enqueue_copy(queue, a, hits_cl, src_offset=label_counter*a.nbytes)
+            accumulate(label_counter, a.astype(np.float32))
+        hits_cl.release()
+        return None
+
     # call Kernel
+    a_cl = cl.Buffer(ctx, mf.WRITE_ONLY | mf.COPY_HOST_PTR, hostbuf=a)
+    cl.enqueue_fill_buffer(queue, nsegments_cl, np.int32(1), offset=0, size=4, wait_for=None)
     for label_counter, segment in enumerate(allLabels):
         print('%s:' %(name) + ' ' + str(label_counter+1) + '/' + str(len(allLabels)))
         cl.enqueue_fill_buffer(queue, a_cl, np.int32(0), offset=0, size=a.nbytes)
-        cl.enqueue_fill_buffer(queue, segment_cl, np.int32(segment), offset=0, size=4, wait_for=None)
-        prg.randomWalk(queue, grid, block, segment_cl, raw_cl, slices_cl, a_cl, xsh_cl, ysh_cl, zsh_cl, indices_cl, sorw_cl, nbrw_cl)
+        cl.enqueue_fill_buffer(queue, segments_cl, np.int32(segment), offset=0, size=4, wait_for=None)
+        prg.randomWalk(queue, grid, block, segments_cl, nsegments_cl, raw_cl, slices_cl, a_cl, xsh_cl, ysh_cl, zsh_cl, indices_cl, sorw_cl, nbrw_cl, seed_cl)
         cl.enqueue_copy(queue, a, a_cl)
-        walkmap[label_counter] += a
-    return walkmap
+        if accumulate is None:
+            walkmap[label_counter] += a
+        else:
+            accumulate(label_counter, a.astype(np.float32))
+
+    if accumulate is None:
+        return walkmap
 
 def _build_kernel_int8():
     src = '''
@@ -143,14 +149,15 @@ def _build_kernel_int8():
         return exp( - tmp * tmp * div1 );
         }
 
-    __kernel void randomWalk(__global int *Segment, __global char *raw, __global int *slices, __global int *a, __global int *Xsh, __global int *Ysh, __global int *Zsh, __global int *indices, __global int *Sorw, __global int *Nbrw) {
+    __kernel void randomWalk(__global int *segments, __global int *Nsegments, __global char *raw, __global int *slices, __global int *a, __global int *Xsh, __global int *Ysh, __global int *Zsh, __global int *indices, __global int *Sorw, __global int *Nbrw, __global int *Seed) {
 
         int sorw = *Sorw;
         int nbrw = *Nbrw;
+        int seed = *Seed;
         int xsh = *Xsh;
         int ysh = *Ysh;
         int zsh = *Zsh;
-        int segment = *Segment;
+        int nsegments = *Nsegments;
 
         // get_global_id(0)         // blockIdx.z * blockDim.z + threadIdx.z
         // get_local_id(0)          // threadIdx.z
@@ -167,7 +174,18 @@ def _build_kernel_int8():
 
         if (index < get_global_size(0)*flat && plane>0 && row>0 && column>0 && plane<zsh-1 && row<ysh-1 && column<xsh-1) {
 
-            if (slices[index]==segment) {
+            /* Get the accumulator of the label */
+            int segment = slices[index];
+            int label_idx = -1;
+            for (int s = 0; s < nsegments; s++) {
+                if (segments[s] == segment) {
+                    label_idx = s;
+                    }
+                }
+
+            if (label_idx >= 0) {
+
+                ulong offset = (ulong)label_idx * zsh * flat;
 
                 float rand;
                 float W0,W1,W2,W3,W4,W5;
@@ -183,7 +201,8 @@ def _build_kernel_int8():
                 float a23n = 1370589.0;
                 long k1;
                 float p1, p2;
-                float s10 = index, s11 = index, s12 = index, s20 = index, s21 = index, s22 = index;
+                int rng_seed = index + seed;
+                float s10 = rng_seed, s11 = rng_seed, s12 = rng_seed, s20 = rng_seed, s21 = rng_seed, s22 = rng_seed;
 
                 /* Compute standard deviation */
                 int B = raw[position];
@@ -258,7 +277,7 @@ def _build_kernel_int8():
                         l += o;
                         m += p;
                         position = k*flat + l*xsh + m;
-                        atomic_add(&a[position], 1);
+                        atomic_add(&a[offset + position], 1);
                         }
 
                     step += 1;
@@ -305,14 +324,15 @@ def _build_kernel_float32():
         return exp( - tmp * tmp * div1 );
         }
 
-    __kernel void randomWalk(__global int *Segment, __global float *raw, __global int *slices, __global int *a, __global int *Xsh, __global int *Ysh, __global int *Zsh, __global int *indices, __global int *Sorw, __global int *Nbrw)
+    __kernel void randomWalk(__global int *segments, __global int *Nsegments, __global float *raw, __global int *slices, __global int *a, __global int *Xsh, __global int *Ysh, __global int *Zsh, __global int *indices, __global int *Sorw, __global int *Nbrw, __global int *Seed)
     {
         int sorw = *Sorw;
         int nbrw = *Nbrw;
+        int seed = *Seed;
         int xsh = *Xsh;
         int ysh = *Ysh;
         int zsh = *Zsh;
-        int segment = *Segment;
+        int nsegments = *Nsegments;
 
         // get_global_id(0)         // blockIdx.z * blockDim.z + threadIdx.z
         // get_local_id(0)          // threadIdx.z
@@ -329,7 +349,18 @@ def _build_kernel_float32():
 
         if (index < get_global_size(0)*flat && plane>0 && row>0 && column>0 && plane<zsh-1 && row<ysh-1 && column<xsh-1) {
 
-            if (slices[index]==segment) {
+            /* Get the accumulator of the label */
+            int segment = slices[index];
+            int label_idx = -1;
+            for (int s = 0; s < nsegments; s++) {
+                if (segments[s] == segment) {
+                    label_idx = s;
+                    }
+                }
+
+            if (label_idx >= 0) {
+
+                ulong offset = (ulong)label_idx * zsh * flat;
 
                 float rand;
                 float W0,W1,W2,W3,W4,W5;
@@ -345,7 +376,8 @@ def _build_kernel_float32():
                 float a23n = 1370589.0;
                 long k1;
                 float p1, p2;
-                float s10 = index, s11 = index, s12 = index, s20 = index, s21 = index, s22 = index;
+                int rng_seed = index + seed;
+                float s10 = rng_seed, s11 = rng_seed, s12 = rng_seed, s20 = rng_seed, s21 = rng_seed, s22 = rng_seed;
 
                 /* Compute standard deviation */
                 float B = raw[position];
@@ -419,7 +451,7 @@ def _build_kernel_float32():
                         l += o;
                         m += p;
                         position = k*flat + l*xsh + m;
-                        atomic_add(&a[position], 1);
+                        atomic_add(&a[offset + position], 1);
                         }
 
                     step += 1;
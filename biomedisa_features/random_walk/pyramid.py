@@ -0,0 +1,184 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+
+from biomedisa_features.biomedisa_helper import (_get_device, img_resize,
+    read_labeled_slices)
+from biomedisa_features.random_walk.rw_small import max_to_label
+import numpy as np
+import time
+import cv2
+
+def _downsample_slices(labels, indices, shape, factor):
+    zsh, ysh, xsh = shape
+    coarse_indices, coarse_labels = [], []
+    for k, slc in zip(indices, labels):
+        if k // factor not in coarse_indices:
+            coarse_indices.append(k // factor)
+            slc = cv2.resize(slc.astype(np.float32), (xsh, ysh), interpolation=cv2.INTER_NEAREST)
+            coarse_labels.append(slc)
+    coarse_labels = np.array(coarse_labels, dtype=np.int32).reshape(-1, ysh, xsh)
+    return coarse_indices, coarse_labels
+
+def _upsample(a, shape, factor):
+    zsh, ysh, xsh = shape
+    z = np.arange(zsh) // factor
+    y = np.arange(ysh) // factor
+    x = np.arange(xsh) // factor
+    return a[np.ix_(z, y, x)]
+
+def _boundary_band(a):
+    # voxels whose 6-neighbourhood contains another label and their neighbours
+    band = np.zeros(a.shape, dtype=bool)
+    for axis in range(3):
+        diff = np.diff(a, axis=axis) != 0
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        band[tuple(lower)] |= diff
+        band[tuple(upper)] |= diff
+    dilated = np.copy(band)
+    for axis in range(3):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        dilated[tuple(lower)] |= band[tuple(upper)]
+        dilated[tuple(upper)] |= band[tuple(lower)]
+    return dilated
+
+def coarse_to_fine(bm):
+
+    # region of interest
+    factor = bm.pyramid
+    crop = (slice(bm.argmin_z, bm.argmax_z), slice(bm.argmin_y, bm.argmax_y), slice(bm.argmin_x, bm.argmax_x))
+    data = bm.data[crop]
+    labelData = bm.labelData[crop]
+    zsh, ysh, xsh = data.shape
+    coarse_shape = (-(-zsh // factor), -(-ysh // factor), -(-xsh // factor))
+
+    # downsample image data and labeled slices
+    coarse_data = img_resize(data, *coarse_shape)
+    indices, labels = read_labeled_slices(labelData)
+    coarse_indices, coarse_labels = _downsample_slices(labels, indices, coarse_shape[1:], factor)
+    allLabels = np.unique(coarse_labels)
+    allLabels = allLabels[allLabels >= 0]
+
+    # select platform
+    if bm.platform == 'cuda':
+        import pycuda.driver as cuda
+        cuda.init()
+        dev = cuda.Device(0)
+        ctx, queue = dev.make_context(), None
+        from biomedisa_features.random_walk.pycuda_small import walk
+    elif bm.platform == 'numba_CPU':
+        ctx, queue = None, None
+        from biomedisa_features.random_walk.numba_small import walk
+    else:
+        ctx, queue = _get_device(bm.platform, 0)
+        from biomedisa_features.random_walk.pyopencl_small import walk
+
+    # random walks at coarse scale covering the same distance
+    final = np.zeros(coarse_shape, dtype=np.uint8)
+    max_hits = np.zeros(coarse_shape, dtype=np.float32)
+    def accumulate(k, hits):
+        max_to_label(np.ascontiguousarray(hits, dtype=np.float32), max_hits, final, k)
+    tic = time.time()
+    walk(coarse_data, coarse_labels, coarse_indices, coarse_indices, bm.nbrw,
+         max(1, bm.sorw // factor**2), 'coarse', ctx, queue, accumulate)
+    print('Walktime_coarse: ' + str(int(time.time() - tic)) + ' ' + 'seconds')
+
+    # free device
+    if bm.platform == 'cuda':
+        ctx.pop()
+        del ctx
+
+    # upsample coarse labels and the band around their boundaries
+    coarse = allLabels[final].astype(np.uint8)
+    band = _upsample(_boundary_band(coarse), (zsh, ysh, xsh), factor)
+    bm.coarse_labels = _upsample(coarse, (zsh, ysh, xsh), factor)
+    bm.coarse_crop = crop
+
+    # remove seeds outside the band
+    masked = labelData.astype(np.int32)
+    for k in indices:
+        masked[k][np.logical_not(band[k])] = -1
+
+    # restore labels which lost all their seeds, their fine result is kept wherever they win
+    bm.restored = []
+    walked = np.copy(band)
+    for label in np.unique(labels):
+        if label >= 0 and not np.any(masked[indices] == label):
+            bm.restored.append(label)
+            for k in indices:
+                masked[k][labelData[k] == label] = label
+                walked[k] |= labelData[k] == label
+
+    # walk at fine scale only within the bounding box of the band and restored seeds
+    fine = _bounding_box(walked, 100)
+    bm.band = band[fine]
+    bm.argmin_z, bm.argmax_z = crop[0].start + fine[0].start, crop[0].start + fine[0].stop
+    bm.argmin_y, bm.argmax_y = crop[1].start + fine[1].start, crop[1].start + fine[1].stop
+    bm.argmin_x, bm.argmax_x = crop[2].start + fine[2].start, crop[2].start + fine[2].stop
+    bm.coarse_fine = fine
+
+    bm.labelData = bm.labelData.astype(np.int32)
+    bm.labelData[crop] = masked
+    print('Fine seeds:', np.count_nonzero(masked[indices] >= 0), 'of', labels.size)
+    print('Fine crop:', tuple(f.stop - f.start for f in fine), 'of', (zsh, ysh, xsh))
+
+    return bm
+
+def _bounding_box(mask, margin):
+    # bounding box of a mask extended by a margin
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other))
+        if nonzero.size == 0:
+            box.append(slice(0, mask.shape[axis]))
+        else:
+            box.append(slice(int(max(nonzero[0] - margin, 0)), int(min(nonzero[-1] + 1 + margin, mask.shape[axis]))))
+    return tuple(box)
+
+def merge_coarse(bm, final, result, touched=None):
+    # keep the coarse labels outside the band or where no walk arrived,
+    # except where a restored label wins
+    fine = bm.band if touched is None else np.logical_and(bm.band, touched)
+    if bm.restored:
+        restored = np.isin(final, bm.restored)
+        if touched is not None:
+            restored &= touched
+        fine = np.logical_or(fine, restored)
+    fine = np.logical_not(fine)
+    final[fine] = bm.coarse_labels[bm.coarse_fine][fine]
+
+    # coarse labels outside the fine crop
+    result[bm.coarse_crop] = bm.coarse_labels
+    return final
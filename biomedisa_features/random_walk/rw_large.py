@@ -34,6 +34,39 @@ import time
 import socket
 import os
 
+def _ghost_width(sorw, zsh, ngpus):
+    # a random walk moves on average sqrt(sorw/3) slices in z, keep three standard deviations
+    # but not more than a block so that ghost regions are only exchanged with neighbours
+    ghost = int(np.ceil(3 * np.sqrt(sorw / 3)))
+    return max(1, min(ghost, zsh // ngpus))
+
+def _decompose(labelData, ngpus, nbrw, ghost, allaxis=False):
+    # size the blocks by the number of random walks starting in each slice
+    zsh = labelData.shape[0]
+    # background seeds (label 0) are walked as well, only for all axes
+    # unlabeled z-slices are included and zeros cannot be told apart from them
+    work = np.zeros(zsh)
+    if allaxis:
+        for k in range(zsh):
+            work[k] = np.count_nonzero(labelData[k] > 0) * nbrw
+    else:
+        indices, _ = read_labeled_slices_large(labelData)
+        for k in indices:
+            work[k] = np.count_nonzero(labelData[k] >= 0) * nbrw
+    cumulative = np.cumsum(work)
+    if cumulative[-1] == 0:
+        blocks = [k * (zsh // ngpus) for k in range(ngpus)] + [zsh]
+    else:
+        targets = cumulative[-1] * np.arange(1, ngpus) / ngpus
+        blocks = [0] + [int(k) + 1 for k in np.searchsorted(cumulative, targets)] + [zsh]
+    # each block must be at least as thick as the ghost regions
+    for k in range(1, ngpus):
+        blocks[k] = max(blocks[k], blocks[k-1] + ghost)
+    for k in range(ngpus-1, 0, -1):
+        blocks[k] = min(blocks[k], blocks[k+1] - ghost)
+    loads = [np.sum(work[blocks[k]:blocks[k+1]]) for k in range(ngpus)]
+    return blocks, loads
+
 def _diffusion_child(comm, bm=None):
 
     rank = comm.Get_rank()
@@ -53,13 +86,10 @@ def _diffusion_child(comm, bm=None):
         bm.labelData = np.copy(bm.labelData[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x], order='C')
 
         # domain decomposition
-        sizeofblocks = (bm.argmax_z - bm.argmin_z) // ngpus
-        blocks = [0]
-        for k in range(ngpus-1):
-            block_temp = blocks[-1] + sizeofblocks
-            blocks.append(block_temp)
-        blocks.append(bm.argmax_z - bm.argmin_z)
+        ghost = _ghost_width(bm.sorw, bm.argmax_z - bm.argmin_z, ngpus)
+        blocks, loads = _decompose(bm.labelData, ngpus, bm.nbrw, ghost, bm.allaxis)
         print('blocks =', blocks)
+        print('ghost =', ghost)
 
         # read labeled slices
         if bm.allaxis:
@@ -76,8 +106,8 @@ def _diffusion_child(comm, bm=None):
             # ghost blocks
             blockmin = blocks[destination]
             blockmax = blocks[destination+1]
-            datablockmin = blockmin - 100
-            datablockmax = blockmax + 100
+            datablockmin = blockmin - ghost
+            datablockmax = blockmax + ghost
             datablockmin = 0 if datablockmin < 0 else datablockmin
             datablockmax = (bm.argmax_z - bm.argmin_z) if datablockmax > (bm.argmax_z - bm.argmin_z) else datablockmax
             datablock = np.copy(bm.data[datablockmin:datablockmax], order='C')
@@ -122,6 +152,7 @@ def _diffusion_child(comm, bm=None):
                 sendToChildLarge(comm, indices_child, destination, dataListe, labels_child,
                             bm.nbrw, bm.sorw, blocks_temp, bm.allaxis,
                             bm.allLabels, bm.smooth, bm.uncertainty, bm.platform)
+                comm.send(bm.subdomains, dest=destination, tag=98)
 
             else:
 
@@ -135,6 +166,13 @@ def _diffusion_child(comm, bm=None):
                         from biomedisa_features.random_walk.pycuda_large_allx import walk
                     else:
                         from biomedisa_features.random_walk.pycuda_large import walk
+                elif bm.allaxis:
+                    # all axes are walked by the portable host engine on OpenCL and CPU nodes
+                    ctx, queue = None, None
+                    from biomedisa_features.random_walk.numba_large_allx import walk
+                elif bm.platform == 'numba_CPU':
+                    ctx, queue = None, None
+                    from biomedisa_features.random_walk.numba_large import walk
                 else:
                     ctx, queue = _get_device(bm.platform, rank)
                     from biomedisa_features.random_walk.pyopencl_large import walk
@@ -145,10 +183,17 @@ def _diffusion_child(comm, bm=None):
                                     labels_child, indices_child, bm.nbrw, bm.sorw,
                                     blockmin-datablockmin, blockmax-datablockmin, name,
                                     bm.allLabels, bm.smooth, bm.uncertainty,
-                                    ctx, queue, bm.platform)
+                                    ctx, queue, bm.platform, bm.subdomains)
                 tac = time.time()
                 print('Walktime_%s: ' %(name) + str(int(tac - tic)) + ' ' + 'seconds')
 
+                # predicted and actual walk time of each GPU
+                walktimes = comm.gather(tac - tic, root=0)
+                total = max(sum(loads), 1)
+                for k in range(ngpus):
+                    print('GPU %s: predicted %s, actual %s seconds' %(k,
+                        int(loads[k] / total * sum(walktimes)), int(walktimes[k])))
+
                 # free device
                 if bm.platform == 'cuda':
                     ctx.pop()
@@ -171,13 +216,18 @@ def _diffusion_child(comm, bm=None):
 
             # regular result
             final_result = np.zeros((bm.zsh, bm.ysh, bm.xsh), dtype=np.uint8)
+
+            # keep coarse labels outside the band around the coarse label boundaries
+            if bm.pyramid > 1:
+                from biomedisa_features.random_walk.pyramid import merge_coarse
+                final = merge_coarse(bm, final, final_result)
             final_result[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x] = final
             final_result = final_result[1:-1, 1:-1, 1:-1]
             results['regular'] = final_result
             if bm.django_env and not bm.remote:
                 bm.path_to_final = unique_file_path(bm.path_to_final)
             if bm.path_to_data:
-                save_data(bm.path_to_final, final_result, bm.header, bm.final_image_type, bm.compression)
+                save_data(bm.path_to_final, final_result, bm.header, bm.final_image_type, bm.compression, output_type='labels')
 
             # uncertainty
             if final_uncertainty is not None:
@@ -198,7 +248,7 @@ def _diffusion_child(comm, bm=None):
                 if bm.django_env and not bm.remote:
                     bm.path_to_uq = unique_file_path(bm.path_to_uq)
                 if bm.path_to_data:
-                    save_data(bm.path_to_uq, uncertainty_result, compress=bm.compression)
+                    save_data(bm.path_to_uq, uncertainty_result, compress=bm.compression, output_type='uncertainty')
             else:
                 bm.uncertainty = False
 
@@ -213,13 +263,16 @@ def _diffusion_child(comm, bm=None):
                         final_smooth = np.append(final_smooth, receivedata, axis=0)
                 # save finals
                 smooth_result = np.zeros((bm.zsh, bm.ysh, bm.xsh), dtype=np.uint8)
+                if bm.pyramid > 1:
+                    from biomedisa_features.random_walk.pyramid import merge_coarse
+                    final_smooth = merge_coarse(bm, final_smooth, smooth_result)
                 smooth_result[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x] = final_smooth
                 smooth_result = smooth_result[1:-1, 1:-1, 1:-1]
                 results['smooth'] = smooth_result
                 if bm.django_env and not bm.remote:
                     bm.path_to_smooth = unique_file_path(bm.path_to_smooth)
                 if bm.path_to_data:
-                    save_data(bm.path_to_smooth, smooth_result, bm.header, bm.final_image_type, bm.compression)
+                    save_data(bm.path_to_smooth, smooth_result, bm.header, bm.final_image_type, bm.compression, output_type='labels')
             else:
                 bm.smooth = 0
 
@@ -287,6 +340,7 @@ def _diffusion_child(comm, bm=None):
         allLabels = comm.recv(source=0, tag=99)
         indices = comm.recv(source=0, tag=8)
         blocks = comm.recv(source=0, tag=9)
+        subdomains = comm.recv(source=0, tag=98)
 
         blockmin = blocks[rank]
         blockmax = blocks[rank+1]
@@ -301,6 +355,13 @@ def _diffusion_child(comm, bm=None):
                 from biomedisa_features.random_walk.pycuda_large_allx import walk
             else:
                 from biomedisa_features.random_walk.pycuda_large import walk
+        elif allx:
+            # all axes are walked by the portable host engine on OpenCL and CPU nodes
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_large_allx import walk
+        elif platform == 'numba_CPU':
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_large import walk
         else:
             ctx, queue = _get_device(platform, rank)
             from biomedisa_features.random_walk.pyopencl_large import walk
@@ -308,9 +369,10 @@ def _diffusion_child(comm, bm=None):
         # run random walks
         tic = time.time()
         memory_error, final, final_uncertainty, final_smooth = walk(comm, data, labels, indices, nbrw, sorw,
-                blockmin, blockmax, name, allLabels, smooth, uncertainty, ctx, queue, platform)
+                blockmin, blockmax, name, allLabels, smooth, uncertainty, ctx, queue, platform, subdomains)
         tac = time.time()
         print('Walktime_%s: ' %(name) + str(int(tac - tic)) + ' ' + 'seconds')
+        comm.gather(tac - tic, root=0)
 
         # free device
         if platform == 'cuda':
@@ -28,12 +28,148 @@
 
 from biomedisa_features.biomedisa_helper import (_get_device, save_data, unique_file_path,
     sendToChild, _split_indices, get_labels)
+from biomedisa_features.random_walk.cpu_kernels import max_to_uncertainty, compute_uncertainty, smooth_cpu
 from mpi4py import MPI
+import numba
 import numpy as np
 import time
 import socket
 import os
 
+@numba.jit(nopython=True)
+def max_to_label(a, walkmap, final, label_index):
+    zsh, ysh, xsh = a.shape
+    for k in range(zsh):
+        for l in range(ysh):
+            for m in range(xsh):
+                if a[k,l,m] > walkmap[k,l,m]:
+                    walkmap[k,l,m] = a[k,l,m]
+                    final[k,l,m] = label_index
+    return walkmap, final
+
+@numba.jit(nopython=True)
+def _scatter_add(a, index, values):
+    for i in range(index.shape[0]):
+        a[index[i]] += values[i]
+    return a
+
+def reduce_hits(comm, hits, root=0):
+    # the hits of all ranks are summed on root by gathering only the touched voxels,
+    # an index and a value cost 12 bytes, so dense hits are reduced as a whole
+    hits = np.ascontiguousarray(hits, dtype=np.float32)
+    flat = hits.reshape(-1)
+    rank, size = comm.Get_rank(), comm.Get_size()
+    count = 0 if rank == root else np.count_nonzero(flat)
+    counts = comm.allgather(count)
+    if 3 * sum(counts) > flat.size * (size - 1):
+        if rank == root:
+            result = np.empty_like(flat)
+            comm.Reduce(flat, result, op=MPI.SUM, root=root)
+            return result.reshape(hits.shape)
+        comm.Reduce(flat, None, op=MPI.SUM, root=root)
+        return None
+    if rank == root:
+        index = np.empty(0, dtype=np.int64)
+        values = np.empty(0, dtype=np.float32)
+    else:
+        index = np.flatnonzero(flat).astype(np.int64)
+        values = flat[index]
+    if rank == root:
+        recv_index = np.empty(sum(counts), dtype=np.int64)
+        recv_values = np.empty(sum(counts), dtype=np.float32)
+        comm.Gatherv(index, [recv_index, counts], root=root)
+        comm.Gatherv(values, [recv_values, counts], root=root)
+        result = np.copy(flat)
+        _scatter_add(result, recv_index, recv_values)
+        return result.reshape(hits.shape)
+    else:
+        comm.Gatherv(index, None, root=root)
+        comm.Gatherv(values, None, root=root)
+        return None
+
+# upper bound of the hits of the labels that are reduced across ranks at once
+BATCH_BYTES = 1e9
+
+def _batch_size(nol, voxels):
+    return max(1, min(nol, int(BATCH_BYTES // (voxels * 4))))
+
+def _batched(comm, nol, shape, accumulate=None):
+    # collect the hits of several labels and reduce them in one collective,
+    # so ranks wait for each other once per batch instead of once per label
+    size = _batch_size(nol, int(np.prod(shape)))
+    batch = np.empty((size,)+tuple(shape), dtype=np.float32)
+    first = [0]
+    def add(k, hits):
+        batch[k - first[0]] = hits
+        if k - first[0] == size - 1 or k == nol - 1:
+            n = k - first[0] + 1
+            hits = reduce_hits(comm, batch[:n])
+            if accumulate is not None and hits is not None:
+                for l in range(n):
+                    accumulate(first[0] + l, hits[l])
+            first[0] = k + 1
+    return add
+
+def _reduce_labels(comm, walkmap):
+    # sum the hits of all labels on root in batches of labels
+    size = _batch_size(walkmap.shape[0], walkmap[0].size)
+    for k in range(0, walkmap.shape[0], size):
+        hits = reduce_hits(comm, walkmap[k:k+size])
+        if hits is not None:
+            walkmap[k:k+size] = hits
+    return walkmap
+
+def _skip_empty(walk):
+    # ranks without slices take part in every collective with zero hits
+    def walk_chunk(data, slices, indices, indices_child, *args, **kwargs):
+        if len(indices_child):
+            return walk(data, slices, indices, indices_child, *args, **kwargs)
+        if isinstance(slices, list):
+            slices = np.concatenate([slc.reshape(-1) for slc in slices])
+        nol = np.count_nonzero(np.unique(slices) >= 0)
+        accumulate = kwargs.get('accumulate', args[5] if len(args) > 5 else None)
+        if accumulate is not None:
+            for k in range(nol):
+                accumulate(k, np.zeros(data.shape, dtype=np.float32))
+            return None
+        return np.zeros((nol,)+data.shape, dtype=np.float32)
+    return walk_chunk
+
+def _round_sizes(nbrw, nrounds=5):
+    # split the random walks of each pixel into rounds
+    size = max(1, nbrw // nrounds)
+    return [min(size, nbrw - k) for k in range(0, nbrw, size)]
+
+def _adaptive_walk(comm, walk, data, labels, indices, indices_child, nbrw, sorw,
+                   name, ctx, queue, tolerance=None):
+    # run random walks in rounds until the fraction of voxels changing their label
+    # between two rounds falls below the tolerance
+    rank = comm.Get_rank()
+    rounds = _round_sizes(nbrw)
+    final, previous = None, None
+    for r, nbrw_round in enumerate(rounds):
+        walkmap = walk(data, labels, indices, indices_child, nbrw_round, sorw, name, ctx, queue, seed=r)
+        if comm.Get_size() > 1:
+            walkmap = _reduce_labels(comm, walkmap)
+        converged = False
+        if rank == 0:
+            if final is None:
+                final = walkmap
+            else:
+                final += walkmap
+            current = np.argmax(final, axis=0).astype(np.uint8)
+            if previous is not None:
+                touched = np.amax(final, axis=0) > 0
+                changed = np.count_nonzero(current[touched] != previous[touched])
+                changed /= max(1, np.count_nonzero(touched))
+                print('Round %s/%s: %.5f of the voxels changed' %(r+1, len(rounds), changed))
+                converged = changed < tolerance
+            previous = current
+        converged = comm.bcast(converged, root=0)
+        if converged:
+            break
+    return final, r + 1
+
 def _diffusion_child(comm, bm=None):
 
     rank = comm.Get_rank()
@@ -48,14 +184,39 @@ def _diffusion_child(comm, bm=None):
         # initialize results
         results = {}
 
+        # weight each slice by its number of random walks
+        if bm.allaxis:
+            weights = None
+        else:
+            weights = [np.count_nonzero(slc >= 0) * bm.nbrw for slc in bm.labels]
+
         # split indices on GPUs
-        indices_split = _split_indices(bm.indices, ngpus)
+        indices_split = _split_indices(bm.indices, ngpus, weights)
         print('Indices:', indices_split)
+        if weights is not None:
+            loads = [sum(weights[bm.indices.index(k)] for k in part) for part in indices_split]
+            print('Random walks per GPU:', loads)
+
+        # only walk from slices without cached hits
+        if bm.incremental:
+            from biomedisa_features.random_walk.incremental import slice_files
+            box = (bm.argmin_z, bm.argmax_z, bm.argmin_y, bm.argmax_y, bm.argmin_x, bm.argmax_x)
+            files = slice_files(bm.path_to_cache, bm.indices, bm.labels, box)
+            todo = [k for k, path_to_slice in zip(bm.indices, files) if not os.path.exists(path_to_slice)]
+            print('Cached slices:', len(bm.indices) - len(todo))
+            todo_split = _split_indices(todo, ngpus, [weights[bm.indices.index(k)] for k in todo])
+            todo_split += [[] for k in range(ngpus - len(todo_split))]
+
+        # dense hits of all labels are only required for smoothing and returning hits,
+        # the childs follow the same sequence of collectives
+        streaming = not (bm.return_hits or bm.smooth or bm.allaxis or bm.adaptive)
 
         # send data to GPUs
         for k in range(1, ngpus):
             sendToChild(comm, bm.indices, indices_split[k], k, bm.data, bm.labels, bm.nbrw,
                         bm.sorw, bm.allaxis, bm.platform)
+            comm.send((bm.adaptive, streaming), dest=k, tag=11)
+            comm.send((todo_split[k], files, box) if bm.incremental else None, dest=k, tag=12)
 
         # select platform
         if bm.platform == 'cuda':
@@ -70,29 +231,77 @@ def _diffusion_child(comm, bm=None):
                 from biomedisa_features.random_walk.pycuda_small_allx import walk
             else:
                 from biomedisa_features.random_walk.pycuda_small import walk
+        elif bm.allaxis:
+            # all axes are walked by the portable host engine on OpenCL and CPU nodes
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_small_allx import walk
+        elif bm.platform == 'numba_CPU':
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_small import walk
         else:
             ctx, queue = _get_device(bm.platform, rank)
             from biomedisa_features.random_walk.pyopencl_small import walk
+        walk = _skip_empty(walk)
+
+        # stream the hits of each label into a running argmax
+        zsh_tmp = bm.argmax_z - bm.argmin_z
+        ysh_tmp = bm.argmax_y - bm.argmin_y
+        xsh_tmp = bm.argmax_x - bm.argmin_x
+        if streaming:
+            final_zero = np.zeros((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.uint8)
+            max_hits = np.zeros((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+            if bm.uncertainty:
+                max_uq = np.zeros((3, zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+
+            def accumulate(k, hits):
+                hits = np.ascontiguousarray(hits, dtype=np.float32)
+                max_to_label(hits, max_hits, final_zero, k)
+                if bm.uncertainty:
+                    max_to_uncertainty(max_uq, hits)
+
+            # the hits of the GPUs are summed in batches of labels
+            if ngpus > 1:
+                nol = np.count_nonzero(np.unique(bm.labels) >= 0)
+                accumulate = _batched(comm, nol, bm.data.shape, accumulate)
 
         # run random walks
         tic = time.time()
-        walkmap = walk(bm.data, bm.labels, bm.indices, indices_split[0], bm.nbrw, bm.sorw, name, ctx, queue)
+        if bm.incremental:
+            from biomedisa_features.random_walk.incremental import walk_slices, load_hits
+            walk_slices(walk, bm.data, bm.labels, bm.indices, todo_split[0], bm.nbrw, bm.sorw, name, ctx, queue, files, box)
+            comm.Barrier()
+            # sum the cached hits of the current slices, removed slices are ignored
+            if not streaming:
+                final_zero = np.empty((bm.nol, zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+            for k, label in enumerate(bm.allLabels):
+                hits = load_hits(files, label, box)
+                if streaming:
+                    max_to_label(hits, max_hits, final_zero, k)
+                    if bm.uncertainty:
+                        max_to_uncertainty(max_uq, hits)
+                else:
+                    final_zero[k] = hits
+        elif streaming:
+            walk(bm.data, bm.labels, bm.indices, indices_split[0], bm.nbrw, bm.sorw, name, ctx, queue, accumulate)
+        elif bm.adaptive:
+            final_zero, bm.rounds = _adaptive_walk(comm, walk, bm.data, bm.labels, bm.indices, indices_split[0],
+                                    bm.nbrw, bm.sorw, name, ctx, queue, bm.tolerance)
+            results['rounds'] = bm.rounds
+            print('Rounds:', bm.rounds)
+        else:
+            walkmap = walk(bm.data, bm.labels, bm.indices, indices_split[0], bm.nbrw, bm.sorw, name, ctx, queue)
         tac = time.time()
         print('Walktime_%s: ' %(name) + str(int(tac - tic)) + ' ' + 'seconds')
 
-        # gather data
-        zsh_tmp = bm.argmax_z - bm.argmin_z
-        ysh_tmp = bm.argmax_y - bm.argmin_y
-        xsh_tmp = bm.argmax_x - bm.argmin_x
+        # imbalance of walk times between GPUs
+        walktimes = comm.gather(tac - tic, root=0)
         if ngpus > 1:
-            final_zero = np.empty((bm.nol, zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
-            for k in range(bm.nol):
-                sendbuf = np.copy(walkmap[k])
-                recvbuf = np.empty((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
-                comm.Barrier()
-                comm.Reduce([sendbuf, MPI.FLOAT], [recvbuf, MPI.FLOAT], root=0, op=MPI.SUM)
-                final_zero[k] = recvbuf
-        else:
+            print('Walktime imbalance (max/mean): %.2f' %(max(walktimes) / max(np.mean(walktimes), 1e-6)))
+
+        # gather data
+        if not (streaming or bm.adaptive or bm.incremental):
+            if ngpus > 1:
+                walkmap = _reduce_labels(comm, walkmap)
             final_zero = walkmap
 
         # block and grid size
@@ -106,33 +315,59 @@ def _diffusion_child(comm, bm=None):
         # smooth
         if bm.smooth:
             try:
-                update_gpu = _build_update_gpu()
-                curvature_gpu = _build_curvature_gpu()
-                a_gpu = gpuarray.empty((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
-                b_gpu = gpuarray.zeros((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
                 final_smooth = np.copy(final_zero)
-                for k in range(bm.nol):
-                    a_gpu = gpuarray.to_gpu(final_smooth[k])
-                    for l in range(bm.smooth):
-                        curvature_gpu(a_gpu, b_gpu, xsh_gpu, ysh_gpu, block=block, grid=grid)
-                        update_gpu(a_gpu, b_gpu, xsh_gpu, ysh_gpu, block=block, grid=grid)
-                    final_smooth[k] = a_gpu.get()
+                if bm.platform == 'cuda':
+                    update_gpu = _build_update_gpu()
+                    curvature_gpu = _build_curvature_gpu()
+                    a_gpu = gpuarray.empty((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+                    b_gpu = gpuarray.zeros((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+                    for k in range(bm.nol):
+                        a_gpu = gpuarray.to_gpu(final_smooth[k])
+                        for l in range(bm.smooth):
+                            curvature_gpu(a_gpu, b_gpu, xsh_gpu, ysh_gpu, block=block, grid=grid)
+                            update_gpu(a_gpu, b_gpu, xsh_gpu, ysh_gpu, block=block, grid=grid)
+                        final_smooth[k] = a_gpu.get()
+                else:
+                    for k in range(bm.nol):
+                        final_smooth[k] = smooth_cpu(final_smooth[k], bm.smooth)
                 final_smooth = np.argmax(final_smooth, axis=0).astype(np.uint8)
                 final_smooth = get_labels(final_smooth, bm.allLabels)
                 smooth_result = np.zeros((bm.zsh, bm.ysh, bm.xsh), dtype=np.uint8)
+                if bm.pyramid > 1:
+                    from biomedisa_features.random_walk.pyramid import merge_coarse
+                    final_smooth = merge_coarse(bm, final_smooth, smooth_result)
                 smooth_result[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x] = final_smooth
                 smooth_result = smooth_result[1:-1, 1:-1, 1:-1]
                 results['smooth'] = smooth_result
                 if bm.django_env and not bm.remote:
                     bm.path_to_smooth = unique_file_path(bm.path_to_smooth)
                 if bm.path_to_data:
-                    save_data(bm.path_to_smooth, smooth_result, bm.header, bm.final_image_type, bm.compression)
+                    save_data(bm.path_to_smooth, smooth_result, bm.header, bm.final_image_type, bm.compression, output_type='labels')
             except Exception as e:
-                print('Warning: GPU out of memory to allocate smooth array. Process starts without smoothing.')
+                print('Warning: Out of memory to allocate smooth array. Process starts without smoothing.')
                 bm.smooth = 0
 
+        # uncertainty from the running maxima, computed on the host for other platforms than cuda
+        if bm.uncertainty and (streaming or bm.platform != 'cuda'):
+            if not streaming:
+                max_uq = np.zeros((3, zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
+                for k in range(bm.nol):
+                    max_to_uncertainty(max_uq, final_zero[k])
+            uq = compute_uncertainty(max_uq)
+            del max_uq
+            uq *= 255
+            uq = uq.astype(np.uint8)
+            uncertainty_result = np.zeros((bm.zsh, bm.ysh, bm.xsh), dtype=np.uint8)
+            uncertainty_result[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x] = uq
+            uncertainty_result = uncertainty_result[1:-1, 1:-1, 1:-1]
+            results['uncertainty'] = uncertainty_result
+            if bm.django_env and not bm.remote:
+                bm.path_to_uq = unique_file_path(bm.path_to_uq)
+            if bm.path_to_data:
+                save_data(bm.path_to_uq, uncertainty_result, compress=bm.compression, output_type='uncertainty')
+
         # uncertainty
-        if bm.uncertainty:
+        elif bm.uncertainty:
             try:
                 max_gpu = gpuarray.zeros((3, zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
                 a_gpu = gpuarray.zeros((zsh_tmp, ysh_tmp, xsh_tmp), dtype=np.float32)
@@ -152,7 +387,7 @@ def _diffusion_child(comm, bm=None):
                 if bm.django_env and not bm.remote:
                     bm.path_to_uq = unique_file_path(bm.path_to_uq)
                 if bm.path_to_data:
-                    save_data(bm.path_to_uq, uncertainty_result, compress=bm.compression)
+                    save_data(bm.path_to_uq, uncertainty_result, compress=bm.compression, output_type='uncertainty')
             except Exception as e:
                 print('Warning: GPU out of memory to allocate uncertainty array. Process starts without uncertainty.')
                 bm.uncertainty = False
@@ -170,18 +405,26 @@ def _diffusion_child(comm, bm=None):
             results['hits'] = hits
 
         # argmax
-        final_zero = np.argmax(final_zero, axis=0).astype(np.uint8)
+        if streaming:
+            touched = max_hits > 0
+            del max_hits
+        else:
+            touched = np.amax(final_zero, axis=0) > 0
+            final_zero = np.argmax(final_zero, axis=0).astype(np.uint8)
 
         # regular result
         final_zero = get_labels(final_zero, bm.allLabels)
         final_result = np.zeros((bm.zsh, bm.ysh, bm.xsh), dtype=np.uint8)
+        if bm.pyramid > 1:
+            from biomedisa_features.random_walk.pyramid import merge_coarse
+            final_zero = merge_coarse(bm, final_zero, final_result, touched)
         final_result[bm.argmin_z:bm.argmax_z, bm.argmin_y:bm.argmax_y, bm.argmin_x:bm.argmax_x] = final_zero
         final_result = final_result[1:-1,1:-1,1:-1]
         results['regular'] = final_result
         if bm.django_env and not bm.remote:
             bm.path_to_final = unique_file_path(bm.path_to_final)
         if bm.path_to_data:
-            save_data(bm.path_to_final, final_result, bm.header, bm.final_image_type, bm.compression)
+            save_data(bm.path_to_final, final_result, bm.header, bm.final_image_type, bm.compression, output_type='labels')
 
         # computation time
         t = int(time.time() - bm.TIC)
@@ -231,6 +474,8 @@ def _diffusion_child(comm, bm=None):
             comm.Recv([labels, MPI.INT], source=0, tag=6)
         indices = comm.recv(source=0, tag=9)
         indices_child = comm.recv(source=0, tag=10)
+        adaptive, streaming = comm.recv(source=0, tag=11)
+        incremental = comm.recv(source=0, tag=12)
 
         # select platform
         if platform == 'cuda':
@@ -242,15 +487,39 @@ def _diffusion_child(comm, bm=None):
                 from biomedisa_features.random_walk.pycuda_small_allx import walk
             else:
                 from biomedisa_features.random_walk.pycuda_small import walk
+        elif allx:
+            # all axes are walked by the portable host engine on OpenCL and CPU nodes
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_small_allx import walk
+        elif platform == 'numba_CPU':
+            ctx, queue = None, None
+            from biomedisa_features.random_walk.numba_small import walk
         else:
             ctx, queue = _get_device(platform, rank)
             from biomedisa_features.random_walk.pyopencl_small import walk
+        walk = _skip_empty(walk)
+
+        # send the hits in batches of labels as soon as they are computed
+        if streaming:
+            nol = np.count_nonzero(np.unique(labels) >= 0)
+            accumulate = _batched(comm, nol, data.shape)
 
         # run random walks
         tic = time.time()
-        walkmap = walk(data, labels, indices, indices_child, nbrw, sorw, name, ctx, queue)
+        if incremental is not None:
+            from biomedisa_features.random_walk.incremental import walk_slices
+            todo, files, box = incremental
+            walk_slices(walk, data, labels, indices, todo, nbrw, sorw, name, ctx, queue, files, box)
+            comm.Barrier()
+        elif adaptive:
+            _adaptive_walk(comm, walk, data, labels, indices, indices_child, nbrw, sorw, name, ctx, queue)
+        elif streaming:
+            walk(data, labels, indices, indices_child, nbrw, sorw, name, ctx, queue, accumulate)
+        else:
+            walkmap = walk(data, labels, indices, indices_child, nbrw, sorw, name, ctx, queue)
         tac = time.time()
         print('Walktime_%s: ' %(name) + str(int(tac - tic)) + ' ' + 'seconds')
+        comm.gather(tac - tic, root=0)
 
         # free device
         if platform == 'cuda':
@@ -258,8 +527,6 @@ def _diffusion_child(comm, bm=None):
             del ctx
 
         # send data
-        for k in range(walkmap.shape[0]):
-            datatemporaer = np.copy(walkmap[k])
-            comm.Barrier()
-            comm.Reduce([datatemporaer, MPI.FLOAT], None, root=0, op=MPI.SUM)
+        if not (streaming or adaptive or incremental is not None):
+            _reduce_labels(comm, walkmap)
 
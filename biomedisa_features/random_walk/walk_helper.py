@@ -0,0 +1,139 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+import numpy as np
+import numba
+
+# helpers shared by the small and large walks of all backends
+
+def walk_labels(walk_on_device, data, slices, indices, indices_child, nbrw, sorw, name,
+                device=(), accumulate=None, seed=0):
+    # walk the labels of the slices of this rank and map them onto all labels
+    labels = np.unique(slices)
+    slicesChunk = _extract_slices(slices, indices, indices_child)
+    labelsChunk = np.unique(slicesChunk)
+
+    # remove negative labels from list
+    index = np.argwhere(labels<0)
+    labels = np.delete(labels, index)
+    index = np.argwhere(labelsChunk<0)
+    labelsChunk = np.delete(labelsChunk, index)
+
+    # stream the hits of every label to the accumulator
+    if accumulate is not None:
+        chunk2Walkmap = np.nonzero(np.in1d(labels, labelsChunk))[0]
+        empty = np.zeros(data.shape, dtype=np.float32)
+        nextIndex = [0]
+        def _accumulate(chunkIndex, hits):
+            walkmapIndex = chunk2Walkmap[chunkIndex]
+            for k in range(nextIndex[0], walkmapIndex):
+                accumulate(k, empty)
+            accumulate(walkmapIndex, hits)
+            nextIndex[0] = walkmapIndex + 1
+        walk_on_device(data, slicesChunk, labelsChunk, indices_child, nbrw, sorw, name, *device,
+                       accumulate=_accumulate, seed=seed)
+        for k in range(nextIndex[0], len(labels)):
+            accumulate(k, empty)
+        return None
+
+    walkmapChunk = walk_on_device(data, slicesChunk, labelsChunk, indices_child, nbrw, sorw, name, *device, seed=seed)
+
+    if walkmapChunk.shape[0] != len(labels):
+        walkmap = np.zeros((len(labels),)+data.shape, dtype=np.float32)
+        chunk2Walkmap = np.nonzero(np.in1d(labels, labelsChunk))[0]
+        for chunkIndex, walkmapIndex in enumerate(chunk2Walkmap):
+            walkmap[walkmapIndex] += walkmapChunk[chunkIndex]
+    else:
+        walkmap = walkmapChunk
+
+    return walkmap
+
+def _extract_slices(slices, indices, indicesChunk):
+    extracted = np.zeros((0, slices.shape[1], slices.shape[2]), dtype=np.int32)
+    slicesIndicesToExtract = np.nonzero(np.in1d(indices, indicesChunk))[0]
+    for arraySliceIndex in slicesIndicesToExtract:
+        extracted = np.append(extracted, [slices[arraySliceIndex]], axis=0)
+    return extracted
+
+def _seed_offset(seed, nthreads):
+    # shift the random number streams of each pixel by the number of threads per round
+    return np.int32((seed * nthreads) % 1073741824)
+
+def reduceBlocksize(slices):
+    zsh, ysh, xsh = slices.shape
+    argmin_x, argmax_x, argmin_y, argmax_y = xsh, 0, ysh, 0
+    for k in range(zsh):
+        y, x = np.nonzero(slices[k])
+        if x.any():
+            argmin_x = min(argmin_x, np.amin(x))
+            argmax_x = max(argmax_x, np.amax(x))
+            argmin_y = min(argmin_y, np.amin(y))
+            argmax_y = max(argmax_y, np.amax(y))
+    argmin_x = argmin_x - 100 if argmin_x - 100 > 0 else 0
+    argmax_x = argmax_x + 100 if argmax_x + 100 < xsh else xsh
+    argmin_y = argmin_y - 100 if argmin_y - 100 > 0 else 0
+    argmax_y = argmax_y + 100 if argmax_y + 100 < ysh else ysh
+    slices[:, :argmin_y] = -1
+    slices[:, argmax_y:] = -1
+    slices[:, :, :argmin_x] = -1
+    slices[:, :, argmax_x:] = -1
+    return slices
+
+def reduceBlocksize_allx(slices):
+    # unlabeled voxels (-1) of the slices along all axes are ignored
+    testSlices = np.copy(slices)
+    testSlices[testSlices==-1] = 0
+    zsh, ysh, xsh = slices.shape
+    argmin_x, argmax_x, argmin_y, argmax_y = xsh, 0, ysh, 0
+    for k in range(zsh):
+        y, x = np.nonzero(testSlices[k])
+        if x.any():
+            argmin_x = min(argmin_x, np.amin(x))
+            argmax_x = max(argmax_x, np.amax(x))
+            argmin_y = min(argmin_y, np.amin(y))
+            argmax_y = max(argmax_y, np.amax(y))
+    argmin_x = argmin_x - 100 if argmin_x - 100 > 0 else 0
+    argmax_x = argmax_x + 100 if argmax_x + 100 < xsh else xsh
+    argmin_y = argmin_y - 100 if argmin_y - 100 > 0 else 0
+    argmax_y = argmax_y + 100 if argmax_y + 100 < ysh else ysh
+    slices[:, :argmin_y] = -1
+    slices[:, argmax_y:] = -1
+    slices[:, :, :argmin_x] = -1
+    slices[:, :, argmax_x:] = -1
+    return slices
+
+@numba.jit(nopython=True)
+def max_to_label(a, walkmap, final, blockmin, blockmax, segment):
+    zsh, ysh, xsh = a.shape
+    for k in range(blockmin, blockmax):
+        for l in range(ysh):
+            for m in range(xsh):
+                if a[k,l,m] > walkmap[k,l,m]:
+                    walkmap[k,l,m] = a[k,l,m]
+                    final[k-blockmin,l,m] = segment
+    return walkmap, final
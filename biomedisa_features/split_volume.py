@@ -29,7 +29,7 @@
 import sys, os
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
-from biomedisa_features.biomedisa_helper import load_data, save_data
+from biomedisa_features.biomedisa_helper import load_data, save_data, probe_data
 import numpy as np
 import subprocess
 import platform
@@ -71,10 +71,13 @@ if __name__ == '__main__':
         os.remove(f)
 
     # data shape
-    data, _ = load_data(path_to_data, 'split_volume')
-    shape = np.copy(np.array(data.shape))
-    zsh, ysh, xsh = shape
-    del data
+    info = probe_data(path_to_data)
+    if info:
+        zsh, ysh, xsh = info['shape'][:3]
+    else:
+        data, _ = load_data(path_to_data, 'split_volume', lazy=True)
+        zsh, ysh, xsh = data.shape[:3]
+        del data
 
     # split volume
     sub_size_z = np.ceil(zsh / sub_z)
@@ -107,12 +110,12 @@ if __name__ == '__main__':
                 datamax_x = min(blockmax_x + overlap, xsh)
 
                 # extract image subvolume
-                data, _ = load_data(path_to_data, 'split_volume')
+                data, _ = load_data(path_to_data, 'split_volume', lazy=True)
                 save_data(BASE_DIR+f'/tmp/sub_volume_{subvolume}.tif', data[datamin_z:datamax_z,datamin_y:datamax_y,datamin_x:datamax_x], False)
                 del data
 
                 # extract label subvolume
-                labelData, header, final_image_type = load_data(path_to_labels, 'split_volume', True)
+                labelData, header, final_image_type = load_data(path_to_labels, 'split_volume', True, lazy=True)
                 save_data(BASE_DIR+'/tmp/labels.sub_volume.tif', labelData[datamin_z:datamax_z,datamin_y:datamax_y,datamin_x:datamax_x])
                 del labelData
 
@@ -0,0 +1,227 @@
+##########################################################################
+##                                                                      ##
+##  Copyright (c) 2024 Philipp Lösel. All rights reserved.              ##
+##                                                                      ##
+##  This file is part of the open source project biomedisa.             ##
+##                                                                      ##
+##  Licensed under the European Union Public Licence (EUPL)             ##
+##  v1.2, or - as soon as they will be approved by the                  ##
+##  European Commission - subsequent versions of the EUPL;              ##
+##                                                                      ##
+##  You may redistribute it and/or modify it under the terms            ##
+##  of the EUPL v1.2. You may not use this work except in               ##
+##  compliance with this Licence.                                       ##
+##                                                                      ##
+##  You can obtain a copy of the Licence at:                            ##
+##                                                                      ##
+##  https://joinup.ec.europa.eu/page/eupl-text-11-12                    ##
+##                                                                      ##
+##  Unless required by applicable law or agreed to in                   ##
+##  writing, software distributed under the Licence is                  ##
+##  distributed on an "AS IS" basis, WITHOUT WARRANTIES                 ##
+##  OR CONDITIONS OF ANY KIND, either express or implied.               ##
+##                                                                      ##
+##  See the Licence for the specific language governing                 ##
+##  permissions and limitations under the Licence.                      ##
+##                                                                      ##
+##########################################################################
+
+try:
+    from biomedisa_app.config import config
+except:
+    from biomedisa_app.config_example import config
+from biomedisa.settings import BASE_DIR
+import numpy as np
+import threading
+import hashlib
+import shutil
+import json
+import glob
+import os
+
+# formats whose headers reference the source files are cached per upload
+PATH_BOUND = ['.nc', '.zip']
+
+# medpy headers carry the full SimpleITK image and are not cached
+UNCACHED = ['.hdr', '.mhd', '.mha', '.nrrd', '.nii', '.nii.gz']
+
+def _cache_dir():
+    return config.get('VOLUME_CACHE_DIR', BASE_DIR + '/tmp/volume_cache')
+
+def _budget():
+    # disk budget in bytes, zero disables the cache
+    return int(float(config.get('VOLUME_CACHE_SIZE', 0)) * 1024**3)
+
+def enabled():
+    return _budget() > 0
+
+def _sources(path_to_data):
+    # the zip archive or its extracted directory, a file or a block directory
+    if os.path.isfile(path_to_data):
+        return [path_to_data]
+    if path_to_data[-4:] == '.zip' and os.path.isdir(path_to_data[:-4]):
+        path_to_data = path_to_data[:-4]
+    files = glob.glob(path_to_data+'/**/*', recursive=True)
+    return sorted([name for name in files if os.path.isfile(name)])
+
+def content_hash(path_to_data, extension):
+    """Key of a decoded volume derived from the content of its source files"""
+    files = _sources(path_to_data)
+    if not files:
+        return None
+
+    # reuse the digest as long as size and modification time are unchanged
+    stats = [(os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+    index = _cache_dir() + '/index/' + hashlib.sha1(os.path.abspath(path_to_data).encode()).hexdigest()
+    if os.path.isfile(index):
+        try:
+            with open(index, 'r') as f:
+                entry = json.load(f)
+            if entry['stats'] == [list(s) for s in stats]:
+                return entry['key']
+        except Exception:
+            pass
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(extension.encode())
+    if extension in PATH_BOUND:
+        digest.update(os.path.abspath(path_to_data).encode())
+    for f in files:
+        if len(files) > 1:
+            digest.update(os.path.relpath(f, path_to_data[:-4] if path_to_data[-4:] == '.zip' else path_to_data).encode())
+        with open(f, 'rb') as stream:
+            for block in iter(lambda: stream.read(16*1024**2), b''):
+                digest.update(block)
+    key = digest.hexdigest()
+
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    with open(index + '.' + str(os.getpid()), 'w') as f:
+        json.dump({'stats': stats, 'key': key}, f)
+    os.replace(index + '.' + str(os.getpid()), index)
+    return key
+
+def _encode(obj, arrays):
+    # headers are stored as JSON with their arrays in an npz archive, so
+    # loading an entry never unpickles data from the shared cache directory
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        arrays.append(obj)
+        return {'array': len(arrays) - 1}
+    if isinstance(obj, np.dtype):
+        return {'dtype': obj.str}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (list, tuple)):
+        return {'list': [_encode(o, arrays) for o in obj]}
+    if isinstance(obj, dict):
+        return {'dict': [[str(k), _encode(v, arrays)] for k, v in obj.items()]}
+    if type(obj).__name__ == 'SliceHeaders':
+        return {'slices': _encode(vars(obj), arrays)}
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise TypeError('header of type %s cannot be cached' % type(obj).__name__)
+
+def _decode(obj, arrays):
+    if not isinstance(obj, dict):
+        return obj
+    if 'array' in obj:
+        return arrays['arr_%s' % obj['array']]
+    if 'dtype' in obj:
+        return np.dtype(obj['dtype'])
+    if 'list' in obj:
+        return [_decode(o, arrays) for o in obj['list']]
+    if 'dict' in obj:
+        return {k: _decode(v, arrays) for k, v in obj['dict']}
+    from biomedisa_features.biomedisa_helper import SliceHeaders
+    headers = SliceHeaders(0, 0)
+    headers.__dict__.update(_decode(obj['slices'], arrays))
+    return headers
+
+def lookup(key):
+    """Decoded volume as copy-on-write memory map, header and extension"""
+    entry = _cache_dir() + '/' + key
+    try:
+        with open(entry + '/header.json', 'r') as f:
+            header, extension = json.load(f)
+        with np.load(entry + '/header.npz', allow_pickle=False) as arrays:
+            header = _decode(header, arrays)
+        data = np.load(entry + '/data.npy', mmap_mode='c', allow_pickle=False)
+    except Exception:
+        return None
+    # most recently used
+    os.utime(entry)
+    return data, header, extension
+
+def store(key, data, header, extension):
+    """Add a decoded volume and evict the least recently used entries
+
+    The volume is written from the caller's array without a copy, so
+    ``data`` must not be modified before the call returns.
+    """
+    budget = _budget()
+    if data.nbytes > budget:
+        return
+    if os.path.isfile(_cache_dir() + '/' + key + '/header.json'):
+        return
+    try:
+        arrays = []
+        header = json.dumps([_encode(header, arrays), extension])
+    except TypeError as e:
+        print('Warning: could not cache decoded volume.', e)
+        return
+    _write(key, data, header, arrays, budget)
+
+def _write(key, data, header, arrays, budget):
+    cache_dir = _cache_dir()
+    entry = cache_dir + '/' + key
+    tmp = cache_dir + '/tmp.' + key + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        np.save(tmp + '/data.npy', np.asarray(data), allow_pickle=False)
+        np.savez(tmp + '/header.npz', *arrays)
+        with open(tmp + '/header.json', 'w') as f:
+            f.write(header)
+        # entries of an older layout are replaced
+        if os.path.isdir(entry) and not os.path.isfile(entry + '/header.json'):
+            shutil.rmtree(entry, ignore_errors=True)
+        # publish atomically, another job may have won the race
+        os.rename(tmp, entry)
+        evict(budget, keep=key)
+    except Exception as e:
+        print('Warning: could not cache decoded volume.', e)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _size(path):
+    # entries may be removed by other jobs at any time
+    try:
+        return sum(os.path.getsize(path + '/' + f) for f in os.listdir(path))
+    except OSError:
+        return None
+
+def evict(budget, keep=None, cache_dir=None):
+    # every directory of the cache is one entry
+    cache_dir = cache_dir or _cache_dir()
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        path = cache_dir + '/' + name
+        if name in ['index', keep] or name[:4] == 'tmp.' or not os.path.isdir(path):
+            continue
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        size = _size(path)
+        if size is not None:
+            entries.append((mtime, size, path))
+    total = sum(e[1] for e in entries)
+    if keep is not None:
+        total += _size(cache_dir + '/' + keep) or 0
+    # remove least recently used entries first, mapped arrays stay valid
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
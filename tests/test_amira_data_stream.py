@@ -0,0 +1,68 @@
+import os
+import sys
+import zlib
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+import numpy as np
+import pytest
+from biomedisa_features.amira_to_np import amira_data_stream as stream
+
+def _volume(size, seed=0):
+    # runs of random length mixed with noise
+    rng = np.random.default_rng(seed)
+    data = np.empty(size, dtype=np.uint8)
+    i = 0
+    while i < size:
+        n = int(rng.integers(1, 300))
+        if rng.random() < 0.5:
+            data[i:i+n] = rng.integers(0, 256)
+        else:
+            data[i:i+n] = rng.integers(0, 256, size=len(data[i:i+n]))
+        i += n
+    return data
+
+@pytest.mark.parametrize('size', [0, 1, 2, 127, 128, 129, 1000, 50000])
+@pytest.mark.parametrize('segment_size', [1, 7, 127, 128, 4096])
+def test_byterle_round_trip(size, segment_size):
+    data = _volume(size)
+    encoded = stream.byterle_encode_parallel(data, segment_size) if size else np.zeros(0, np.uint8)
+    size_, in_offsets, out_offsets = stream.byterle_index(encoded, segment_size)
+    assert size_ == size
+    output = np.empty(size, dtype=np.uint8)
+    stream.byterle_decode_parallel(encoded, in_offsets, out_offsets, output)
+    np.testing.assert_array_equal(output, data)
+
+def test_byterle_matches_serial_decoder():
+    # segments encoded independently form one valid stream
+    data = _volume(20000, seed=1)
+    encoded = stream.byterle_encode_parallel(data, 333)
+    np.testing.assert_array_equal(np.asarray(stream.byterle_decoder(encoded.tolist(), data.size)), data)
+
+def test_byterle_runs_across_segments():
+    data = np.zeros(1000, dtype=np.uint8)
+    data[400:700] = 5
+    for segment_size in [100, 256, 999, 1000]:
+        encoded = stream.byterle_encode_parallel(data, segment_size)
+        size, in_offsets, out_offsets = stream.byterle_index(encoded, 64)
+        output = np.empty(size, dtype=np.uint8)
+        stream.byterle_decode_parallel(encoded, in_offsets, out_offsets, output)
+        np.testing.assert_array_equal(output, data)
+
+def test_hxbyterle_round_trip():
+    data = _volume(30000, seed=2).reshape(10, 30, 100)
+    encoded = stream.hxbyterle_encode(data)
+    decoded = stream.hxbyterle_decode(data.size, bytes(encoded))
+    np.testing.assert_array_equal(decoded, data.reshape(-1))
+
+@pytest.mark.parametrize('segment_size', [1000, 4096, 100000])
+def test_hxzip_round_trip(monkeypatch, segment_size):
+    monkeypatch.setattr(stream, 'SEGMENT_SIZE', segment_size)
+    data = _volume(50000, seed=3)
+    encoded = stream.hxzip_encode(data)
+    # a single zlib stream readable by any decoder
+    np.testing.assert_array_equal(np.frombuffer(zlib.decompress(encoded), dtype=np.uint8), data)
+    np.testing.assert_array_equal(stream.hxzip_decode(data.size, encoded), data)
+
+def test_hxzip_empty():
+    encoded = stream.hxzip_encode(np.zeros(0, dtype=np.uint8))
+    assert zlib.decompress(encoded) == b''
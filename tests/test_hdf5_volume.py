@@ -0,0 +1,51 @@
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+import numpy as np
+import pytest
+from biomedisa_features.hdf5_volume import np_to_h5, h5_to_np, ChunkedArray
+
+# partial chunks at the edges of every axis
+SHAPE = (70, 65, 130)
+
+KEYS = [
+    np.s_[:],
+    np.s_[5],
+    np.s_[-1],
+    np.s_[3:67, -10:, 60:129],
+    np.s_[-70:-2, 1:64, 64:],
+    np.s_[10:5],
+    np.s_[:, 64],
+    np.s_[69, -65, -1],
+    np.s_[::2, 1:60:3],
+    ]
+
+@pytest.fixture(scope='module', params=[True, False])
+def volume(tmp_path_factory, request):
+    arr = np.random.default_rng(0).integers(0, 65535, size=SHAPE).astype(np.uint16)
+    path = str(tmp_path_factory.mktemp('h5') / 'volume.hdf5')
+    np_to_h5(path, arr, compress=request.param)
+    return path, arr
+
+@pytest.mark.parametrize('key', KEYS)
+def test_crop_equals_numpy(volume, key):
+    path, arr = volume
+    data = ChunkedArray(path)
+    np.testing.assert_array_equal(data[key], arr[key])
+    data.close()
+
+def test_round_trip(volume):
+    path, arr = volume
+    np.testing.assert_array_equal(h5_to_np(path), arr)
+
+def test_levels(tmp_path):
+    # levels are stored while their smallest axis spans a chunk
+    arr = np.random.default_rng(1).integers(0, 255, size=(130, 140, 260)).astype(np.uint8)
+    path = str(tmp_path / 'levels.hdf5')
+    np_to_h5(path, arr)
+    data = ChunkedArray(path, level=1)
+    np.testing.assert_array_equal(data[3:40, -20:, 100:], arr[::2, ::2, ::2][3:40, -20:, 100:])
+    data.close()
+    with pytest.raises(KeyError):
+        ChunkedArray(path, level=2)